@@ -0,0 +1,378 @@
+"""
+Side-by-side latency comparison of original_code.app and refactored_code.app.
+
+Both ASGI apps are driven in-process (no sockets) with the same recorded
+workload: a seeded request mix over every route the two versions share,
+replayed against the same seeded data set (benchmarks/datasets.py). Each round
+resets both apps and replays the workload once per app, alternating which goes
+first. A final replay under tracemalloc records the peak memory each request
+allocates. The report has p50/p95/p99 per route for both versions, the
+allocation figures and how many responses differed in status class.
+
+The exit status is 1 when, for any route with enough samples, the refactored
+version's --metric latency is more than --threshold slower than the original.
+
+Run: python -m benchmarks.bench_compare --size 10000 --requests 5000 --threshold 0.10
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Dict, List, Optional
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LIBRARY_STORAGE", "memory")
+
+import original_code as oc  # noqa: E402
+import refactored_code as rc  # noqa: E402
+from benchmarks.bench_suite import percentile  # noqa: E402
+from benchmarks.datasets import GENRES, Library, load, synthetic_library  # noqa: E402
+
+APPS = ("original", "refactored")
+MAX_LOANS = {"basic": 3, "premium": 10, "student": 5}
+# Relative frequency of each route in the generated workload
+ROUTE_WEIGHTS = {
+    ("GET", "/books/{book_id}"): 20,
+    ("GET", "/users/{user_id}"): 10,
+    ("GET", "/books/search"): 16,
+    ("GET", "/users/{user_id}/loans"): 8,
+    ("GET", "/loans/{loan_id}"): 8,
+    ("GET", "/reservations/{user_id}"): 4,
+    ("GET", "/statistics"): 2,
+    ("POST", "/loans"): 10,
+    ("POST", "/loans/{loan_id}/return"): 6,
+    ("POST", "/loans/{loan_id}/renew"): 3,
+    ("POST", "/reservations"): 4,
+    ("POST", "/books"): 2,
+    ("POST", "/users"): 2,
+}
+_SEARCH_WORDS = ("river", "garden", "code", "night", "atlas", "storm")
+_AUTHORS = ("koval", "melnyk", "anna", "bondar")
+
+
+def record_workload(library: Library, count: int, seed: int) -> List[dict]:
+    """
+    `count` requests as {"route", "method", "path", "query", "body"} dicts.
+    Checkouts only go to users with room under their loan limit, and returns
+    and renewals target loans the workload itself knows to be active, so most
+    requests succeed on both versions.
+    """
+    rng = random.Random(seed)
+    routes = list(ROUTE_WEIGHTS)
+    weights = list(ROUTE_WEIGHTS.values())
+    n_books, n_users = len(library.books), len(library.users)
+    membership = {user["id"]: user["membership_type"] for user in library.users}
+    active_by_user: Dict[int, int] = {}
+    active_loans: List[int] = []
+    for loan in library.loans:
+        if loan["status"] == "active":
+            active_by_user[loan["user_id"]] = active_by_user.get(loan["user_id"], 0) + 1
+            active_loans.append(loan["id"])
+    next_loan_id = len(library.loans) + 1
+
+    workload = []
+    for _ in range(count):
+        method, route = rng.choices(routes, weights)[0]
+        path, query, body = route, {}, None
+        if route == "/books/{book_id}":
+            path = f"/books/{rng.randint(1, n_books)}"
+        elif route in ("/users/{user_id}", "/users/{user_id}/loans", "/reservations/{user_id}"):
+            path = route.replace("{user_id}", str(rng.randint(1, n_users)))
+        elif route == "/books/search":
+            roll = rng.random()
+            if roll < 0.6:
+                query = {"q": f"{rng.choice(_SEARCH_WORDS)} {rng.randint(1, n_books)}"}
+            elif roll < 0.85:
+                query = {"q": rng.choice(_SEARCH_WORDS), "genre": rng.choice(GENRES)}
+            else:
+                query = {"author": rng.choice(_AUTHORS), "genre": rng.choice(GENRES)}
+        elif route == "/loans/{loan_id}":
+            path = f"/loans/{rng.randint(1, next_loan_id - 1)}"
+        elif route == "/loans":
+            for _ in range(20):
+                user_id = rng.randint(1, n_users)
+                if active_by_user.get(user_id, 0) < MAX_LOANS[membership[user_id]]:
+                    break
+            body = {"user_id": user_id, "book_id": rng.randint(1, n_books)}
+            if active_by_user.get(user_id, 0) < MAX_LOANS[membership[user_id]]:
+                active_by_user[user_id] = active_by_user.get(user_id, 0) + 1
+                active_loans.append(next_loan_id)
+                next_loan_id += 1
+        elif route == "/loans/{loan_id}/return":
+            loan_id = active_loans.pop(rng.randrange(len(active_loans))) if active_loans else 1
+            path = f"/loans/{loan_id}/return"
+        elif route == "/loans/{loan_id}/renew":
+            loan_id = rng.choice(active_loans) if active_loans else 1
+            path = f"/loans/{loan_id}/renew"
+        elif route == "/reservations":
+            body = {"user_id": rng.randint(1, n_users), "book_id": rng.randint(1, n_books)}
+        elif route == "/books":
+            n_books += 1
+            body = {
+                "title": f"Harbor {rng.choice(_SEARCH_WORDS)} {n_books}",
+                "author": "Sofia Koval",
+                "isbn": f"979-{n_books:010d}",
+                "genre": rng.choice(GENRES),
+                "year": rng.randint(1900, 2024),
+                "copies": 5,
+                "available_copies": 5,
+            }
+        elif route == "/users":
+            n_users += 1
+            membership[n_users] = rng.choice(tuple(MAX_LOANS))
+            body = {
+                "name": f"User {n_users}",
+                "email": f"user{n_users}@example.com",
+                "phone": f"+380{n_users:09d}",
+                "membership_type": membership[n_users],
+            }
+        workload.append(
+            {"route": route, "method": method, "path": path, "query": query, "body": body}
+        )
+    return workload
+
+
+def reset(app_name: str, library: Library) -> None:
+    """Empties one app's state and loads `library` (a fresh copy per call) into it."""
+    if app_name == "original":
+        for table in (oc.books, oc.users, oc.loans, oc.reservations):
+            table.clear()
+        oc.books.update((book["id"], book) for book in library.books)
+        oc.users.update((user["id"], user) for user in library.users)
+        oc.loans.update((loan["id"], loan) for loan in library.loans)
+        oc.cnt, oc.cnt2, oc.cnt3 = len(library.books), len(library.users), len(library.loans)
+    else:
+        rc.store.clear()
+        rc.response_cache.clear()
+        rc.fragment_cache.clear()
+        load(rc.store, library)
+
+
+def _scope(request: dict) -> dict:
+    body = request["body"]
+    headers = [(b"host", b"bench")]
+    if body is not None:
+        headers.append((b"content-type", b"application/json"))
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": request["method"],
+        "scheme": "http",
+        "path": request["path"],
+        "raw_path": request["path"].encode(),
+        "query_string": urlencode(request["query"]).encode(),
+        "root_path": "",
+        "headers": headers,
+        "client": ("127.0.0.1", 50000),
+        "server": ("bench", 80),
+    }
+
+
+async def _call(app, request: dict) -> int:
+    """Runs one request through `app` and returns the response status."""
+    body = b"" if request["body"] is None else json.dumps(request["body"]).encode()
+    sent = False
+    status = 0
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            return {"type": "http.disconnect"}
+        sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(_scope(request), receive, send)
+    return status
+
+
+async def _replay(app, workload: List[dict], trace_memory: bool):
+    clock = time.perf_counter_ns
+    samples = []
+    for request in workload:
+        if trace_memory:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = clock()
+        status = await _call(app, request)
+        elapsed = clock() - start
+        allocated = tracemalloc.get_traced_memory()[1] - before if trace_memory else 0
+        samples.append((elapsed, allocated, status))
+    return samples
+
+
+@contextlib.contextmanager
+def _quiet():
+    """
+    Sends the original's prints and the refactored app's log lines to
+    /dev/null, so both versions still pay for them but the terminal stays clean.
+    """
+    handlers = [h for h in logging.getLogger().handlers if isinstance(h, logging.StreamHandler)]
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        streams = [h.setStream(devnull) for h in handlers]
+        try:
+            yield
+        finally:
+            for handler, stream in zip(handlers, streams):
+                handler.setStream(stream)
+
+
+def run(
+    workload: List[dict], size: int, seed: int, rounds: int, allocations: bool
+) -> Dict[str, List[tuple]]:
+    """Samples per app as (route_key, elapsed_ns, allocated_bytes, status)."""
+    apps = {"original": oc.app, "refactored": rc.app}
+    now = datetime.now()
+    samples: Dict[str, List[tuple]] = {name: [] for name in APPS}
+    routes = [f"{request['method']} {request['route']}" for request in workload]
+    loop = asyncio.new_event_loop()
+    try:
+        with _quiet():
+            for round_no in range(rounds + int(allocations)):
+                trace = round_no == rounds
+                order = APPS if round_no % 2 == 0 else APPS[::-1]
+                for name in order:
+                    reset(name, synthetic_library(size, seed, now))
+                    if trace:
+                        tracemalloc.start()
+                    try:
+                        replayed = loop.run_until_complete(_replay(apps[name], workload, trace))
+                    finally:
+                        if trace:
+                            tracemalloc.stop()
+                    for route, (elapsed, allocated, status) in zip(routes, replayed):
+                        if trace:
+                            samples[name].append((route, None, allocated, status))
+                        else:
+                            samples[name].append((route, elapsed, None, status))
+    finally:
+        loop.close()
+    return samples
+
+
+def summarize(samples: Dict[str, List[tuple]]) -> List[dict]:
+    rows: Dict[str, dict] = {}
+    for name in APPS:
+        by_route: Dict[str, dict] = {}
+        for route, elapsed, allocated, status in samples[name]:
+            entry = by_route.setdefault(route, {"ns": [], "bytes": [], "statuses": []})
+            if elapsed is not None:
+                entry["ns"].append(elapsed)
+                entry["statuses"].append(status // 100)
+            else:
+                entry["bytes"].append(allocated)
+        for route, entry in by_route.items():
+            ordered = sorted(entry["ns"])
+            row = rows.setdefault(route, {"route": route, "samples": len(ordered)})
+            row[name] = {
+                "p50_us": round(percentile(ordered, 0.50) / 1000, 1),
+                "p95_us": round(percentile(ordered, 0.95) / 1000, 1),
+                "p99_us": round(percentile(ordered, 0.99) / 1000, 1),
+                "alloc_peak_kib": (
+                    round(sum(entry["bytes"]) / len(entry["bytes"]) / 1024, 1)
+                    if entry["bytes"] else None
+                ),
+                "ok": sum(1 for status in entry["statuses"] if status == 2),
+            }
+            row[f"_{name}_statuses"] = entry["statuses"]
+    for row in rows.values():
+        original, refactored = row.pop("_original_statuses"), row.pop("_refactored_statuses")
+        row["status_mismatches"] = sum(1 for a, b in zip(original, refactored) if a != b)
+    return sorted(rows.values(), key=lambda row: row["route"])
+
+
+def regressions(rows: List[dict], metric: str, threshold: float, min_samples: int) -> List[str]:
+    """Routes where the refactored `metric` is more than `threshold` above the original's."""
+    slower = []
+    for row in rows:
+        base, current = row["original"][metric], row["refactored"][metric]
+        if row["samples"] >= min_samples and base and current / base - 1 > threshold:
+            slower.append(row["route"])
+    return slower
+
+
+def format_table(rows: List[dict]) -> List[str]:
+    lines = [
+        f"{'route':<34} {'n':>6} {'orig p50':>9} {'ref p50':>9} {'orig p95':>9} "
+        f"{'ref p95':>9} {'orig p99':>9} {'ref p99':>9} {'orig KiB':>9} {'ref KiB':>9}"
+    ]
+    for row in rows:
+        original, refactored = row["original"], row["refactored"]
+        cells = [
+            original["p50_us"], refactored["p50_us"], original["p95_us"], refactored["p95_us"],
+            original["p99_us"], refactored["p99_us"],
+            original["alloc_peak_kib"], refactored["alloc_peak_kib"],
+        ]
+        lines.append(
+            f"{row['route']:<34} {row['samples']:>6} "
+            + " ".join("        -" if cell is None else f"{cell:>9.1f}" for cell in cells)
+        )
+    return lines
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--size", type=int, default=10_000, help="books and loans seeded")
+    parser.add_argument("--requests", type=int, default=5_000, help="requests per replay")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workload", help="replay this recorded workload (JSON) instead")
+    parser.add_argument("--record", help="also write the workload used to this file")
+    parser.add_argument("--no-allocations", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--metric", choices=("p50_us", "p95_us", "p99_us"), default="p50_us")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown")
+    parser.add_argument("--min-samples", type=int, default=30, help="per route, to be judged")
+    parser.add_argument("--output", help="write the JSON report here")
+    args = parser.parse_args(argv)
+
+    if args.workload:
+        with open(args.workload, encoding="utf-8") as source:
+            workload = json.load(source)
+    else:
+        workload = record_workload(synthetic_library(args.size, args.seed), args.requests, args.seed)
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as out:
+            json.dump(workload, out)
+
+    samples = run(workload, args.size, args.seed, args.rounds, not args.no_allocations)
+    rows = summarize(samples)
+    slower = regressions(rows, args.metric, args.threshold, args.min_samples)
+    report = {
+        "size": args.size,
+        "requests": len(workload),
+        "rounds": args.rounds,
+        "metric": args.metric,
+        "threshold": args.threshold,
+        "routes": rows,
+        "regressions": slower,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as out:
+            json.dump(report, out, indent=2)
+            out.write("\n")
+    for line in format_table(rows):
+        print(line)
+    if slower:
+        print(f"\nrefactored slower than original by >{args.threshold:.0%} ({args.metric}): "
+              + ", ".join(slower))
+        return 1
+    print(f"\nno route regressed by >{args.threshold:.0%} ({args.metric})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""
+Throughput of the batch fine job (fines.py).
+
+* kernel - fines for N synthetic due timestamps (default 10M), NumPy vs. the
+           pure Python fallback (capped by --python-max to keep runs short).
+* sweep  - apply_overdue_fines end to end on a populated store, per backend.
+
+Prints one JSON line per case with loans per second.
+
+Run: python -m benchmarks.bench_fines --kernel-loans 10000000 --store-loans 200000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fines import FINE_PER_DAY, apply_overdue_fines, compute_fines, np  # noqa: E402
+from storage import SECONDS_PER_DAY, InMemoryStore, SQLiteStore, to_timestamp  # noqa: E402
+
+SEED = 42
+
+
+def bench_kernel(count: int, use_numpy: bool) -> dict:
+    rng = random.Random(SEED)
+    now_ts = to_timestamp(datetime.now())
+    due = [now_ts - rng.uniform(0, 60 * SECONDS_PER_DAY) for _ in range(count)]
+    if use_numpy:
+        due = np.asarray(due)
+    start = time.perf_counter()
+    compute_fines(due, now_ts, FINE_PER_DAY, use_numpy=use_numpy)
+    elapsed = time.perf_counter() - start
+    return {
+        "case": "kernel",
+        "path": "numpy" if use_numpy else "python",
+        "loans": count,
+        "seconds": round(elapsed, 4),
+        "loans_per_second": round(count / elapsed),
+    }
+
+
+def populate(store, count: int) -> None:
+    rng = random.Random(SEED)
+    now = datetime.now()
+    users = max(1, count // 20)
+    with store.transaction():
+        store.insert_users(
+            [
+                {
+                    "id": user_id,
+                    "name": f"User {user_id}",
+                    "email": f"user{user_id}@example.com",
+                    "phone": "000",
+                    "membership_type": "basic",
+                    "balance": 0.0,
+                    "active": True,
+                    "registered_at": now.isoformat(),
+                }
+                for user_id in range(1, users + 1)
+            ]
+        )
+        store.reserve_ids("user", users)
+        for loan_id in range(1, count + 1):
+            due = now - timedelta(days=rng.uniform(-14, 45))
+            store.insert_loan(
+                {
+                    "id": loan_id,
+                    "user_id": rng.randint(1, users),
+                    "book_id": 1,
+                    "issue_date": (due - timedelta(days=14)).isoformat(),
+                    "due_date": due.isoformat(),
+                    "status": "active",
+                    "fine_applied": False,
+                    "renewed": False,
+                }
+            )
+        store.reserve_ids("loan", count)
+
+
+def bench_sweep(backend: str, count: int, use_numpy: bool) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        if backend == "memory":
+            store = InMemoryStore()
+        else:
+            store = SQLiteStore(os.path.join(tmp, "fines.db"))
+        populate(store, count)
+        report = apply_overdue_fines(store, FINE_PER_DAY, use_numpy=use_numpy)
+        if backend == "sqlite":
+            store.close()
+    return {
+        "case": "sweep",
+        "backend": backend,
+        "path": "numpy" if use_numpy else "python",
+        "loans": count,
+        "charged_loans": report["charged_loans"],
+        "compute_seconds": report["compute_seconds"],
+        "seconds": report["total_seconds"],
+        "loans_per_second": round(count / report["total_seconds"]),
+    }
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--kernel-loans", type=int, default=10_000_000)
+    parser.add_argument("--python-max", type=int, default=1_000_000)
+    parser.add_argument("--store-loans", type=int, default=100_000)
+    parser.add_argument("--backends", nargs="+", default=["memory", "sqlite"])
+    args = parser.parse_args(argv)
+
+    paths = [True, False] if np is not None else [False]
+    for use_numpy in paths:
+        count = args.kernel_loans if use_numpy else min(args.kernel_loans, args.python_max)
+        print(json.dumps(bench_kernel(count, use_numpy)), flush=True)
+    for backend in args.backends:
+        for use_numpy in paths:
+            print(json.dumps(bench_sweep(backend, args.store_loans, use_numpy)), flush=True)
+
+
+if __name__ == "__main__":
+    main()
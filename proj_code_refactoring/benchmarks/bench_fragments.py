@@ -0,0 +1,182 @@
+"""
+Serialization cost of GET /users/{id}/loans, GET /loans/{id} and the full
+GET /books/search listing: FastAPI's default path (jsonable_encoder +
+JSONResponse) vs. responses spliced from the pre-encoded loan and book
+fragment caches, with the stdlib and orjson encoders.
+Handlers are called in-process so HTTP overhead does not hide the difference.
+Prints one JSON line per case.
+
+Run: python -m benchmarks.bench_fragments --loans 200 --repeat 200
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Callable, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LIBRARY_STORAGE", "memory")
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+import refactored_code as rc  # noqa: E402
+from caching import JSON_ENCODERS, get_json_encoder  # noqa: E402
+
+USER_ID = 1
+
+
+def populate(n_loans: int) -> None:
+    rc.store.clear()
+    now = datetime.now()
+    rc.store.insert_user(
+        {
+            "id": rc.store.next_id("user"),
+            "name": "Bench User",
+            "email": "bench@example.com",
+            "phone": "000",
+            "membership_type": "premium",
+            "balance": 0.0,
+            "active": True,
+            "registered_at": now.isoformat(),
+        }
+    )
+    for i in range(n_loans):
+        book_id = rc.store.next_id("book")
+        rc.store.insert_book(
+            {
+                "id": book_id,
+                "title": f"Book title {i}",
+                "author": f"Author {i % 50}",
+                "isbn": f"978-{i:010d}",
+                "genre": ("fiction", "science", "history")[i % 3],
+                "year": 1990 + i % 30,
+                "copies": 1,
+                "available_copies": 0,
+            }
+        )
+        issue = now - timedelta(days=i % 40)
+        rc.store.insert_loan(
+            {
+                "id": rc.store.next_id("loan"),
+                "user_id": USER_ID,
+                "book_id": book_id,
+                "issue_date": issue.isoformat(),
+                "due_date": (issue + timedelta(days=14)).isoformat(),
+                "status": "active" if i % 4 else "returned",
+                "fine_applied": False,
+                "renewed": False,
+            }
+        )
+
+
+def default_user_loans() -> bytes:
+    """What FastAPI does with the dict the handler returned before fragments."""
+    now = datetime.now()
+    result = []
+    for loan in rc.store.loans_for_user(USER_ID):
+        book = rc.store.get_book(loan["book_id"])
+        result.append(
+            {
+                "loan": loan,
+                "book_title": book["title"] if book else "Unknown",
+                "fine": rc.calculate_fine(loan, now),
+            }
+        )
+    total_fine = sum(item["fine"] for item in result)
+    payload = {"loans": result, "total_fine": round(total_fine, 2)}
+    return JSONResponse(jsonable_encoder(payload)).body
+
+
+def default_loan() -> bytes:
+    loan = rc.store.get_loan(1)
+    user = rc.store.get_user(loan["user_id"])
+    book = rc.store.get_book(loan["book_id"])
+    payload = {
+        "loan": loan,
+        "user_name": user["name"],
+        "book_title": book["title"],
+        "current_fine": rc.calculate_fine(loan),
+    }
+    return JSONResponse(jsonable_encoder(payload)).body
+
+
+def default_search() -> bytes:
+    return JSONResponse(jsonable_encoder(rc.store.search_books())).body
+
+
+def fragment_user_loans() -> bytes:
+    return rc.get_user_loans(USER_ID, limit=None, cursor=None, output_format="json").body
+
+
+def fragment_loan() -> bytes:
+    return rc.get_loan(1).body
+
+
+def fragment_search() -> bytes:
+    return rc.search_books(
+        q="",
+        genre="",
+        author="",
+        limit=None,
+        cursor=None,
+        output_format="json",
+        mode="substring",
+        facets=None,
+        facet_limit=rc.FACET_DEFAULT_LIMIT,
+    ).body
+
+
+def time_per_call(func: Callable[[], bytes], repeat: int) -> float:
+    func()  # warm the fragment cache
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def run(n_loans: int, repeat: int) -> List[dict]:
+    populate(n_loans)
+    results = []
+    for endpoint, default, fragments in (
+        ("/users/{id}/loans", default_user_loans, fragment_user_loans),
+        ("/loans/{id}", default_loan, fragment_loan),
+        ("/books/search", default_search, fragment_search),
+    ):
+        baseline = time_per_call(default, repeat)
+        results.append(
+            {"endpoint": endpoint, "path": "jsonable_encoder", "us_per_call": baseline * 1e6}
+        )
+        for name in JSON_ENCODERS:
+            rc.encode_json = get_json_encoder(name)
+            rc.fragment_cache.clear()
+            elapsed = time_per_call(fragments, repeat)
+            results.append(
+                {
+                    "endpoint": endpoint,
+                    "path": f"fragments+{name}",
+                    "us_per_call": elapsed * 1e6,
+                    "speedup": baseline / elapsed,
+                }
+            )
+    for row in results:
+        row["us_per_call"] = round(row["us_per_call"], 1)
+        if "speedup" in row:
+            row["speedup"] = round(row["speedup"], 2)
+    return results
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--loans", type=int, default=200, help="loans of the benchmark user")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args(argv)
+    for row in run(args.loans, args.repeat):
+        print(json.dumps(row))
+
+
+if __name__ == "__main__":
+    main()
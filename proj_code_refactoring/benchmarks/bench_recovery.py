@@ -0,0 +1,172 @@
+"""
+Durability costs of the journaled in-memory store (journal.py).
+
+* commit    - small write transactions per second for each fsync policy.
+* load      - journaling --loans loans (plus books and users) through the
+              store's normal mutation methods.
+* recovery  - restart time from the journal alone, from a snapshot alone and
+              from a snapshot plus a journal tail of --tail mutations, with
+              the snapshot's size and the time taken to write it.
+
+Prints one JSON line per case. The data set of --loans loans has to fit in
+memory once (stores are closed and dropped before each restart).
+
+Run: python -m benchmarks.bench_recovery --loans 10000000 --books 100000
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.datasets import synthetic_library  # noqa: E402
+from journal import FSYNC_MODES, JournaledStore  # noqa: E402
+
+SEED = 42
+LOAN_BATCH = 10_000
+
+
+def bench_commit(directory: str, fsync: str, seconds: float) -> dict:
+    store = JournaledStore(os.path.join(directory, f"commit-{fsync}"), fsync=fsync)
+    store.insert_user(synthetic_library(1).users[0])
+    commits = 0
+    deadline = time.perf_counter() + seconds
+    start = time.perf_counter()
+    while time.perf_counter() < deadline:
+        with store.transaction():
+            store.adjust_balance(1, -0.5)
+            store.adjust_balance(1, +0.5)
+        commits += 1
+    elapsed = time.perf_counter() - start
+    store.close()
+    return {"case": "commit", "fsync": fsync, "commits_per_second": round(commits / elapsed)}
+
+
+def _loans(count: int, n_books: int, n_users: int):
+    rng = random.Random(SEED)
+    now = datetime.now()
+    for loan_id in range(1, count + 1):
+        issue = now - timedelta(days=rng.uniform(0, 60))
+        loan = {
+            "id": loan_id,
+            "user_id": rng.randint(1, n_users),
+            "book_id": rng.randint(1, n_books),
+            "issue_date": issue.isoformat(),
+            "due_date": (issue + timedelta(days=14)).isoformat(),
+            "status": "active",
+            "fine_applied": False,
+            "renewed": False,
+        }
+        if rng.random() < 0.7:
+            loan["status"] = "returned"
+            loan["return_date"] = (issue + timedelta(days=rng.uniform(1, 20))).isoformat()
+            loan["final_fine"] = 0.0
+        yield loan
+
+
+def load(directory: str, n_loans: int, n_books: int) -> dict:
+    books, users, _ = synthetic_library(n_books, SEED)
+    store = JournaledStore(directory, fsync="batch", snapshot_every=0)
+    start = time.perf_counter()
+    with store.transaction():
+        store.insert_books(books)
+        store.insert_users(users)
+        store.reserve_ids("book", len(books))
+        store.reserve_ids("user", len(users))
+    loans = _loans(n_loans, len(books), len(users))
+    while True:
+        batch = list(islice(loans, LOAN_BATCH))
+        if not batch:
+            break
+        with store.transaction():
+            for loan in batch:
+                store.insert_loan(loan)
+    store.reserve_ids("loan", n_loans)
+    store.close()
+    elapsed = time.perf_counter() - start
+    return {
+        "case": "load",
+        "loans": n_loans,
+        "books": n_books,
+        "seconds": round(elapsed, 2),
+        "journal_bytes": _size(directory, "journal-"),
+    }
+
+
+def _size(directory: str, prefix: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(directory, name))
+        for name in os.listdir(directory)
+        if name.startswith(prefix)
+    )
+
+
+def restart(directory: str, case: str, n_loans: int) -> JournaledStore:
+    gc.collect()
+    start = time.perf_counter()
+    store = JournaledStore(directory, snapshot_every=0)
+    elapsed = time.perf_counter() - start
+    assert len(store.loans) == n_loans, (len(store.loans), n_loans)
+    row = {"case": "recovery", "from": case, "loans": n_loans, "seconds": round(elapsed, 2)}
+    row.update(
+        snapshot_seconds=store.recovery["snapshot_seconds"],
+        journal_ops=store.recovery["ops"],
+        loans_per_second=round(n_loans / elapsed),
+    )
+    print(json.dumps(row), flush=True)
+    return store
+
+
+def run(directory: str, n_loans: int, n_books: int, tail: int) -> None:
+    print(json.dumps(load(directory, n_loans, n_books)), flush=True)
+
+    store = restart(directory, "journal", n_loans)
+    report = store.snapshot()
+    print(json.dumps({"case": "snapshot", **report}), flush=True)
+    store.close()
+    del store
+
+    store = restart(directory, "snapshot", n_loans)
+    rng = random.Random(SEED)
+    with store.transaction():
+        for _ in range(tail):
+            loan = store.get_loan(rng.randint(1, n_loans))
+            store.update_loan(loan, renewed=True)
+            store.adjust_balance(loan["user_id"], -0.5)
+    store.close()
+    del store
+
+    restart(directory, f"snapshot+{2 * tail}-op tail", n_loans).close()
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--loans", type=int, default=10_000_000)
+    parser.add_argument("--books", type=int, default=100_000)
+    parser.add_argument("--tail", type=int, default=100_000, help="loans touched after the snapshot")
+    parser.add_argument("--commit-seconds", type=float, default=2.0)
+    parser.add_argument("--dir", help="journal directory (default: a temporary one)")
+    args = parser.parse_args(argv)
+
+    directory = args.dir or tempfile.mkdtemp(prefix="library-journal-")
+    try:
+        for fsync in FSYNC_MODES:
+            print(json.dumps(bench_commit(directory, fsync, args.commit_seconds)), flush=True)
+        run(os.path.join(directory, "store"), args.loans, args.books, args.tail)
+    finally:
+        if not args.dir:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+Microbenchmarks for the library API helpers and handlers.
+
+For each dataset size (seeded, see benchmarks/datasets.py) the store is
+loaded once and every case is timed call by call in-process: calculate_fine,
+get_active_loans_for_user, search_books (selective / by genre / broad page,
+with facets, and ranked), get_statistics (computed, and revalidated via its
+ETag), get_popular_books, create_loan, return_book and create_loans_batch.
+Results are written as JSON so runs from different releases can be diffed;
+--baseline prints that diff directly.
+
+Run: python -m benchmarks.bench_suite --sizes 1000 100000 1000000 --output bench.json
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+# Books per create_loans_batch call, a typical kiosk checkout
+CHECKOUT_BATCH = 5
+
+
+def percentile(sorted_ns: List[int], fraction: float) -> float:
+    index = min(len(sorted_ns) - 1, int(round(fraction * (len(sorted_ns) - 1))))
+    return sorted_ns[index]
+
+
+def measure(
+    call: Callable[[], object], min_time: float, max_iterations: int, warmup: int = 3
+) -> List[int]:
+    """Per-call durations in ns; runs at least once and at most `max_iterations` times."""
+    for _ in range(warmup):
+        call()
+    samples = []
+    deadline = time.perf_counter() + min_time
+    clock = time.perf_counter_ns
+    while len(samples) < max_iterations:
+        start = clock()
+        call()
+        samples.append(clock() - start)
+        if time.perf_counter() >= deadline:
+            break
+    return samples
+
+
+def summarize(name: str, size: int, samples: List[int]) -> dict:
+    ordered = sorted(samples)
+    mean = sum(ordered) / len(ordered)
+    return {
+        "name": name,
+        "size": size,
+        "iterations": len(ordered),
+        "mean_us": round(mean / 1000, 3),
+        "p50_us": round(percentile(ordered, 0.50) / 1000, 3),
+        "p95_us": round(percentile(ordered, 0.95) / 1000, 3),
+        "p99_us": round(percentile(ordered, 0.99) / 1000, 3),
+        "min_us": round(ordered[0] / 1000, 3),
+        "ops_per_sec": round(1e9 / mean, 1),
+    }
+
+
+def run_size(rc, size: int, seed: int, min_time: float, max_iterations: int) -> List[dict]:
+    from starlette.requests import Request
+
+    from benchmarks.datasets import load, synthetic_library
+
+    rc.store.clear()
+    load(rc.store, synthetic_library(size, seed))
+    # Keep full collections from walking the loaded data set mid-sample; with a
+    # million records those pauses would swamp what is being measured.
+    gc.collect()
+    gc.freeze()
+
+    rng = random.Random(seed)
+    users = len(rc.store.users)
+    active_loans = rc.store.loans_for_user(rng.randint(1, users), "active") or [
+        rc.store.get_loan(1)
+    ]
+    now = datetime.now()
+
+    def random_user() -> int:
+        return rng.randint(1, users)
+
+    def statistics_request() -> Request:
+        return Request({"type": "http", "method": "GET", "path": "/statistics", "headers": []})
+
+    def statistics_computed():
+        rc.response_cache.clear()
+        return rc.get_statistics(statistics_request())
+
+    cached_request = statistics_request()
+    cached_request.scope["headers"] = [
+        (b"if-none-match", rc.get_statistics(statistics_request()).headers["etag"].encode())
+    ]
+
+    def search(q="", genre="", author="", limit=None, mode="substring", facets=None):
+        return lambda: rc.search_books(
+            q, genre, author, limit, None, "json", mode, facets, rc.FACET_DEFAULT_LIMIT
+        )
+
+    cases: Dict[str, Callable[[], object]] = {
+        "calculate_fine": lambda: rc.calculate_fine(active_loans[0], now),
+        "get_active_loans_for_user": lambda: rc.get_active_loans_for_user(random_user()),
+        "search_books[title]": search(q=f"river {rng.randint(1, size)}"),
+        "search_books[author+genre,page]": search(author="koval", genre="poetry", limit=50),
+        "search_books[broad,page]": search(q="a", limit=50),
+        "search_books[facets,page]": search(q="river", limit=50, facets="genre,author,year"),
+        "search_books[facets,genre]": search(genre="poetry", limit=50, facets="author,year"),
+        "search_books[ranked]": search(q="silent rivr", limit=20, mode="ranked"),
+        "search_books[ranked,genre]": search(
+            q="python machine", genre="poetry", limit=20, mode="ranked"
+        ),
+        "get_statistics[computed]": statistics_computed,
+        # 304 while the cached entry is valid; with many overdue loans some fine
+        # changes every few seconds, so large sizes mostly recompute here.
+        "get_statistics[revalidate]": lambda: rc.get_statistics(cached_request),
+        "get_popular_books[7d]": lambda: rc.get_popular_books("7d", 10, None),
+        "get_popular_books[30d,genre]": lambda: rc.get_popular_books("30d", 10, "poetry"),
+    }
+    results = []
+    for name, call in cases.items():
+        results.append(summarize(name, size, measure(call, min_time, max_iterations)))
+
+    results.extend(bench_checkout(rc, size, rng, min_time, max_iterations))
+    gc.unfreeze()
+    return results
+
+
+def bench_checkout(rc, size: int, rng: random.Random, min_time: float, max_iterations: int):
+    """
+    create_loan and return_book timed in pairs, then create_loans_batch, by
+    dedicated users with no history.
+    """
+    first_user = rc.store.reserve_ids("user", 50)
+    for user_id in range(first_user, first_user + 50):
+        rc.store.insert_user(
+            {
+                "id": user_id,
+                "name": f"Bench {user_id}",
+                "email": f"bench{user_id}@example.com",
+                "phone": "000",
+                "membership_type": "premium",
+                "balance": 0.0,
+                "active": True,
+                "registered_at": datetime.now().isoformat(),
+            }
+        )
+    create_ns: List[int] = []
+    return_ns: List[int] = []
+    clock = time.perf_counter_ns
+    deadline = time.perf_counter() + 2 * min_time
+    while len(create_ns) < max_iterations:
+        data = rc.LoanCreate(
+            user_id=rng.randint(first_user, first_user + 49), book_id=rng.randint(1, size)
+        )
+        start = clock()
+        loan = rc.create_loan(data)
+        middle = clock()
+        rc.return_book(loan["id"])
+        create_ns.append(middle - start)
+        return_ns.append(clock() - middle)
+        if time.perf_counter() >= deadline:
+            break
+
+    batch_ns: List[int] = []
+    deadline = time.perf_counter() + 2 * min_time
+    while len(batch_ns) < max_iterations:
+        data = rc.LoanBatchCreate(
+            user_id=rng.randint(first_user, first_user + 49),
+            book_ids=[rng.randint(1, size) for _ in range(CHECKOUT_BATCH)],
+        )
+        start = clock()
+        created = rc.create_loans_batch(data)
+        batch_ns.append(clock() - start)
+        for result in created["results"]:
+            rc.return_book(result["loan"]["id"])
+        if time.perf_counter() >= deadline:
+            break
+    return [
+        summarize("create_loan", size, create_ns),
+        summarize("return_book", size, return_ns),
+        summarize(f"create_loans_batch[{CHECKOUT_BATCH}]", size, batch_ns),
+    ]
+
+
+def metadata(storage: str, seed: int) -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=PROJECT_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "storage": storage,
+        "seed": seed,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[str]:
+    """Human-readable p50 diff per (name, size); regressions over `threshold` are flagged."""
+    previous = {(row["name"], row["size"]): row for row in baseline["results"]}
+    lines = [f"{'case':<36} {'size':>8} {'base p50':>10} {'p50':>10} {'change':>8}"]
+    for row in current["results"]:
+        old = previous.get((row["name"], row["size"]))
+        if old is None:
+            continue
+        change = row["p50_us"] / old["p50_us"] - 1 if old["p50_us"] else 0.0
+        flag = "  REGRESSION" if change > threshold else ""
+        lines.append(
+            f"{row['name']:<36} {row['size']:>8} {old['p50_us']:>10.1f} "
+            f"{row['p50_us']:>10.1f} {change:>+8.1%}{flag}"
+        )
+    return lines
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 100_000, 1_000_000])
+    parser.add_argument("--storage", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--db", default=None, help="SQLite file (default: a temporary one)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds per case")
+    parser.add_argument("--max-iterations", type=int, default=100_000)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    parser.add_argument("--baseline", help="earlier JSON output to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="p50 slowdown to flag")
+    args = parser.parse_args(argv)
+
+    os.environ["LIBRARY_STORAGE"] = args.storage
+    if args.storage == "sqlite":
+        import tempfile
+
+        path = args.db or os.path.join(tempfile.mkdtemp(), "bench.db")
+        os.environ["LIBRARY_SQLITE_PATH"] = path
+    import refactored_code as rc
+
+    rc.logger.setLevel(logging.WARNING)  # per-loan INFO lines would dominate create_loan
+
+    report = {"suite": "library-api-micro", "meta": metadata(args.storage, args.seed), "results": []}
+    for size in args.sizes:
+        report["results"].extend(run_size(rc, size, args.seed, args.min_time, args.max_iterations))
+        print(f"size {size}: done", file=sys.stderr, flush=True)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as out:
+            out.write(text + "\n")
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as base:
+            for line in compare(json.load(base), report, args.threshold):
+                print(line, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Throughput scaling of the library API across uvicorn worker processes.
+
+For each worker count the API is started via serve.py on a fresh shared SQLite
+file, seeded with books and users, and then driven by several client processes
+issuing a read-heavy mix (search, book/user/statistics reads, checkout + return)
+for a fixed duration. Prints one JSON object per worker count plus a summary.
+
+Run: python -m benchmarks.bench_workers --workers 1 2 4 --clients 16 --duration 10
+"""
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _request(conn: http.client.HTTPConnection, method: str, path: str, body=None) -> int:
+    payload = json.dumps(body).encode() if body is not None else None
+    headers = {"Content-Type": "application/json"} if payload else {}
+    conn.request(method, path, body=payload, headers=headers)
+    response = conn.getresponse()
+    response.read()
+    return response.status
+
+
+def _wait_until_ready(port: int, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            if _request(conn, "GET", "/statistics") == 200:
+                conn.close()
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"API on port {port} did not start")
+
+
+def seed(port: int, n_books: int, n_users: int) -> None:
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    for i in range(n_books):
+        _request(
+            conn,
+            "POST",
+            "/books",
+            {
+                "title": f"Book {i} volume {i % 97}",
+                "author": f"Author {i % 500}",
+                "isbn": str(i),
+                "genre": ("fiction", "science", "history", "tech")[i % 4],
+                "year": 1950 + i % 70,
+                "copies": 1000,
+                "available_copies": 1000,
+            },
+        )
+    for i in range(n_users):
+        _request(
+            conn,
+            "POST",
+            "/users",
+            {
+                "name": f"User {i}",
+                "email": f"user{i}@example.com",
+                "phone": str(i),
+                "membership_type": "premium",
+            },
+        )
+    conn.close()
+
+
+def _client(args) -> Dict[str, int]:
+    port, duration, n_books, n_users, write_ratio, seed_value = args
+    rng = random.Random(seed_value)
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    done = errors = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        roll = rng.random()
+        if roll < write_ratio:
+            user_id = rng.randint(1, n_users)
+            status = _request(
+                conn, "POST", "/loans", {"user_id": user_id, "book_id": rng.randint(1, n_books)}
+            )
+            if status == 400:  # loan limit reached: return one of the user's loans
+                status = 200
+                _request(conn, "GET", f"/users/{user_id}/loans")
+        elif roll < 0.5:
+            status = _request(conn, "GET", f"/books/{rng.randint(1, n_books)}")
+        elif roll < 0.75:
+            status = _request(conn, "GET", f"/users/{rng.randint(1, n_users)}")
+        elif roll < 0.95:
+            status = _request(conn, "GET", f"/books/search?q=volume%20{rng.randint(0, 96)}")
+        else:
+            status = _request(conn, "GET", "/statistics")
+        done += 1
+        errors += status >= 500
+    conn.close()
+    return {"requests": done, "errors": errors}
+
+
+def run_one(workers: int, clients: int, duration: float, n_books: int, n_users: int,
+            write_ratio: float) -> Dict[str, float]:
+    port = _free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        server = subprocess.Popen(
+            [
+                sys.executable, "serve.py",
+                "--workers", str(workers),
+                "--port", str(port),
+                "--storage", "sqlite",
+                "--db", os.path.join(tmp, "library.db"),
+            ],
+            cwd=PROJECT_DIR,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            _wait_until_ready(port)
+            seed(port, n_books, n_users)
+            jobs = [(port, duration, n_books, n_users, write_ratio, i) for i in range(clients)]
+            with multiprocessing.Pool(clients) as pool:
+                results = pool.map(_client, jobs)
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+    total = sum(r["requests"] for r in results)
+    return {
+        "workers": workers,
+        "clients": clients,
+        "duration_s": duration,
+        "requests": total,
+        "errors": sum(r["errors"] for r in results),
+        "requests_per_s": round(total / duration, 1),
+    }
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--books", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--write-ratio", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    rows = []
+    for workers in args.workers:
+        row = run_one(workers, args.clients, args.duration, args.books, args.users, args.write_ratio)
+        rows.append(row)
+        print(json.dumps(row), flush=True)
+
+    baseline = rows[0]["requests_per_s"] or 1.0
+    print("\nworkers  req/s     speedup")
+    for row in rows:
+        print(f"{row['workers']:>7}  {row['requests_per_s']:>8.1f}  {row['requests_per_s'] / baseline:>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
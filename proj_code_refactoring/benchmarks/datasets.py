@@ -0,0 +1,94 @@
+"""
+Seeded synthetic library data for the benchmarks.
+The same (size, seed) always produces the same books, users and loans, so
+numbers from different runs and releases describe the same workload.
+"""
+
+import random
+from datetime import datetime, timedelta
+from typing import List, NamedTuple
+
+GENRES = ("fiction", "science", "history", "tech", "poetry", "travel", "art", "children")
+_TITLE_WORDS = (
+    "silent", "river", "garden", "empire", "code", "shadow", "winter", "atlas",
+    "python", "storm", "glass", "harbor", "machine", "secret", "golden", "night",
+)
+_AUTHOR_FIRST = ("Anna", "Ivan", "Maria", "Taras", "Olena", "Petro", "Sofia", "Mark")
+_AUTHOR_LAST = ("Shevchenko", "Koval", "Bondar", "Melnyk", "Tkachenko", "Kravets")
+MEMBERSHIPS = ("basic", "premium", "student")
+
+
+class Library(NamedTuple):
+    books: List[dict]
+    users: List[dict]
+    loans: List[dict]
+
+
+def synthetic_library(size: int, seed: int = 42, now: datetime = None) -> Library:
+    """
+    `size` books and `size` loans (about 30% active, some overdue) spread over
+    size // 10 users. Every book keeps spare copies so checkouts succeed.
+    """
+    rng = random.Random(seed)
+    now = now or datetime.now()
+    books = []
+    for book_id in range(1, size + 1):
+        words = rng.sample(_TITLE_WORDS, 2)
+        books.append(
+            {
+                "id": book_id,
+                "title": f"{words[0].title()} {words[1]} {book_id}",
+                "author": f"{rng.choice(_AUTHOR_FIRST)} {rng.choice(_AUTHOR_LAST)}",
+                "isbn": f"978-{book_id:010d}",
+                "genre": rng.choice(GENRES),
+                "year": rng.randint(1900, 2024),
+                "copies": 5,
+                "available_copies": 5,
+            }
+        )
+
+    users = [
+        {
+            "id": user_id,
+            "name": f"User {user_id}",
+            "email": f"user{user_id}@example.com",
+            "phone": f"+380{user_id:09d}",
+            "membership_type": MEMBERSHIPS[user_id % 3],
+            "balance": 0.0,
+            "active": True,
+            "registered_at": (now - timedelta(days=rng.randint(0, 1000))).isoformat(),
+        }
+        for user_id in range(1, max(10, size // 10) + 1)
+    ]
+
+    loans = []
+    for loan_id in range(1, size + 1):
+        issue = now - timedelta(days=rng.uniform(0, 60))
+        active = rng.random() < 0.3
+        loan = {
+            "id": loan_id,
+            "user_id": rng.randint(1, len(users)),
+            "book_id": rng.randint(1, size),
+            "issue_date": issue.isoformat(),
+            "due_date": (issue + timedelta(days=14)).isoformat(),
+            "status": "active" if active else "returned",
+            "fine_applied": False,
+            "renewed": False,
+        }
+        if not active:
+            loan["return_date"] = (issue + timedelta(days=rng.uniform(1, 20))).isoformat()
+            loan["final_fine"] = 0.0
+        loans.append(loan)
+    return Library(books, users, loans)
+
+
+def load(store, library: Library) -> None:
+    """Bulk-loads `library` into an empty store and advances its id counters."""
+    with store.transaction():
+        store.insert_books(library.books)
+        store.insert_users(library.users)
+        for loan in library.loans:
+            store.insert_loan(loan)
+        store.reserve_ids("book", len(library.books))
+        store.reserve_ids("user", len(library.users))
+        store.reserve_ids("loan", len(library.loans))
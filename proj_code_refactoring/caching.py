@@ -0,0 +1,167 @@
+"""
+Library Management System - Response Caching
+In-process caches of encoded JSON for the hot read endpoints:
+
+* ResponseCache - whole responses keyed by (route, id, version).
+* FragmentCache - the JSON of single books/users/loans, spliced into larger
+                  responses without going through jsonable_encoder again.
+
+Versions come from the store's change counters (LibraryStore.version), so a
+mutation never has to find and evict stale entries: it makes them unreachable
+(or mismatched), and the LRU bounds drop them later.
+"""
+
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, NamedTuple, Optional, Tuple
+import json
+import threading
+
+try:
+    import orjson
+except ImportError:  # optional speed-up, see get_json_encoder
+    orjson = None
+
+
+class CachedResponse(NamedTuple):
+    etag: str
+    body: bytes
+    # Payloads that depend on the clock (e.g. accrued fines) stop being valid
+    # at this naive timestamp; version-only payloads use infinity.
+    expires_ts: float = float("inf")
+
+
+class ResponseCache:
+    """Thread-safe LRU of CachedResponse entries."""
+
+    def __init__(self, max_entries: int = 4096) -> None:
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, CachedResponse]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, now_ts: float = 0.0) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now_ts >= entry.expires_ts:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: Hashable, entry: CachedResponse) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match comparison (RFC 9110 13.1.2: weak comparison, "*" matches)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+# --- JSON Encoding ---
+
+
+def _encode_stdlib(payload) -> bytes:
+    """Same bytes FastAPI's default JSONResponse would produce."""
+    return json.dumps(
+        payload, default=dict, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def _encode_orjson(payload) -> bytes:
+    return orjson.dumps(payload, default=dict)
+
+
+JSON_ENCODERS: Dict[str, Callable[[object], bytes]] = {"json": _encode_stdlib}
+if orjson is not None:
+    JSON_ENCODERS["orjson"] = _encode_orjson
+
+
+def get_json_encoder(name: Optional[str] = None) -> Callable[[object], bytes]:
+    """
+    Encoder by name ("json" or "orjson"); by default orjson when installed.
+    Both accept the compact store records (mappings) via `default=dict`.
+    """
+    if name is None:
+        return JSON_ENCODERS.get("orjson", _encode_stdlib)
+    try:
+        return JSON_ENCODERS[name]
+    except KeyError:
+        raise ValueError(f"unknown or unavailable JSON encoder: {name!r}") from None
+
+
+# --- Fragments ---
+
+
+class FragmentCache:
+    """
+    Thread-safe LRU of encoded records keyed by (kind, id). Each entry
+    remembers the record version it was encoded at; a newer version replaces
+    it, so there is at most one entry per record. Callers must encode a record
+    read after its version, never before, or stale bytes could be filed
+    under a newer version.
+    """
+
+    def __init__(self, max_entries: int = 100_000) -> None:
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, int], Tuple[int, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, kind: str, record_id: int, version: int) -> Optional[bytes]:
+        key = (kind, record_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, kind: str, record_id: int, version: int, fragment: bytes) -> None:
+        if self.max_entries <= 0:
+            return
+        key = (kind, record_id)
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and current[0] > version:
+                return  # a concurrent request already cached something newer
+            self._entries[key] = (version, fragment)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
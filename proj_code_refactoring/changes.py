@@ -0,0 +1,138 @@
+"""
+Library Management System - Change Feed
+A sequenced log of library mutations for downstream consumers (reporting,
+notifications) that would otherwise poll /statistics and per-user endpoints.
+
+Every committed mutation becomes one change: {"seq", "ts", "entity", "id",
+"op"} plus the ids of related records (a loan carries user_id and book_id).
+Changes name what changed rather than carrying record bodies, so a consumer
+re-reads the records it cares about. The app publishes a transaction's
+changes after it commits, and drops them if the store rolled it back.
+
+The most recent `capacity` changes are kept in a ring buffer. A consumer
+that falls further behind than that, or whose cursor comes from another
+process or an earlier run (the feed's epoch differs), gets ChangesExpired and
+should resynchronize from the regular endpoints. Each worker process keeps its
+own feed.
+"""
+
+from collections import deque
+from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+import asyncio
+import threading
+import uuid
+
+DEFAULT_CAPACITY = 10_000
+
+
+class Change(NamedTuple):
+    seq: int
+    ts: str
+    entity: str
+    id: int
+    op: str
+    refs: Dict[str, int]
+
+    def to_dict(self) -> dict:
+        return {
+            "seq": self.seq,
+            "ts": self.ts,
+            "entity": self.entity,
+            "id": self.id,
+            "op": self.op,
+            **self.refs,
+        }
+
+
+# (entity, id, op, refs) as recorded by a request, before it is sequenced
+PendingChange = Tuple[str, int, str, Dict[str, int]]
+
+
+class ChangesExpired(Exception):
+    """The requested position is no longer (or was never) in this feed."""
+
+    def __init__(self, since: int, oldest_seq: int, last_seq: int) -> None:
+        super().__init__(f"Changes after {since} are not available")
+        self.since = since
+        self.oldest_seq = oldest_seq
+        self.last_seq = last_seq
+
+
+class ChangeFeed:
+    """
+    Thread-safe ring buffer of sequenced changes. Writers publish from
+    threadpool threads; readers may wait for new changes on an event loop.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY) -> None:
+        self.capacity = capacity
+        self.epoch = uuid.uuid4().hex[:12]
+        self.last_seq = 0
+        self._changes: "deque[Change]" = deque(maxlen=max(capacity, 1))
+        self._lock = threading.Lock()
+        # future -> its event loop, completed on the next publish
+        self._waiters: Dict[asyncio.Future, asyncio.AbstractEventLoop] = {}
+
+    @property
+    def oldest_seq(self) -> int:
+        """Sequence number of the oldest change still held (last_seq + 1 when empty)."""
+        with self._lock:
+            return self._changes[0].seq if self._changes else self.last_seq + 1
+
+    def publish(self, changes: Iterable[PendingChange]) -> int:
+        """Sequences and stores `changes`; returns the new last_seq."""
+        ts = datetime.now().isoformat()
+        with self._lock:
+            seq = self.last_seq
+            for entity, record_id, op, refs in changes:
+                seq += 1
+                self._changes.append(Change(seq, ts, entity, record_id, op, refs))
+            if seq == self.last_seq:
+                return seq
+            self.last_seq = seq
+            waiters, self._waiters = self._waiters, {}
+        for waiter, loop in waiters.items():
+            loop.call_soon_threadsafe(_wake, waiter)
+        return seq
+
+    def read(self, since: int, limit: int) -> List[Change]:
+        """
+        Up to `limit` changes with seq > `since`, oldest first. Raises
+        ChangesExpired if some of them were evicted or `since` is from the future.
+        """
+        with self._lock:
+            oldest = self._changes[0].seq if self._changes else self.last_seq + 1
+            if since > self.last_seq or since + 1 < oldest:
+                raise ChangesExpired(since, oldest, self.last_seq)
+            start = since + 1 - oldest
+            stop = min(start + limit, len(self._changes))
+            return [self._changes[index] for index in range(start, stop)]
+
+    async def wait(self, since: int, timeout: float) -> bool:
+        """Waits until there are changes after `since`; False on timeout."""
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        with self._lock:
+            if self.last_seq > since:
+                return True
+            self._waiters[waiter] = loop
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                self._waiters.pop(waiter, None)
+
+
+def _wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def format_sse(event: str, data: str, event_id: Optional[str] = None) -> bytes:
+    """One Server-Sent Events message; `data` must be a single line (e.g. JSON)."""
+    head = "" if event_id is None else f"id: {event_id}\n"
+    return f"{head}event: {event}\ndata: {data}\n\n".encode()
@@ -0,0 +1,143 @@
+"""
+Library Management System - Batch Fine Job
+Applies overdue fines for every user in one sweep instead of lazily when a
+user next borrows (see refactored_code.apply_pending_fines, whose semantics
+this keeps: an active loan is charged its current fine once, the first time
+that fine is positive, and is then flagged fine_applied).
+
+Fines for all candidate loans are computed in one vectorized pass over their
+due timestamps. NumPy is used when installed; otherwise a pure Python loop
+gives the same results.
+
+Run: python fines.py --db library.db
+"""
+
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # optional, see compute_fines
+    np = None
+
+from storage import LibraryStore, SECONDS_PER_DAY, to_timestamp
+
+# Fine per overdue day. Kept here rather than in refactored_code so the batch
+# job can run without importing the app (and opening its configured store).
+FINE_PER_DAY = 0.5
+# Loans marked and users charged per store transaction
+APPLY_BATCH_SIZE = 10_000
+
+
+def compute_fines(
+    due_ts: Sequence[float], now_ts: float, fine_per_day: float, use_numpy: Optional[bool] = None
+):
+    """
+    Fine for each due timestamp as of `now_ts`, matching refactored_code.fine_for_due.
+    Returns a float64 array with NumPy, a list otherwise.
+    """
+    if use_numpy is None:
+        use_numpy = np is not None
+    if use_numpy:
+        due = np.asarray(due_ts, dtype=np.float64)
+        days_overdue = np.floor_divide(now_ts - due, SECONDS_PER_DAY)
+        return np.round(np.maximum(days_overdue, 0.0) * fine_per_day, 2)
+    return [
+        round(int((now_ts - due) // SECONDS_PER_DAY) * fine_per_day, 2) if now_ts > due else 0.0
+        for due in due_ts
+    ]
+
+
+def apply_overdue_fines(
+    store: LibraryStore,
+    fine_per_day: float,
+    now: Optional[datetime] = None,
+    batch_size: int = APPLY_BATCH_SIZE,
+    use_numpy: Optional[bool] = None,
+    on_charged: Optional[Callable[[List[Tuple[int, int, int]]], None]] = None,
+) -> dict:
+    """
+    Charges every unapplied positive fine on active loans and flags the loans.
+    Candidates are read once; each batch is applied in its own transaction and
+    only charges loans the store could still flag, so loans returned or fined
+    concurrently are left alone. `on_charged` gets each batch's charged
+    (loan_id, user_id, book_id) triples once the batch is committed.
+    """
+    vectorized = np is not None if use_numpy is None else use_numpy
+    started = time.perf_counter()
+    now_ts = to_timestamp(now or datetime.now())
+    loan_ids, _, due_ts = store.fine_candidates(now_ts)
+    fines = compute_fines(due_ts, now_ts, fine_per_day, vectorized)
+
+    if vectorized:
+        positive = np.flatnonzero(fines > 0)
+        due_loans = np.asarray(loan_ids, dtype=np.int64)[positive].tolist()
+        due_fines = fines[positive].tolist()
+    else:
+        due_loans = [loan_id for loan_id, fine in zip(loan_ids, fines) if fine > 0]
+        due_fines = [fine for fine in fines if fine > 0]
+    computed = time.perf_counter()
+
+    fine_by_loan = dict(zip(due_loans, due_fines))
+    charged_loans = 0
+    charged_users: Dict[int, float] = {}
+    for start in range(0, len(due_loans), batch_size):
+        with store.transaction():
+            marked = store.mark_fines_applied(due_loans[start : start + batch_size])
+            batch_totals: Dict[int, float] = {}
+            for loan_id, user_id, _ in marked:
+                batch_totals[user_id] = batch_totals.get(user_id, 0.0) + fine_by_loan[loan_id]
+            for user_id, total in batch_totals.items():
+                store.adjust_balance(user_id, -total)
+        charged_loans += len(marked)
+        if on_charged is not None and marked:
+            on_charged(marked)
+        for user_id, total in batch_totals.items():
+            charged_users[user_id] = charged_users.get(user_id, 0.0) + total
+    finished = time.perf_counter()
+
+    return {
+        "candidates": len(loan_ids),
+        "charged_loans": charged_loans,
+        "charged_users": len(charged_users),
+        "total_charged": round(sum(charged_users.values()), 2),
+        "vectorized": vectorized,
+        "compute_seconds": round(computed - started, 6),
+        "total_seconds": round(finished - started, 6),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Apply overdue fines for all users")
+    parser.add_argument(
+        "--db",
+        default=os.environ.get("LIBRARY_SQLITE_PATH", "library.db"),
+        help="SQLite file the API workers use",
+    )
+    parser.add_argument("--fine-per-day", type=float, default=FINE_PER_DAY)
+    parser.add_argument("--batch-size", type=int, default=APPLY_BATCH_SIZE)
+    parser.add_argument("--no-numpy", action="store_true", help="force the pure Python path")
+    args = parser.parse_args(argv)
+
+    # An in-memory store lives inside the API process; use POST /admin/fines/apply there.
+    from storage import SQLiteStore
+
+    store = SQLiteStore(os.path.abspath(args.db))
+    try:
+        report = apply_overdue_fines(
+            store,
+            args.fine_per_day,
+            batch_size=args.batch_size,
+            use_numpy=False if args.no_numpy else None,
+        )
+    finally:
+        store.close()
+    print(json.dumps(report))
+
+
+if __name__ == "__main__":
+    main()
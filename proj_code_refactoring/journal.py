@@ -0,0 +1,503 @@
+"""
+Library Management System - Durable In-Memory Store
+JournaledStore keeps InMemoryStore's dict speed and adds durability without
+a database: every mutation is appended to a write-ahead journal, and
+periodic snapshots bound how much of the journal a restart has to replay.
+
+* Journal   - segment files of CRC-checked frames, one frame per store
+              transaction (or per mutation made outside one). fsync policy:
+              "always" (before the commit returns), "batch" (group commit
+              every flush interval, the default) or "none" (left to the OS).
+* Snapshots - the whole store in one compact binary file: loans as typed
+              columns, the other records as tuples and dicts.
+* Recovery  - the newest snapshot, then every journal segment written after
+              it. A torn frame at the end of a segment (a crash mid-write)
+              ends that segment's replay.
+
+Snapshot N holds the state before journal segment N, so once it is written
+the older snapshots and segments are deleted. Frames and snapshots are
+pickles: the directory must be as trusted as the process itself.
+
+Use it with LIBRARY_STORAGE=memory and LIBRARY_JOURNAL_DIR=<directory>
+(see storage.create_store).
+"""
+
+from array import array
+from contextlib import contextmanager
+from operator import attrgetter
+from typing import Iterator, List, Optional, Tuple
+import logging
+import math
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+from storage import BookRecord, InMemoryStore, LoanRecord
+
+logger = logging.getLogger(__name__)
+
+FSYNC_MODES = ("always", "batch", "none")
+FRAME_HEADER = struct.Struct("<II")  # payload length, CRC32 of the payload
+SNAPSHOT_MAGIC = b"LIBSNAP1"
+JOURNAL_PREFIX, JOURNAL_SUFFIX = "journal-", ".log"
+SNAPSHOT_PREFIX, SNAPSHOT_SUFFIX = "snapshot-", ".bin"
+
+_book_values = attrgetter(*BookRecord.__slots__)
+_loan_values = attrgetter(*LoanRecord.__slots__)
+# array typecode per LoanRecord slot; NaN stands for None in the float columns
+_LOAN_COLUMNS = {
+    "id": "q", "user_id": "q", "book_id": "q", "issue_ts": "d", "due_ts": "d",
+    "status_code": "b", "fine_applied": "b", "renewed": "b", "return_ts": "d", "final_fine": "d",
+}
+
+
+def _file_name(prefix: str, seq: int, suffix: str) -> str:
+    return f"{prefix}{seq:012d}{suffix}"
+
+
+def _numbered_files(directory: str, prefix: str, suffix: str) -> List[Tuple[int, str]]:
+    """(sequence number, path) of matching files, in sequence order."""
+    found = []
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and name.endswith(suffix):
+            number = name[len(prefix) : -len(suffix)]
+            if number.isdigit():
+                found.append((int(number), os.path.join(directory, name)))
+    return sorted(found)
+
+
+def _fsync_directory(directory: str) -> None:
+    """Makes file creations and renames in `directory` durable (no-op where unsupported)."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# --- Journal ---
+
+
+class Journal:
+    """
+    Appends frames to the current segment file. Commits only queue their
+    frame; it is written (and synced, per the fsync policy) by the committing
+    thread in "always" mode, and by a background flusher every
+    `flush_interval` seconds otherwise, so concurrent commits share one fsync.
+    """
+
+    def __init__(
+        self, directory: str, segment: int, fsync: str = "batch", flush_interval: float = 0.05
+    ) -> None:
+        if fsync not in FSYNC_MODES:
+            raise ValueError(f"Unknown journal fsync mode: {fsync}")
+        self.directory = directory
+        self.segment = segment
+        self.fsync = fsync
+        self.flush_interval = flush_interval
+        self._pending: List[bytes] = []
+        self._pending_lock = threading.Lock()
+        self._io_lock = threading.Lock()  # the file, its rotation and fsyncs
+        self._file = self._open(segment)
+        self._stop = threading.Event()
+        self._flusher = None
+        if fsync != "always":
+            self._flusher = threading.Thread(
+                target=self._flush_forever, name="journal-flusher", daemon=True
+            )
+            self._flusher.start()
+
+    def _open(self, segment: int):
+        path = os.path.join(self.directory, _file_name(JOURNAL_PREFIX, segment, JOURNAL_SUFFIX))
+        handle = open(path, "ab")
+        _fsync_directory(self.directory)
+        return handle
+
+    def append(self, payload: bytes) -> None:
+        frame = FRAME_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._pending_lock:
+            self._pending.append(frame)
+        if self.fsync == "always":
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes queued frames; fsyncs them unless the policy is "none"."""
+        with self._io_lock:
+            self._write_pending()
+
+    def _write_pending(self) -> None:
+        with self._pending_lock:
+            frames, self._pending = self._pending, []
+        if not frames:
+            return
+        self._file.write(b"".join(frames))
+        self._file.flush()
+        if self.fsync != "none":
+            os.fsync(self._file.fileno())
+
+    def _flush_forever(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError:
+                logger.exception("Journal flush failed")
+
+    def rotate(self) -> int:
+        """Closes the current segment (with everything queued) and starts the next one."""
+        with self._io_lock:
+            self._write_pending()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self.segment += 1
+            self._file = self._open(self.segment)
+            return self.segment
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        with self._io_lock:
+            if self._file.closed:
+                return
+            self._write_pending()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+
+def read_frames(path: str) -> Iterator[bytes]:
+    """Payloads of one segment, stopping at the first truncated or corrupt frame."""
+    with open(path, "rb") as source:
+        while True:
+            header = source.read(FRAME_HEADER.size)
+            if not header:
+                return
+            if len(header) == FRAME_HEADER.size:
+                length, crc = FRAME_HEADER.unpack(header)
+                payload = source.read(length)
+                if len(payload) == length and zlib.crc32(payload) == crc:
+                    yield payload
+                    continue
+            logger.warning("Ignoring torn journal tail in %s at byte %d", path, source.tell())
+            return
+
+
+# --- Snapshots ---
+
+
+def _none_to_nan(value) -> float:
+    return math.nan if value is None else value
+
+
+def _nan_to_none(value: float) -> Optional[float]:
+    return None if value != value else value
+
+
+def write_snapshot(directory: str, segment: int, state: dict) -> Tuple[str, int]:
+    """Writes `state` as snapshot `segment` atomically; returns its path and size."""
+    path = os.path.join(directory, _file_name(SNAPSHOT_PREFIX, segment, SNAPSHOT_SUFFIX))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as out:
+        out.write(SNAPSHOT_MAGIC)
+        pickle.dump(state, out, protocol=pickle.HIGHEST_PROTOCOL)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, path)
+    _fsync_directory(directory)
+    return path, os.path.getsize(path)
+
+
+def read_snapshot(path: str) -> dict:
+    with open(path, "rb") as source:
+        if source.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a library snapshot")
+        return pickle.load(source)
+
+
+# --- Store ---
+
+
+class JournaledStore(InMemoryStore):
+    """
+    InMemoryStore whose mutations are journaled; the constructor recovers the
+    state found in `directory`. Every `snapshot_every` journaled mutations a
+    snapshot is taken in the background (0 disables that; see snapshot()).
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        fsync: str = "batch",
+        flush_interval: float = 0.05,
+        snapshot_every: int = 1_000_000,
+    ) -> None:
+        super().__init__()
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.snapshot_every = snapshot_every
+        self._ops: List[tuple] = []  # mutations of the open transaction
+        self._depth = 0
+        self._ops_since_snapshot = 0
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_thread: Optional[threading.Thread] = None
+        self._replaying = True
+        self.recovery = self._recover()
+        self._replaying = False
+        self.journal = Journal(self.directory, self.recovery["next_segment"], fsync, flush_interval)
+
+    # Journaling
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                # Memory is not rolled back on errors, so neither is the journal.
+                self._depth -= 1
+                if self._depth == 0 and self._ops:
+                    self._commit()
+
+    def _log(self, op: tuple) -> None:
+        if self._replaying:
+            return
+        with self._lock:
+            self._ops.append(op)
+            if self._depth == 0:
+                self._commit()
+
+    def _commit(self) -> None:
+        ops, self._ops = self._ops, []
+        payload = pickle.dumps((self.version("store"), ops), protocol=pickle.HIGHEST_PROTOCOL)
+        self.journal.append(payload)
+        self._ops_since_snapshot += len(ops)
+        if 0 < self.snapshot_every <= self._ops_since_snapshot and not self._snapshot_running():
+            self._ops_since_snapshot = 0
+            self._snapshot_thread = threading.Thread(
+                target=self._snapshot_in_background, name="store-snapshot", daemon=True
+            )
+            self._snapshot_thread.start()
+
+    def reserve_ids(self, kind: str, count: int) -> int:
+        with self._lock:
+            first = super().reserve_ids(kind, count)
+            self._log(("ids", kind, count))
+            return first
+
+    def clear(self) -> None:
+        with self._lock:
+            super().clear()
+            self._log(("clear",))
+
+    def insert_book(self, book: dict) -> None:
+        super().insert_book(book)
+        self._log(("book", _book_values(self.books[book["id"]])))
+
+    def adjust_available_copies(self, book_id: int, delta: int) -> None:
+        super().adjust_available_copies(book_id, delta)
+        self._log(("copies", book_id, delta))
+
+    def insert_user(self, user: dict) -> None:
+        super().insert_user(user)
+        self._log(("user", dict(user)))
+
+    def update_user(self, user: dict, **fields) -> None:
+        super().update_user(user, **fields)
+        self._log(("user_fields", user["id"], fields))
+
+    def adjust_balance(self, user_id: int, delta: float) -> None:
+        super().adjust_balance(user_id, delta)
+        self._log(("balance", user_id, delta))
+
+    def insert_loan(self, loan: dict) -> None:
+        super().insert_loan(loan)
+        self._log(("loan", _loan_values(self.loans[loan["id"]])))
+
+    def update_loan(self, loan: dict, **fields) -> None:
+        super().update_loan(loan, **fields)
+        self._log(("loan_fields", loan["id"], fields))
+
+    def mark_fines_applied(self, loan_ids: List[int]) -> List[Tuple[int, int, int]]:
+        marked = super().mark_fines_applied(loan_ids)
+        if marked:
+            self._log(("fines", [loan_id for loan_id, _, _ in marked]))
+        return marked
+
+    def insert_reservation(self, reservation: dict) -> None:
+        super().insert_reservation(reservation)
+        self._log(("reservation", dict(reservation)))
+
+    def update_reservation(self, reservation: dict, **fields) -> None:
+        super().update_reservation(reservation, **fields)
+        self._log(("reservation_fields", reservation["id"], fields))
+
+    # Recovery
+
+    def _apply(self, op: tuple) -> None:
+        kind, args = op[0], op[1:]
+        if kind == "loan":
+            self._index_loan(LoanRecord(*args[0]))
+        elif kind == "loan_fields":
+            InMemoryStore.update_loan(self, self.loans[args[0]], **args[1])
+        elif kind == "balance":
+            InMemoryStore.adjust_balance(self, *args)
+        elif kind == "copies":
+            InMemoryStore.adjust_available_copies(self, *args)
+        elif kind == "fines":
+            InMemoryStore.mark_fines_applied(self, args[0])
+        elif kind == "book":
+            self._index_book(BookRecord(*args[0]))
+        elif kind == "user":
+            InMemoryStore.insert_user(self, args[0])
+        elif kind == "user_fields":
+            InMemoryStore.update_user(self, self.users[args[0]], **args[1])
+        elif kind == "reservation":
+            InMemoryStore.insert_reservation(self, args[0])
+        elif kind == "reservation_fields":
+            InMemoryStore.update_reservation(self, self.reservations[args[0]], **args[1])
+        elif kind == "ids":
+            InMemoryStore.reserve_ids(self, *args)
+        elif kind == "clear":
+            InMemoryStore.clear(self)
+        else:
+            raise ValueError(f"Unknown journal entry: {kind}")
+
+    def _recover(self) -> dict:
+        started = time.perf_counter()
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):  # a snapshot interrupted mid-write
+                os.remove(os.path.join(self.directory, name))
+        snapshots = _numbered_files(self.directory, SNAPSHOT_PREFIX, SNAPSHOT_SUFFIX)
+        segments = _numbered_files(self.directory, JOURNAL_PREFIX, JOURNAL_SUFFIX)
+
+        snapshot_segment, last_version = 0, None
+        if snapshots:
+            snapshot_segment, path = snapshots[-1]
+            state = read_snapshot(path)
+            self._restore(state)
+            last_version = state["store_version"]
+        loaded = time.perf_counter()
+
+        frames = ops = 0
+        for segment, path in segments:
+            if segment < snapshot_segment:
+                continue
+            for payload in read_frames(path):
+                version, entries = pickle.loads(payload)
+                for op in entries:
+                    self._apply(op)
+                frames += 1
+                ops += len(entries)
+                last_version = version if last_version is None else max(last_version, version)
+
+        if last_version is not None:
+            # Versions handed out before the restart must never come back, so
+            # every record starts above the last persisted store version.
+            self._versions.clear()
+            self._version_base = last_version + 1
+        next_segment = max([snapshot_segment] + [segment + 1 for segment, _ in segments])
+        return {
+            "snapshot_segment": snapshot_segment if snapshots else None,
+            "frames": frames,
+            "ops": ops,
+            "next_segment": next_segment,
+            "snapshot_seconds": round(loaded - started, 6),
+            "total_seconds": round(time.perf_counter() - started, 6),
+        }
+
+    # Snapshots
+
+    def _capture(self) -> dict:
+        """The whole state as plain data; the caller holds the store lock."""
+        loans = list(self.loans.values())
+        columns = {}
+        for slot, typecode in _LOAN_COLUMNS.items():
+            values = [getattr(loan, slot) for loan in loans]
+            if slot in ("return_ts", "final_fine"):
+                values = [_none_to_nan(value) for value in values]
+            columns[slot] = array(typecode, values)
+        return {
+            "format": 1,
+            "store_version": self.version("store"),
+            "counters": dict(self._counters),
+            "books": [_book_values(book) for book in self.books.values()],
+            "users": [dict(user) for user in self.users.values()],
+            "loans": columns,
+            "reservations": [dict(reservation) for reservation in self.reservations.values()],
+        }
+
+    def _restore(self, state: dict) -> None:
+        for values in state["books"]:
+            self._index_book(BookRecord(*values))
+        for user in state["users"]:
+            self.users[user["id"]] = user
+        columns = state["loans"]
+        for (loan_id, user_id, book_id, issue_ts, due_ts, status_code,
+             fine_applied, renewed, return_ts, final_fine) in zip(
+            *(columns[slot] for slot in _LOAN_COLUMNS)
+        ):
+            self._index_loan(
+                LoanRecord(
+                    loan_id, user_id, book_id, issue_ts, due_ts, status_code,
+                    bool(fine_applied), bool(renewed),
+                    _nan_to_none(return_ts), _nan_to_none(final_fine),
+                )
+            )
+        for reservation in state["reservations"]:
+            InMemoryStore.insert_reservation(self, reservation)
+        self._counters.update(state["counters"])
+
+    def _snapshot_running(self) -> bool:
+        return self._snapshot_thread is not None and self._snapshot_thread.is_alive()
+
+    def _snapshot_in_background(self) -> None:
+        try:
+            report = self.snapshot()
+            logger.info("Snapshot %s written in %.2fs", report["path"], report["total_seconds"])
+        except Exception:
+            logger.exception("Background snapshot failed")
+
+    def snapshot(self) -> dict:
+        """
+        Writes a snapshot and drops the journal it replaces. Writers wait
+        while the state is copied (reads do not); encoding and writing the
+        file happen after the store lock is released.
+        """
+        with self._snapshot_lock:
+            started = time.perf_counter()
+            with self._lock:
+                if self._depth:
+                    raise RuntimeError("Cannot snapshot inside a transaction")
+                segment = self.journal.rotate()
+                state = self._capture()
+                self._ops_since_snapshot = 0
+            captured = time.perf_counter()
+            path, size = write_snapshot(self.directory, segment, state)
+            for prefix, suffix in ((SNAPSHOT_PREFIX, SNAPSHOT_SUFFIX), (JOURNAL_PREFIX, JOURNAL_SUFFIX)):
+                for older, older_path in _numbered_files(self.directory, prefix, suffix):
+                    if older < segment:
+                        os.remove(older_path)
+            return {
+                "path": path,
+                "segment": segment,
+                "bytes": size,
+                "loans": len(state["loans"]["id"]),
+                "capture_seconds": round(captured - started, 6),
+                "total_seconds": round(time.perf_counter() - started, 6),
+            }
+
+    def close(self, snapshot: bool = False) -> None:
+        """Flushes the journal; with `snapshot`, first writes a snapshot so restart is quick."""
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+        if snapshot:
+            self.snapshot()
+        self.journal.close()
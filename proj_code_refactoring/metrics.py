@@ -0,0 +1,136 @@
+"""
+Library Management System - Request Metrics
+Per-route request counters and latency histograms, rendered in the Prometheus
+text exposition format (version 0.0.4) without a client library.
+
+MetricsMiddleware observes every HTTP request on the event loop thread, which
+is also where /metrics renders, so updates are plain integer increments with
+no lock. Each worker process keeps its own series; scrape every worker (or
+run one) to see the whole server.
+"""
+
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Tuple
+import time
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds in seconds; most library calls finish well under 10 ms
+LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+UNMATCHED_ROUTE = "unmatched"
+
+Gauge = Tuple[str, str, float]  # (name, help, value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels: str) -> str:
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels.items()) + "}"
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class RequestMetrics:
+    """Request counts by status and latency histograms by (method, route)."""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS, prefix: str = "library") -> None:
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+        # (method, route, status) -> requests
+        self.requests: Dict[Tuple[str, str, int], int] = {}
+        # (method, route) -> [per-bucket counts..., overflow, sum of seconds]
+        self._latency: Dict[Tuple[str, str], List[float]] = {}
+
+    def observe(self, method: str, route: str, status: int, seconds: float) -> None:
+        key = (method, route, status)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        series = self._latency.get((method, route))
+        if series is None:
+            series = self._latency[(method, route)] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, seconds)] += 1
+        series[-1] += seconds
+
+    def clear(self) -> None:
+        self.requests.clear()
+        self._latency.clear()
+
+    def render(self, gauges: Iterable[Gauge] = ()) -> str:
+        prefix = self.prefix
+        lines = [
+            f"# HELP {prefix}_http_requests_total HTTP requests by route and status.",
+            f"# TYPE {prefix}_http_requests_total counter",
+        ]
+        errors = []
+        for (method, route, status), count in sorted(self.requests.items()):
+            labels = _labels(method=method, route=route, status=status)
+            lines.append(f"{prefix}_http_requests_total{labels} {count}")
+            if status >= 400:
+                errors.append(f"{prefix}_http_request_errors_total{labels} {count}")
+        lines += [
+            f"# HELP {prefix}_http_request_errors_total HTTP responses with status >= 400.",
+            f"# TYPE {prefix}_http_request_errors_total counter",
+            *errors,
+            f"# HELP {prefix}_http_request_duration_seconds Time to serve a request.",
+            f"# TYPE {prefix}_http_request_duration_seconds histogram",
+        ]
+        name = f"{prefix}_http_request_duration_seconds"
+        for (method, route), series in sorted(self._latency.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                labels = _labels(method=method, route=route, le=_number(bound))
+                lines.append(f"{name}_bucket{labels} {cumulative}")
+            labels = _labels(method=method, route=route)
+            lines.append(f"{name}_sum{labels} {_number(series[-1])}")
+            lines.append(f"{name}_count{labels} {cumulative}")
+        for gauge_name, help_text, value in gauges:
+            lines += [
+                f"# HELP {prefix}_{gauge_name} {help_text}",
+                f"# TYPE {prefix}_{gauge_name} gauge",
+                f"{prefix}_{gauge_name} {_number(value)}",
+            ]
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware timing each HTTP request until its last body chunk.
+    Requests are labelled with the matched route template (e.g. /books/{book_id})
+    so path parameters do not create a series per id.
+    """
+
+    def __init__(self, app, metrics: RequestMetrics) -> None:
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            self.metrics.observe(
+                scope["method"],
+                getattr(route, "path", UNMATCHED_ROUTE),
+                status,
+                time.perf_counter() - start,
+            )
@@ -0,0 +1,286 @@
+"""
+Library Management System - Request Profiling
+Opt-in cProfile runs of single requests, for finding out why one
+/statistics or /books/search call was slow in production, and a sampling
+profiler of the whole process (StackSampler) for where worker CPU goes
+under real load.
+
+A request is profiled when it carries X-Debug-Profile: 1 (or ?debug_profile=1)
+together with a valid admin token. Its handler runs under cProfile and the
+stats are kept in a small ProfileStore under the request id (X-Request-ID, or
+a generated one), which the response reports in X-Profile-Id.
+
+Sync handlers run in the threadpool and cProfile only sees the thread that
+enabled it, so the profiler is switched on inside the handler itself:
+ProfiledRoute wraps every endpoint to check a context variable set by
+ProfilingMiddleware. When profiling is not enabled for the app neither is
+installed, and requests pay nothing.
+
+StackSampler reads every thread's stack with sys._current_frames() from a
+background thread and counts identical stacks, producing the collapsed
+format flamegraph.pl, speedscope and inferno read.
+"""
+
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Callable, Dict, List, NamedTuple, Optional
+from urllib.parse import parse_qs
+import cProfile
+import functools
+import inspect
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+
+from fastapi.routing import APIRoute
+
+PROFILE_HEADER = b"x-debug-profile"
+PROFILE_QUERY_FLAG = "debug_profile"
+ADMIN_TOKEN_HEADER = b"x-admin-token"
+REQUEST_ID_HEADER = b"x-request-id"
+PROFILE_ID_HEADER = b"x-profile-id"
+MAX_REQUEST_ID_LENGTH = 128
+
+_active_profile: ContextVar[Optional[cProfile.Profile]] = ContextVar(
+    "library_request_profile", default=None
+)
+
+
+class RequestProfile(NamedTuple):
+    request_id: str
+    method: str
+    path: str
+    status: int
+    seconds: float
+    created_at: str
+    stats: pstats.Stats
+
+    def summary(self) -> dict:
+        return {
+            "request_id": self.request_id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "seconds": round(self.seconds, 6),
+            "created_at": self.created_at,
+        }
+
+
+class ProfileStore:
+    """Thread-safe LRU of the most recent RequestProfile entries."""
+
+    def __init__(self, max_entries: int = 100) -> None:
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, RequestProfile]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, request_id: str) -> Optional[RequestProfile]:
+        with self._lock:
+            return self._entries.get(request_id)
+
+    def put(self, profile: RequestProfile) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[profile.request_id] = profile
+            self._entries.move_to_end(profile.request_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def recent(self) -> List[RequestProfile]:
+        """Newest first."""
+        with self._lock:
+            return list(reversed(self._entries.values()))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+def format_stats(stats: pstats.Stats, limit: int = 40, sort: str = "cumulative") -> str:
+    """The usual pstats table, top `limit` functions by `sort`."""
+    out = io.StringIO()
+    stats.stream = out
+    stats.sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+
+def dump_stats(stats: pstats.Stats) -> bytes:
+    """Bytes of a .prof file, as written by Stats.dump_stats (snakeviz, pstats)."""
+    return marshal.dumps(stats.stats)
+
+
+def profiled_endpoint(endpoint: Callable) -> Callable:
+    """
+    Wraps `endpoint` so it runs under the profiler ProfilingMiddleware set for
+    the current request, if any. Async endpoints are profiled across their
+    awaits, so whatever else the event loop runs meanwhile shows up too.
+    """
+    if inspect.iscoroutinefunction(endpoint):
+
+        @functools.wraps(endpoint)
+        async def async_wrapper(*args, **kwargs):
+            profile = _active_profile.get()
+            if profile is None:
+                return await endpoint(*args, **kwargs)
+            profile.enable()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                profile.disable()
+
+        return async_wrapper
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        profile = _active_profile.get()
+        if profile is None:
+            return endpoint(*args, **kwargs)
+        profile.enable()
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            profile.disable()
+
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    """APIRoute whose endpoint can be profiled per request (see ProfilingMiddleware)."""
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs) -> None:
+        super().__init__(path, profiled_endpoint(endpoint), **kwargs)
+
+
+def _wants_profile(scope) -> bool:
+    for name, value in scope["headers"]:
+        if name == PROFILE_HEADER:
+            return value not in (b"", b"0")
+    query = scope.get("query_string", b"")
+    if PROFILE_QUERY_FLAG.encode() not in query:
+        return False
+    values = parse_qs(query.decode("latin-1")).get(PROFILE_QUERY_FLAG, [])
+    return any(value not in ("", "0") for value in values)
+
+
+class ProfilingMiddleware:
+    """
+    Profiles requests that ask for it and present a token `authorize` accepts;
+    others (including unauthorized profile requests) are served unchanged.
+    """
+
+    def __init__(self, app, profiles: ProfileStore, authorize: Callable[[str], bool]) -> None:
+        self.app = app
+        self.profiles = profiles
+        self.authorize = authorize
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or not _wants_profile(scope):
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        if not self.authorize(headers.get(ADMIN_TOKEN_HEADER, b"").decode("latin-1")):
+            await self.app(scope, receive, send)
+            return
+
+        request_id = headers.get(REQUEST_ID_HEADER, b"").decode("latin-1")[:MAX_REQUEST_ID_LENGTH]
+        request_id = request_id or uuid.uuid4().hex
+        status = 500
+
+        async def send_with_profile_id(message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                profile_id = (PROFILE_ID_HEADER, request_id.encode("latin-1"))
+                message = {**message, "headers": [*message.get("headers", []), profile_id]}
+            await send(message)
+
+        profile = cProfile.Profile()
+        token = _active_profile.set(profile)
+        created_at = datetime.now().isoformat()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            elapsed = time.perf_counter() - start
+            _active_profile.reset(token)
+            if profile.getstats():  # empty when no handler ran (unknown route, 422)
+                self.profiles.put(
+                    RequestProfile(
+                        request_id, scope["method"], scope["path"], status, elapsed, created_at,
+                        pstats.Stats(profile),
+                    )
+                )
+
+
+# Leaf frames of threads that are blocked rather than working: the event loop
+# waiting in select(), threadpool workers waiting for a job, bare lock waits.
+IDLE_LEAVES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+}
+
+
+class StackSampler:
+    """
+    Samples the Python stack of every other thread `hz` times a second until
+    stopped. Stacks are keyed root first and prefixed with the thread name.
+    """
+
+    def __init__(self, hz: float = 100.0, include_idle: bool = False, line_numbers: bool = False):
+        self.interval = 1.0 / hz
+        self.include_idle = include_idle
+        self.line_numbers = line_numbers
+        self.counts: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        self._thread.join()
+        return self.counts
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def _label(self, frame) -> str:
+        code = frame.f_code
+        where = os.path.basename(code.co_filename)
+        if self.line_numbers:
+            where = f"{where}:{frame.f_lineno}"
+        return f"{code.co_qualname} ({where})"
+
+    def sample(self) -> None:
+        own = threading.get_ident()
+        names: Dict[int, str] = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            leaf = (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+            if not self.include_idle and leaf in IDLE_LEAVES:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            self.counts[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+
+def collapse_stacks(counts: Counter) -> str:
+    """One "root;...;leaf count" line per distinct stack."""
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
@@ -3,18 +3,92 @@ Library Management System - Refactored Code
 Applies 10+ refactoring techniques for improved readability and maintainability.
 """
 
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import Optional, List, Dict
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
+from typing import AsyncIterator, Callable, Iterator, Optional, List, Dict, Tuple, Union
 from datetime import datetime, timedelta
 from enum import Enum
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+import asyncio
+import base64
+import binascii
+import hashlib
+import hmac
 import logging
+import os
+import threading
+
+from caching import CachedResponse, FragmentCache, ResponseCache, etag_matches, get_json_encoder
+from changes import ChangeFeed, ChangesExpired, PendingChange, format_sse
+from fines import FINE_PER_DAY, apply_overdue_fines
+from journal import JournaledStore
+from metrics import PROMETHEUS_CONTENT_TYPE, MetricsMiddleware, RequestMetrics
+from profiling import (
+    ProfileStore,
+    ProfiledRoute,
+    ProfilingMiddleware,
+    StackSampler,
+    collapse_stacks,
+    dump_stats,
+    format_stats,
+)
+from storage import (
+    LibraryStore,
+    LoanRecord,
+    create_store,
+    to_timestamp,
+    timestamp_to_iso,
+    popularity_cutoff,
+    SECONDS_PER_DAY,
+    POPULARITY_WINDOWS,
+    FACET_FIELDS,
+)
 
 # REFACTORING 1: Replace Magic Numbers with Named Constants / Symbolic Constants
 # Grouped into a dedicated config section for clarity
-FINE_PER_DAY = 0.5
+# (FINE_PER_DAY is defined in fines.py, shared with the batch fine job)
 DEFAULT_LOAN_DAYS = 14
 RESERVATION_EXPIRY_DAYS = 3
+# Seconds between background reservation expiry sweeps; 0 disables the task
+# and expiry happens lazily on reads.
+RESERVATION_SWEEP_SECONDS = float(os.environ.get("LIBRARY_RESERVATION_SWEEP_SECONDS", "0"))
+# Bulk NDJSON imports: rows validated/inserted per transaction, errors echoed back
+BULK_BATCH_SIZE = 1000
+BULK_MAX_REPORTED_ERRORS = 100
+# Books per POST /loans/batch (kiosk checkout); membership limits still apply
+LOAN_BATCH_MAX = 20
+# List endpoints: default/maximum page size, and rows fetched per NDJSON chunk
+DEFAULT_PAGE_SIZE = 50
+PAGE_SIZE_MAX = 1000
+STREAM_CHUNK_SIZE = 500
+POPULAR_DEFAULT_LIMIT = 10
+POPULAR_LIMIT_MAX = 100
+# Values returned per facet of /books/search?facets=...
+FACET_DEFAULT_LIMIT = 10
+FACET_LIMIT_MAX = 100
+# Encoded book/user/statistics responses kept per process (0 disables)
+RESPONSE_CACHE_SIZE = int(os.environ.get("LIBRARY_RESPONSE_CACHE_SIZE", "4096"))
+# Pre-encoded loan JSON kept per process (0 disables)
+FRAGMENT_CACHE_SIZE = int(os.environ.get("LIBRARY_FRAGMENT_CACHE_SIZE", "100000"))
+# "json" or "orjson"; unset picks orjson when it is installed
+JSON_ENCODER = os.environ.get("LIBRARY_JSON_ENCODER") or None
+# Shared secret for /admin routes (X-Admin-Token); unset disables them
+ADMIN_TOKEN = os.environ.get("LIBRARY_ADMIN_TOKEN", "")
+# Per-request cProfile on X-Debug-Profile plus the admin token; when unset the
+# profiling hooks are not installed at all
+PROFILE_REQUESTS = os.environ.get("LIBRARY_PROFILE_REQUESTS", "") == "1"
+PROFILE_STORE_SIZE = 100
+# /debug/profile: longest sampling window and highest rate accepted
+SAMPLING_MAX_SECONDS = 300
+SAMPLING_MAX_HZ = 1000
+# /changes: ring buffer size, longest long-poll and SSE keep-alive interval
+CHANGE_FEED_SIZE = int(os.environ.get("LIBRARY_CHANGE_FEED_SIZE", "10000"))
+CHANGES_MAX_WAIT_SECONDS = 60
+CHANGES_PAGE_MAX = 1000
+SSE_KEEPALIVE_SECONDS = 15.0
 
 
 # REFACTORING 2: Replace Type Code with Enum
@@ -41,17 +115,43 @@ MEMBERSHIP_LOAN_DAYS: Dict[MembershipType, int] = {
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
 
-# --- In-Memory Store (same as original, but encapsulated) ---
-books: Dict[int, dict] = {}
-users: Dict[int, dict] = {}
-loans: Dict[int, dict] = {}
-reservations: Dict[int, dict] = {}
-_book_counter = 0
-_user_counter = 0
-_loan_counter = 0
-_reservation_counter = 0
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    sweeper = None
+    if RESERVATION_SWEEP_SECONDS > 0:
+        sweeper = asyncio.create_task(sweep_reservations_forever(RESERVATION_SWEEP_SECONDS))
+    yield
+    if sweeper is not None:
+        sweeper.cancel()
+    if isinstance(store, JournaledStore):
+        store.close(snapshot=True)  # restart from the snapshot instead of the journal
+
+
+app = FastAPI(lifespan=lifespan)
+request_metrics = RequestMetrics()
+app.add_middleware(MetricsMiddleware, metrics=request_metrics)
+request_profiles = ProfileStore(PROFILE_STORE_SIZE)
+sampling_lock = threading.Lock()  # one /debug/profile run at a time
+if PROFILE_REQUESTS:
+    app.router.route_class = ProfiledRoute
+    app.add_middleware(
+        ProfilingMiddleware,
+        profiles=request_profiles,
+        authorize=lambda token: admin_token_matches(token),
+    )
+
+# --- Store (in-memory by default, see storage.create_store) ---
+store: LibraryStore = create_store()
+# Direct record access kept for callers of the original module-level dicts.
+books = store.books
+users = store.users
+loans = store.loans
+reservations = store.reservations
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+fragment_cache = FragmentCache(FRAGMENT_CACHE_SIZE)
+encode_json = get_json_encoder(JSON_ENCODER)
+change_feed = ChangeFeed(CHANGE_FEED_SIZE)
 
 
 # --- Pydantic Models ---
@@ -80,6 +180,11 @@ class LoanCreate(BaseModel):
     book_id: int
 
 
+class LoanBatchCreate(BaseModel):
+    user_id: int
+    book_ids: List[int] = Field(min_length=1, max_length=LOAN_BATCH_MAX)
+
+
 class ReservationCreate(BaseModel):
     user_id: int
     book_id: int
@@ -90,48 +195,87 @@ class ReservationCreate(BaseModel):
 
 def _next_id(counter_name: str) -> int:
     """Generate the next sequential ID for a given entity."""
-    global _book_counter, _user_counter, _loan_counter, _reservation_counter
-    mapping = {
-        "book": "_book_counter",
-        "user": "_user_counter",
-        "loan": "_loan_counter",
-        "reservation": "_reservation_counter",
-    }
-    if counter_name == "book":
-        _book_counter += 1
-        return _book_counter
-    elif counter_name == "user":
-        _user_counter += 1
-        return _user_counter
-    elif counter_name == "loan":
-        _loan_counter += 1
-        return _loan_counter
+    return store.next_id(counter_name)
+
+
+_recorded_changes: ContextVar[Optional[List[PendingChange]]] = ContextVar(
+    "library_recorded_changes", default=None
+)
+
+
+@contextmanager
+def mutation():
+    """
+    store.transaction() that publishes the changes recorded inside it (see
+    record_change) to the change feed once it commits. If it ends in an error
+    they are dropped when the store rolled back (SQLite), and still published
+    when it did not, since the in-memory store keeps writes made before one.
+    """
+    if _recorded_changes.get() is not None:
+        with store.transaction():
+            yield
+        return
+    pending: List[PendingChange] = []
+    token = _recorded_changes.set(pending)
+    committed = False
+    try:
+        with store.transaction():
+            yield
+        committed = True
+    finally:
+        _recorded_changes.reset(token)
+        if committed or not store.rolls_back:
+            change_feed.publish(pending)
+
+
+def record_change(entity: str, record_id: int, op: str, **refs: int) -> None:
+    """Adds a change to the enclosing mutation(), or publishes it at once outside one."""
+    pending = _recorded_changes.get()
+    if pending is None:
+        change_feed.publish([(entity, record_id, op, refs)])
     else:
-        _reservation_counter += 1
-        return _reservation_counter
+        pending.append((entity, record_id, op, refs))
 
 
-def calculate_fine(loan: dict) -> float:
+def calculate_fine(loan: dict, now: Optional[datetime] = None) -> float:
     """
     REFACTORING 5: Extract Method
     Calculates the overdue fine for a single loan.
     Was duplicated in 5+ places in the original code.
+    Pass `now` to share one clock read across many loans.
     """
     if loan["status"] != "active":
         return 0.0
-    due_date = datetime.fromisoformat(loan["due_date"])
-    if datetime.now() <= due_date:
+    if isinstance(loan, LoanRecord):
+        due_ts = loan.due_ts  # already a timestamp, skip the ISO round trip
+    else:
+        due_ts = to_timestamp(datetime.fromisoformat(loan["due_date"]))
+    return fine_for_due(due_ts, to_timestamp(now or datetime.now()))
+
+
+def fine_for_due(due_ts: float, now_ts: float) -> float:
+    """Fine for an active loan given its due timestamp and a single clock read."""
+    if now_ts <= due_ts:
         return 0.0
-    days_overdue = (datetime.now() - due_date).days
+    days_overdue = int((now_ts - due_ts) // SECONDS_PER_DAY)
     return round(days_overdue * FINE_PER_DAY, 2)
 
 
+def get_overdue_loans(as_of: Optional[datetime] = None) -> List[Tuple[dict, float]]:
+    """Active loans overdue as of `as_of` (default: now) with their current fine."""
+    as_of_ts = to_timestamp(as_of or datetime.now())
+    return [
+        (loan, fine_for_due(due_ts, as_of_ts))
+        for loan, due_ts in store.overdue_loans(as_of_ts)
+    ]
+
+
 def get_user_or_404(user_id: int) -> dict:
     """
     REFACTORING 5: Extract Method
     Returns user or raises 404. Eliminates repeated lookup pattern.
     """
-    user = users.get(user_id)
+    user = store.get_user(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
@@ -142,7 +286,7 @@ def get_book_or_404(book_id: int) -> dict:
     REFACTORING 5: Extract Method
     Returns book or raises 404. Eliminates repeated lookup pattern.
     """
-    book = books.get(book_id)
+    book = store.get_book(book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     return book
@@ -153,7 +297,7 @@ def get_loan_or_404(loan_id: int) -> dict:
     REFACTORING 5: Extract Method
     Returns loan or raises 404.
     """
-    loan = loans.get(loan_id)
+    loan = store.get_loan(loan_id)
     if not loan:
         raise HTTPException(status_code=404, detail="Loan not found")
     return loan
@@ -164,11 +308,7 @@ def get_active_loans_for_user(user_id: int) -> List[dict]:
     REFACTORING 5: Extract Method
     Returns all active loans for a user.
     """
-    return [
-        loan
-        for loan in loans.values()
-        if loan["user_id"] == user_id and loan["status"] == "active"
-    ]
+    return store.loans_for_user(user_id, "active")
 
 
 def get_loan_period_days(membership_type: MembershipType) -> int:
@@ -195,11 +335,14 @@ def apply_pending_fines(user_id: int) -> None:
     Applies outstanding fines on a user's active loans before processing new actions.
     Was inlined and duplicated inside create_loan.
     """
+    now = datetime.now()
     for loan in get_active_loans_for_user(user_id):
-        fine = calculate_fine(loan)
+        fine = calculate_fine(loan, now)
         if fine > 0 and not loan.get("fine_applied"):
-            users[user_id]["balance"] -= fine
-            loan["fine_applied"] = True
+            store.adjust_balance(user_id, -fine)
+            store.update_loan(loan, fine_applied=True)
+            record_change("loan", loan["id"], "fined", user_id=user_id, book_id=loan["book_id"])
+            record_change("user", user_id, "updated")
 
 
 def fulfill_reservation_if_exists(user_id: int, book_id: int) -> None:
@@ -207,99 +350,459 @@ def fulfill_reservation_if_exists(user_id: int, book_id: int) -> None:
     REFACTORING 5: Extract Method
     Marks a matching reservation as fulfilled.
     """
-    for reservation in reservations.values():
-        if (
-            reservation["user_id"] == user_id
-            and reservation["book_id"] == book_id
-            and reservation["status"] == "active"
-        ):
-            reservation["status"] = "fulfilled"
+    reservation = store.get_active_reservation(user_id, book_id)
+    if reservation is not None:
+        store.update_reservation(reservation, status="fulfilled")
+        record_change("reservation", reservation["id"], "fulfilled", user_id=user_id)
 
 
-def expire_stale_reservations() -> None:
+def expire_stale_reservations(now: Optional[datetime] = None) -> None:
     """
     REFACTORING 7: Separate Query from Modifier
     Expiring reservations is now an explicit operation, not a hidden side effect
     during a read. Call this explicitly when needed.
+    Drains the expiry heap, so only reservations expired since the last call are touched.
     """
-    for reservation in reservations.values():
-        expires_at = datetime.fromisoformat(reservation["expires_at"])
-        if datetime.now() > expires_at and reservation["status"] == "active":
-            reservation["status"] = "expired"
+    now_ts = to_timestamp(now or datetime.now())
+    with mutation():
+        for reservation_id, user_id in store.expire_reservations(now_ts):
+            record_change("reservation", reservation_id, "expired", user_id=user_id)
+
+
+async def sweep_reservations_forever(interval_seconds: float) -> None:
+    """Background task started by the app lifespan when sweeping is configured."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            # Off the event loop: the sweep waits on the store lock (or SQLite's
+            # busy timeout), which would otherwise stall every async request.
+            await run_in_threadpool(expire_stale_reservations)
+        except Exception:  # keep the sweeper alive; the next read drains lazily anyway
+            logger.exception("Reservation expiry sweep failed")
 
 
 # --- Route Handlers ---
 
 
-@app.post("/books", status_code=201)
-def add_book(book: Book):
-    book_id = _next_id("book")
-    books[book_id] = {"id": book_id, **book.model_dump()}
-    logger.info("Book added: %s (id=%d)", book.title, book_id)
-    return books[book_id]
+def _book_record(book_id: int, book: Book) -> dict:
+    return {"id": book_id, **book.model_dump()}
 
 
-@app.post("/users", status_code=201)
-def add_user(user: User):
-    user_id = _next_id("user")
-    users[user_id] = {
+def _user_record(user_id: int, user: User) -> dict:
+    return {
         "id": user_id,
         **user.model_dump(),
         "active": True,
         "registered_at": datetime.now().isoformat(),
     }
+
+
+@app.post("/books", status_code=201)
+def add_book(book: Book):
+    with mutation():
+        book_id = _next_id("book")
+        record = _book_record(book_id, book)
+        store.insert_book(record)
+        record_change("book", book_id, "created")
+    logger.info("Book added: %s (id=%d)", book.title, book_id)
+    return record
+
+
+@app.post("/users", status_code=201)
+def add_user(user: User):
+    with mutation():
+        user_id = _next_id("user")
+        record = _user_record(user_id, user)
+        store.insert_user(record)
+        record_change("user", user_id, "created")
     logger.info("User registered: %s (id=%d)", user.name, user_id)
-    return users[user_id]
+    return record
+
+
+# --- Bulk Import ---
+
+
+async def _ndjson_lines(request: Request) -> AsyncIterator[Tuple[int, bytes]]:
+    """Yields (line number, line) from a streamed NDJSON body, skipping blank lines."""
+    pending = b""
+    line_number = 0
+    async for chunk in request.stream():
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield line_number, line
+    if pending.strip():
+        yield line_number + 1, pending
+
+
+def _describe_validation_error(exc: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in error['loc']) or 'line'}: {error['msg']}"
+        for error in exc.errors()
+    )
+
+
+def _import_batch(
+    batch: List[Tuple[int, bytes]],
+    model: type,
+    kind: str,
+    to_record: Callable[[int, BaseModel], dict],
+    insert_many: Callable[[List[dict]], None],
+    report: dict,
+) -> None:
+    """Validates one batch, then inserts the valid rows under a single id range."""
+    valid = []
+    for line_number, line in batch:
+        try:
+            valid.append(model.model_validate_json(line))
+        except ValidationError as exc:
+            report["rejected"] += 1
+            if len(report["errors"]) < BULK_MAX_REPORTED_ERRORS:
+                report["errors"].append(
+                    {"line": line_number, "error": _describe_validation_error(exc)}
+                )
+    if not valid:
+        return
+
+    with mutation():
+        first_id = store.reserve_ids(kind, len(valid))
+        insert_many([to_record(first_id + offset, item) for offset, item in enumerate(valid)])
+        for record_id in range(first_id, first_id + len(valid)):
+            record_change(kind, record_id, "created")
+
+    last_id = first_id + len(valid) - 1
+    report["inserted"] += len(valid)
+    ranges = report["id_ranges"]
+    if ranges and ranges[-1][1] + 1 == first_id:
+        ranges[-1][1] = last_id
+    else:
+        ranges.append([first_id, last_id])
+
+
+async def _bulk_import(
+    request: Request,
+    model: type,
+    kind: str,
+    to_record: Callable[[int, BaseModel], dict],
+    insert_many: Callable[[List[dict]], None],
+) -> dict:
+    report = {"inserted": 0, "rejected": 0, "id_ranges": [], "errors": []}
+    batch: List[Tuple[int, bytes]] = []
+    async for numbered_line in _ndjson_lines(request):
+        batch.append(numbered_line)
+        if len(batch) >= BULK_BATCH_SIZE:
+            await run_in_threadpool(_import_batch, batch, model, kind, to_record, insert_many, report)
+            batch = []
+    if batch:
+        await run_in_threadpool(_import_batch, batch, model, kind, to_record, insert_many, report)
+
+    logger.info(
+        "Bulk import: %d %s(s) inserted, %d rejected",
+        report["inserted"],
+        kind,
+        report["rejected"],
+    )
+    return report
+
+
+@app.post("/books/bulk")
+async def bulk_add_books(request: Request):
+    """Imports books from an NDJSON body (one Book object per line)."""
+    return await _bulk_import(request, Book, "book", _book_record, store.insert_books)
+
+
+@app.post("/users/bulk")
+async def bulk_add_users(request: Request):
+    """Imports users from an NDJSON body (one User object per line)."""
+    return await _bulk_import(request, User, "user", _user_record, store.insert_users)
+
+
+# --- Pagination ---
+
+# (after_id, limit) -> next records in id order
+PageFetcher = Callable[[int, int], List[dict]]
+
+LIMIT_QUERY = Query(None, ge=1, le=PAGE_SIZE_MAX)
+FORMAT_QUERY = Query("json", alias="format", pattern="^(json|ndjson)$")
+
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(f"id:{last_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    """Id the next page starts after; malformed cursors are a client error."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        prefix, _, value = raw.partition(":")
+        last_id = int(value)
+        if prefix != "id" or last_id < 0:
+            raise ValueError(raw)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return last_id
+
+
+def _stream_ndjson(
+    fetch: PageFetcher, render: Callable[[dict], dict], after_id: int, limit: Optional[int]
+) -> Iterator[bytes]:
+    """Yields one JSON line per record, reading the store a chunk at a time."""
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = STREAM_CHUNK_SIZE if remaining is None else min(STREAM_CHUNK_SIZE, remaining)
+        records = fetch(after_id, size)
+        for record in records:
+            yield encode_json(render(record)) + b"\n"
+        if len(records) < size:
+            return
+        after_id = records[-1]["id"]
+        if remaining is not None:
+            remaining -= len(records)
+
+
+def _paginated(
+    fetch: PageFetcher,
+    render: Callable[[dict], dict],
+    limit: Optional[int],
+    cursor: Optional[str],
+    output_format: str,
+):
+    """
+    Shared paging for list endpoints, or None when the caller asked for neither
+    a page nor a stream and the endpoint should answer in its original shape.
+    * format=ndjson: every record after `cursor` (at most `limit`), streamed.
+    * limit/cursor:  {"items": [...], "next_cursor": str | None}.
+    """
+    after_id = decode_cursor(cursor) if cursor else 0
+    if output_format == "ndjson":
+        return StreamingResponse(
+            _stream_ndjson(fetch, render, after_id, limit), media_type="application/x-ndjson"
+        )
+    if limit is None and cursor is None:
+        return None
+
+    page_size = limit or DEFAULT_PAGE_SIZE
+    records = fetch(after_id, page_size + 1)  # one extra row tells us if there is more
+    has_more = len(records) > page_size
+    records = records[:page_size]
+    return {
+        "items": [render(record) for record in records],
+        "next_cursor": encode_cursor(records[-1]["id"]) if has_more else None,
+    }
+
+
+# --- Pre-encoded Fragments ---
+
+
+def _raw_object(**members: bytes) -> bytes:
+    """A JSON object assembled from already encoded member values."""
+    pairs = (b'"%s":%s' % (name.encode(), value) for name, value in members.items())
+    return b"{" + b",".join(pairs) + b"}"
+
+
+def _raw_array(items: List[bytes]) -> bytes:
+    return b"[" + b",".join(items) + b"]"
+
+
+def _fragment(kind: str, record: dict, version: int) -> Tuple[dict, bytes]:
+    """
+    Encoded JSON of a book, user or loan `record` as of `version`, with the
+    record it was taken from. On a miss the record is re-read so the bytes are
+    never older than the version they are cached under; callers should render
+    from the returned record.
+    """
+    fragment = fragment_cache.get(kind, record["id"], version)
+    if fragment is None:
+        record = getattr(store, f"get_{kind}")(record["id"]) or record
+        fragment = encode_json(record)
+        fragment_cache.put(kind, record["id"], version, fragment)
+    return record, fragment
+
+
+def _fragments(kind: str, records: List[dict]) -> List[bytes]:
+    """Encoded JSON of each record, looking all their versions up at once."""
+    versions = store.versions(kind, [record["id"] for record in records])
+    return [_fragment(kind, record, version)[1] for record, version in zip(records, versions)]
+
+
+FACET_NAMES = "(%s)" % "|".join(FACET_FIELDS)
 
 
 @app.get("/books/search")
-def search_books(q: str = "", genre: str = "", author: str = ""):
+def search_books(
+    q: str = "",
+    genre: str = "",
+    author: str = "",
+    limit: Optional[int] = LIMIT_QUERY,
+    cursor: Optional[str] = None,
+    output_format: str = FORMAT_QUERY,
+    mode: str = Query("substring", pattern="^(substring|ranked)$"),
+    facets: Optional[str] = Query(None, pattern=f"^{FACET_NAMES}(,{FACET_NAMES})*$"),
+    facet_limit: int = Query(FACET_DEFAULT_LIMIT, ge=1, le=FACET_LIMIT_MAX),
+):
     """
     REFACTORING 10: Replace Temp with Query / Consolidate Conditional Expression
-    Filtering logic expressed clearly using a helper predicate.
+    Filtering is delegated to the store's search index.
+    mode=ranked orders by relevance instead (BM25 over title and author,
+    tolerant of typos) and answers with the best `limit` matches as
+    {"items": [{"book": ..., "score": ...}]}; there are no further pages.
+    facets=genre,author,year adds "facets" to a page: the `facet_limit` most
+    common values of each field among all matches, not just the page's.
+    """
+    if mode == "ranked":
+        if cursor is not None or output_format != "json" or facets:
+            raise HTTPException(
+                status_code=400,
+                detail="Ranked search does not support cursor, format=ndjson or facets",
+            )
+        ranked = store.rank_books(q, limit or DEFAULT_PAGE_SIZE, genre, author)
+        found = _fragments("book", [book for book, _ in ranked])
+        items = [
+            _raw_object(book=book_json, score=encode_json(round(score, 4)))
+            for book_json, (_, score) in zip(found, ranked)
+        ]
+        return Response(_raw_object(items=_raw_array(items)), media_type="application/json")
+    if facets and output_format != "json":
+        raise HTTPException(status_code=400, detail="Facets are not available with format=ndjson")
+
+    page = _paginated(
+        lambda after_id, size: store.search_books(q, genre, author, after_id, size),
+        lambda book: book,
+        (limit or DEFAULT_PAGE_SIZE) if facets else limit,
+        cursor,
+        output_format,
+    )
+    if facets:
+        fields = tuple(dict.fromkeys(facets.split(",")))
+        counts = store.facet_counts(q, genre, author, fields, facet_limit)
+        page["facets"] = {
+            field: [{"value": value, "count": count} for value, count in pairs]
+            for field, pairs in counts.items()
+        }
+    if page is not None:
+        return page
+    found = _fragments("book", store.search_books(q, genre, author))
+    return Response(_raw_array(found), media_type="application/json")
+
+
+@app.get("/books/popular")
+def get_popular_books(
+    window: str = Query("7d", pattern="^(%s)$" % "|".join(POPULARITY_WINDOWS)),
+    limit: int = Query(POPULAR_DEFAULT_LIMIT, ge=1, le=POPULAR_LIMIT_MAX),
+    genre: Optional[str] = None,
+):
     """
+    Most borrowed books over a sliding window (1d, 7d or 30d), optionally
+    within one genre. The store keeps windowed counters, so this does not
+    scan loans.
+    """
+    now_ts = to_timestamp(datetime.now())
+    ranked = []
+    for book_id, loan_count in store.popular_books(window, now_ts, limit, genre):
+        book = store.get_book(book_id)
+        ranked.append(
+            {
+                "book_id": book_id,
+                "title": book["title"] if book else "Unknown",
+                "author": book["author"] if book else None,
+                "genre": book["genre"] if book else None,
+                "loans": loan_count,
+            }
+        )
+    return {
+        "window": window,
+        "genre": genre,
+        "since": timestamp_to_iso(popularity_cutoff(now_ts, window)),
+        "books": ranked,
+    }
+
 
-    def matches(book: dict) -> bool:
-        if (
-            q
-            and q.lower() not in book["title"].lower()
-            and q.lower() not in book["author"].lower()
-        ):
-            return False
-        if genre and book["genre"].lower() != genre.lower():
-            return False
-        if author and author.lower() not in book["author"].lower():
-            return False
-        return True
+# --- Conditional GET ---
 
-    return [book for book in books.values() if matches(book)]
+
+NEVER_EXPIRES = float("inf")
+
+
+def _conditional_json(
+    request: Request,
+    key: tuple,
+    build: Callable[[], Tuple[Union[dict, bytes], float]],
+    etag: Optional[str] = None,
+    now_ts: float = 0.0,
+) -> Response:
+    """
+    Serves a JSON payload keyed by (route, id, version) with an ETag.
+    `build` returns the payload (or its encoded bytes) and the timestamp it
+    stays valid until, or raises (e.g. 404). `etag` is used when it follows from the version
+    alone, otherwise the ETag is a hash of the body. A 304 is only answered
+    for a payload that exists: one in the cache, or built just now.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    entry = response_cache.get(key, now_ts)
+    if entry is None:
+        payload, expires_ts = build()
+        body = payload if isinstance(payload, bytes) else encode_json(payload)
+        entry = CachedResponse(
+            etag or '"%s"' % hashlib.blake2b(body, digest_size=12).hexdigest(),
+            body,
+            expires_ts,
+        )
+        response_cache.put(key, entry)
+
+    if etag_matches(if_none_match, entry.etag):
+        return Response(status_code=304, headers={"ETag": entry.etag})
+    return Response(entry.body, media_type="application/json", headers={"ETag": entry.etag})
+
+
+def _version_etag(kind: str, record_id: int, version: int) -> str:
+    # The store epoch keeps a restarted store's restarted counters from
+    # matching ETags issued before the restart.
+    return f'"{kind}-{store.epoch}-{record_id}-{version}"'
 
 
 @app.get("/books/{book_id}")
-def get_book(book_id: int):
-    book = get_book_or_404(book_id)
-    loan_count = sum(1 for loan in loans.values() if loan["book_id"] == book_id)
-    return {"book": book, "loan_count": loan_count}
+def get_book(book_id: int, request: Request):
+    version = store.version("book", book_id)
+
+    def build() -> Tuple[bytes, float]:
+        _, book_json = _fragment("book", get_book_or_404(book_id), version)
+        loan_count = store.count_loans_for_book(book_id)
+        return _raw_object(book=book_json, loan_count=encode_json(loan_count)), NEVER_EXPIRES
+
+    return _conditional_json(
+        request, ("book", book_id, version), build, etag=_version_etag("book", book_id, version)
+    )
 
 
 @app.get("/users/{user_id}")
-def get_user(user_id: int):
-    user = get_user_or_404(user_id)
-    active_count = len(get_active_loans_for_user(user_id))
-    return {"user": user, "active_loans": active_count}
+def get_user(user_id: int, request: Request):
+    version = store.version("user", user_id)
+
+    def build() -> Tuple[bytes, float]:
+        _, user_json = _fragment("user", get_user_or_404(user_id), version)
+        active_count = store.count_loans_for_user(user_id, "active")
+        return _raw_object(user=user_json, active_loans=encode_json(active_count)), NEVER_EXPIRES
+
+    return _conditional_json(
+        request, ("user", user_id, version), build, etag=_version_etag("user", user_id, version)
+    )
 
 
 @app.delete("/users/{user_id}")
 def deactivate_user(user_id: int):
-    user = get_user_or_404(user_id)
-    # REFACTORING 8: Add Guard Clause - check active loans before deactivation
-    active_loans = get_active_loans_for_user(user_id)
-    if active_loans:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Cannot deactivate user with {len(active_loans)} active loan(s)",
-        )
-    users[user_id]["active"] = False
+    with mutation():
+        user = get_user_or_404(user_id)
+        # REFACTORING 8: Add Guard Clause - check active loans before deactivation
+        active_count = store.count_loans_for_user(user_id, "active")
+        if active_count:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Cannot deactivate user with {active_count} active loan(s)",
+            )
+        store.update_user(user, active=False)
+        record_change("user", user_id, "deactivated")
     return {"message": "User deactivated"}
 
 
@@ -310,100 +813,227 @@ def create_loan(data: LoanCreate):
     The original 60-line nested function is now a clean sequence of guard clauses
     and delegating to extracted helpers.
     """
-    user = get_user_or_404(data.user_id)
-    book = get_book_or_404(data.book_id)
-
-    if not user["active"]:
-        raise HTTPException(status_code=400, detail="User account is not active")
-    if book["available_copies"] <= 0:
-        raise HTTPException(status_code=400, detail="No copies available")
+    with mutation():
+        user = get_user_or_404(data.user_id)
+        book = get_book_or_404(data.book_id)
+
+        if not user["active"]:
+            raise HTTPException(status_code=400, detail="User account is not active")
+        if book["available_copies"] <= 0:
+            raise HTTPException(status_code=400, detail="No copies available")
+
+        apply_pending_fines(data.user_id)
+
+        membership = MembershipType(user["membership_type"])
+        active_count = store.count_loans_for_user(data.user_id, "active")
+        max_allowed = get_max_loans(membership)
+
+        if active_count >= max_allowed:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Loan limit reached ({max_allowed} for {membership.value} membership)",
+            )
+
+        loan_days = get_loan_period_days(membership)
+        issue_date = datetime.now()
+        due_date = issue_date + timedelta(days=loan_days)
+
+        loan_id = _next_id("loan")
+        loan = {
+            "id": loan_id,
+            "user_id": data.user_id,
+            "book_id": data.book_id,
+            "issue_date": issue_date.isoformat(),
+            "due_date": due_date.isoformat(),
+            "status": "active",
+            "fine_applied": False,
+            "renewed": False,
+        }
+        store.insert_loan(loan)
+        store.adjust_available_copies(data.book_id, -1)
+        record_change("loan", loan_id, "created", user_id=data.user_id, book_id=data.book_id)
+        record_change("book", data.book_id, "updated")
+        fulfill_reservation_if_exists(data.user_id, data.book_id)
 
-    apply_pending_fines(data.user_id)
-
-    membership = MembershipType(user["membership_type"])
-    active_loans = get_active_loans_for_user(data.user_id)
-    max_allowed = get_max_loans(membership)
+    logger.info(
+        "Loan created: user=%d book=%d due=%s",
+        data.user_id,
+        data.book_id,
+        due_date.date(),
+    )
+    return loan
 
-    if len(active_loans) >= max_allowed:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Loan limit reached ({max_allowed} for {membership.value} membership)",
-        )
 
-    loan_days = get_loan_period_days(membership)
-    issue_date = datetime.now()
-    due_date = issue_date + timedelta(days=loan_days)
-
-    loan_id = _next_id("loan")
-    loans[loan_id] = {
-        "id": loan_id,
-        "user_id": data.user_id,
-        "book_id": data.book_id,
-        "issue_date": issue_date.isoformat(),
-        "due_date": due_date.isoformat(),
-        "status": "active",
-        "fine_applied": False,
-        "renewed": False,
-    }
-    books[data.book_id]["available_copies"] -= 1
-    fulfill_reservation_if_exists(data.user_id, data.book_id)
+@app.post("/loans/batch", status_code=201)
+def create_loans_batch(data: LoanBatchCreate):
+    """
+    Checks out several books for one user in one transaction (kiosk checkout).
+    The user, pending fines and the loan limit are handled once for the whole
+    batch, and every book is checked before anything is written, so either all
+    loans are created or none. A rejected book answers 400 with a result per book.
+    """
+    with mutation():
+        user = get_user_or_404(data.user_id)
+        if not user["active"]:
+            raise HTTPException(status_code=400, detail="User account is not active")
+
+        results = []
+        requested: Dict[int, int] = {}  # the same book may be listed more than once
+        for book_id in data.book_ids:
+            requested[book_id] = requested.get(book_id, 0) + 1
+            book = store.get_book(book_id)
+            if book is None:
+                error = "Book not found"
+            elif book["available_copies"] < requested[book_id]:
+                error = "No copies available"
+            else:
+                results.append({"book_id": book_id, "status": "valid"})
+                continue
+            results.append({"book_id": book_id, "status": "rejected", "error": error})
+        if any(result["status"] == "rejected" for result in results):
+            raise HTTPException(
+                status_code=400, detail={"message": "No loans were created", "results": results}
+            )
+
+        apply_pending_fines(data.user_id)
+
+        membership = MembershipType(user["membership_type"])
+        active_count = store.count_loans_for_user(data.user_id, "active")
+        max_allowed = get_max_loans(membership)
+        if active_count + len(data.book_ids) > max_allowed:
+            raise HTTPException(
+                status_code=400,
+                detail=(
+                    f"Loan limit reached ({max_allowed} for {membership.value} membership, "
+                    f"{active_count} active, {len(data.book_ids)} requested)"
+                ),
+            )
+
+        issue_date = datetime.now()
+        due_date = issue_date + timedelta(days=get_loan_period_days(membership))
+        first_id = store.reserve_ids("loan", len(data.book_ids))
+        results = []
+        for loan_id, book_id in enumerate(data.book_ids, first_id):
+            loan = {
+                "id": loan_id,
+                "user_id": data.user_id,
+                "book_id": book_id,
+                "issue_date": issue_date.isoformat(),
+                "due_date": due_date.isoformat(),
+                "status": "active",
+                "fine_applied": False,
+                "renewed": False,
+            }
+            store.insert_loan(loan)
+            store.adjust_available_copies(book_id, -1)
+            record_change("loan", loan_id, "created", user_id=data.user_id, book_id=book_id)
+            record_change("book", book_id, "updated")
+            fulfill_reservation_if_exists(data.user_id, book_id)
+            results.append({"book_id": book_id, "status": "created", "loan": loan})
 
     logger.info(
-        "Loan created: user=%d book=%d due=%s",
+        "Loans created: user=%d books=%s due=%s",
         data.user_id,
-        data.book_id,
+        data.book_ids,
         due_date.date(),
     )
-    return loans[loan_id]
+    return {"results": results}
+
+
+def _title_json(book: Optional[dict]) -> bytes:
+    return encode_json(book["title"] if book else "Unknown")
 
 
 @app.get("/loans/{loan_id}")
 def get_loan(loan_id: int):
-    loan = get_loan_or_404(loan_id)
-    user = users.get(loan["user_id"])
-    book = books.get(loan["book_id"])
-    current_fine = calculate_fine(loan)
-    return {
-        "loan": loan,
-        "user_name": user["name"] if user else "Unknown",
-        "book_title": book["title"] if book else "Unknown",
-        "current_fine": current_fine,
-    }
+    version = store.version("loan", loan_id)
+    loan, loan_json = _fragment("loan", get_loan_or_404(loan_id), version)
+    user = store.get_user(loan["user_id"])
+    book = store.get_book(loan["book_id"])
+    body = _raw_object(
+        loan=loan_json,
+        user_name=encode_json(user["name"] if user else "Unknown"),
+        book_title=_title_json(book),
+        current_fine=encode_json(calculate_fine(loan)),
+    )
+    return Response(body, media_type="application/json")
 
 
 @app.get("/users/{user_id}/loans")
-def get_user_loans(user_id: int):
+def get_user_loans(
+    user_id: int,
+    limit: Optional[int] = LIMIT_QUERY,
+    cursor: Optional[str] = None,
+    output_format: str = FORMAT_QUERY,
+):
+    """
+    All loans with their current fines and the total. Paged and streamed
+    responses carry per-loan fines only; total_fine needs the full history.
+    """
     get_user_or_404(user_id)
-    result = []
+    now = datetime.now()
+
+    def render(loan: dict) -> dict:
+        book = store.get_book(loan["book_id"])
+        return {
+            "loan": loan,
+            "book_title": book["title"] if book else "Unknown",
+            "fine": calculate_fine(loan, now),
+        }
+
+    page = _paginated(
+        lambda after_id, size: store.loans_for_user(user_id, None, after_id, size),
+        render,
+        limit,
+        cursor,
+        output_format,
+    )
+    if page is not None:
+        return page
+
+    # Full listing: splice cached loan JSON instead of re-encoding every record.
+    user_loans = store.loans_for_user(user_id)
+    versions = store.versions("loan", [loan["id"] for loan in user_loans])
+    items = []
     total_fine = 0.0
-    for loan in loans.values():
-        if loan["user_id"] != user_id:
-            continue
-        fine = calculate_fine(loan)
+    for loan, version in zip(user_loans, versions):
+        loan, loan_json = _fragment("loan", loan, version)
+        fine = calculate_fine(loan, now)
         total_fine += fine
-        book = books.get(loan["book_id"])
-        result.append(
-            {
-                "loan": loan,
-                "book_title": book["title"] if book else "Unknown",
-                "fine": fine,
-            }
+        items.append(
+            _raw_object(
+                loan=loan_json,
+                book_title=_title_json(store.get_book(loan["book_id"])),
+                fine=encode_json(fine),
+            )
         )
-    return {"loans": result, "total_fine": round(total_fine, 2)}
+    body = _raw_object(
+        loans=_raw_array(items), total_fine=encode_json(round(total_fine, 2))
+    )
+    return Response(body, media_type="application/json")
 
 
 @app.post("/loans/{loan_id}/return")
 def return_book(loan_id: int):
-    loan = get_loan_or_404(loan_id)
-    if loan["status"] != "active":
-        raise HTTPException(status_code=400, detail="Loan is not active")
+    with mutation():
+        loan = get_loan_or_404(loan_id)
+        if loan["status"] != "active":
+            raise HTTPException(status_code=400, detail="Loan is not active")
 
-    fine = calculate_fine(loan)
-    loan["status"] = "returned"
-    loan["return_date"] = datetime.now().isoformat()
-    loan["final_fine"] = fine
-    books[loan["book_id"]]["available_copies"] += 1
-    users[loan["user_id"]]["balance"] -= fine
+        fine = calculate_fine(loan)
+        store.update_loan(
+            loan,
+            status="returned",
+            return_date=datetime.now().isoformat(),
+            final_fine=fine,
+        )
+        store.adjust_available_copies(loan["book_id"], +1)
+        store.adjust_balance(loan["user_id"], -fine)
+        record_change(
+            "loan", loan_id, "returned", user_id=loan["user_id"], book_id=loan["book_id"]
+        )
+        record_change("book", loan["book_id"], "updated")
+        record_change("user", loan["user_id"], "updated")
 
     logger.info("Book returned: loan=%d fine=%.2f", loan_id, fine)
     return {"message": "Book returned successfully", "fine": fine}
@@ -411,55 +1041,62 @@ def return_book(loan_id: int):
 
 @app.post("/loans/{loan_id}/renew")
 def renew_loan(loan_id: int):
-    loan = get_loan_or_404(loan_id)
-    if loan["status"] != "active":
-        raise HTTPException(status_code=400, detail="Loan is not active")
-    if loan["renewed"]:
-        raise HTTPException(status_code=400, detail="Loan has already been renewed")
-
-    user = get_user_or_404(loan["user_id"])
-    membership = MembershipType(user["membership_type"])
-    extension_days = get_loan_period_days(membership)
-
-    current_due = datetime.fromisoformat(loan["due_date"])
-    loan["due_date"] = (current_due + timedelta(days=extension_days)).isoformat()
-    loan["renewed"] = True
+    with mutation():
+        loan = get_loan_or_404(loan_id)
+        if loan["status"] != "active":
+            raise HTTPException(status_code=400, detail="Loan is not active")
+        if loan["renewed"]:
+            raise HTTPException(status_code=400, detail="Loan has already been renewed")
+
+        user = get_user_or_404(loan["user_id"])
+        membership = MembershipType(user["membership_type"])
+        extension_days = get_loan_period_days(membership)
+
+        current_due = datetime.fromisoformat(loan["due_date"])
+        new_due = current_due + timedelta(days=extension_days)
+        store.update_loan(loan, due_date=new_due.isoformat(), renewed=True)
+        record_change(
+            "loan", loan_id, "renewed", user_id=loan["user_id"], book_id=loan["book_id"]
+        )
 
     return {"message": "Loan renewed successfully", "new_due_date": loan["due_date"]}
 
 
 @app.post("/reservations", status_code=201)
 def create_reservation(data: ReservationCreate):
-    get_user_or_404(data.user_id)
-    get_book_or_404(data.book_id)
-
-    already_reserved = any(
-        r["user_id"] == data.user_id
-        and r["book_id"] == data.book_id
-        and r["status"] == "active"
-        for r in reservations.values()
-    )
-    if already_reserved:
-        raise HTTPException(
-            status_code=400, detail="Book is already reserved by this user"
-        )
-
-    reservation_id = _next_id("reservation")
-    reservations[reservation_id] = {
-        "id": reservation_id,
-        "user_id": data.user_id,
-        "book_id": data.book_id,
-        "reserved_at": datetime.now().isoformat(),
-        "expires_at": (
-            datetime.now() + timedelta(days=RESERVATION_EXPIRY_DAYS)
-        ).isoformat(),
-        "status": "active",
-    }
-    return reservations[reservation_id]
+    with mutation():
+        get_user_or_404(data.user_id)
+        get_book_or_404(data.book_id)
+
+        if store.get_active_reservation(data.user_id, data.book_id) is not None:
+            raise HTTPException(
+                status_code=400, detail="Book is already reserved by this user"
+            )
+
+        reservation_id = _next_id("reservation")
+        reserved_at = datetime.now()
+        reservation = {
+            "id": reservation_id,
+            "user_id": data.user_id,
+            "book_id": data.book_id,
+            "reserved_at": reserved_at.isoformat(),
+            "expires_at": (
+                reserved_at + timedelta(days=RESERVATION_EXPIRY_DAYS)
+            ).isoformat(),
+            "status": "active",
+        }
+        store.insert_reservation(reservation)
+        record_change("reservation", reservation_id, "created", user_id=data.user_id)
+    return reservation
 
 
 @app.get("/reservations/{user_id}")
-def get_user_reservations(user_id: int):
+def get_user_reservations(
+    user_id: int,
+    limit: Optional[int] = LIMIT_QUERY,
+    cursor: Optional[str] = None,
+    output_format: str = FORMAT_QUERY,
+):
     """
     REFACTORING 7: Separate Query from Modifier
     Side effects (expiration) are separated from reading reservations.
@@ -467,60 +1104,310 @@ def get_user_reservations(user_id: int):
     get_user_or_404(user_id)
     expire_stale_reservations()  # Explicit call, not hidden side effect
 
-    result = []
-    for reservation in reservations.values():
-        if reservation["user_id"] != user_id:
-            continue
-        book = books.get(reservation["book_id"])
-        result.append(
-            {
-                "reservation": reservation,
-                "book_title": book["title"] if book else "Unknown",
-            }
-        )
-    return result
+    def render(reservation: dict) -> dict:
+        book = store.get_book(reservation["book_id"])
+        return {
+            "reservation": reservation,
+            "book_title": book["title"] if book else "Unknown",
+        }
+
+    page = _paginated(
+        lambda after_id, size: store.reservations_for_user(user_id, after_id, size),
+        render,
+        limit,
+        cursor,
+        output_format,
+    )
+    if page is not None:
+        return page
+    return [render(reservation) for reservation in store.reservations_for_user(user_id)]
 
 
 @app.get("/statistics")
-def get_statistics():
+def get_statistics(request: Request):
     """
-    REFACTORING 5 + 10: Extract Method + Inline Temp
-    Statistics computation split into clear named sections. Removed hardcoded genre list.
+    Statistics change with any mutation and, through accrued fines, with the
+    clock, so they are cached per store version until the next fine tick.
     """
-    overdue_loans = [
-        loan
-        for loan in loans.values()
-        if loan["status"] == "active" and calculate_fine(loan) > 0
-    ]
-    total_outstanding_fines = sum(calculate_fine(loan) for loan in overdue_loans)
-
-    # REFACTORING 10: Derive genre stats from actual data instead of hardcoded list
-    genre_stats: Dict[str, int] = {}
-    for book in books.values():
-        genre = book["genre"].lower()
-        genre_stats[genre] = genre_stats.get(genre, 0) + 1
-
-    loan_counts_by_book = {}
-    for loan in loans.values():
-        loan_counts_by_book[loan["book_id"]] = (
-            loan_counts_by_book.get(loan["book_id"], 0) + 1
-        )
+    version = store.version("store")
+    now_ts = to_timestamp(datetime.now())
+    return _conditional_json(
+        request,
+        ("statistics", 0, version),
+        lambda: _statistics_payload(now_ts),
+        now_ts=now_ts,
+    )
 
-    most_popular_book = None
-    if loan_counts_by_book:
-        top_book_id = max(loan_counts_by_book, key=lambda bid: loan_counts_by_book[bid])
-        most_popular_book = (
-            books[top_book_id]["title"] if top_book_id in books else None
-        )
 
-    return {
+def _statistics_payload(now_ts: float) -> Tuple[dict, float]:
+    """
+    REFACTORING 5 + 10: Extract Method + Inline Temp
+    Counters, genre histogram and the most popular book are maintained by the
+    store; overdue figures only touch loans that are already overdue.
+    Also returns when the overdue figures next change without a mutation:
+    a loan not yet overdue accrues its first fine a full day after its due date.
+    """
+    total_outstanding_fines = 0.0
+    overdue_count = 0
+    valid_until = now_ts + SECONDS_PER_DAY
+    for _, due_ts in store.overdue_loans(now_ts):
+        fine = fine_for_due(due_ts, now_ts)
+        if fine > 0:
+            overdue_count += 1
+            total_outstanding_fines += fine
+        next_fine_ts = due_ts + ((now_ts - due_ts) // SECONDS_PER_DAY + 1) * SECONDS_PER_DAY
+        valid_until = min(valid_until, next_fine_ts)
+
+    top_book_id = store.most_popular_book_id()
+    top_book = store.get_book(top_book_id) if top_book_id is not None else None
+    status_counts = store.loan_status_counts()
+
+    payload = {
         "total_books": len(books),
         "total_users": len(users),
         "total_loans": len(loans),
-        "active_loans": sum(1 for l in loans.values() if l["status"] == "active"),
-        "returned_loans": sum(1 for l in loans.values() if l["status"] == "returned"),
-        "overdue_loans": len(overdue_loans),
+        "active_loans": status_counts.get("active", 0),
+        "returned_loans": status_counts.get("returned", 0),
+        "overdue_loans": overdue_count,
         "total_outstanding_fines": round(total_outstanding_fines, 2),
-        "genre_stats": genre_stats,
-        "most_popular_book": most_popular_book,
+        "genre_stats": store.genre_stats(),
+        "most_popular_book": top_book["title"] if top_book else None,
     }
+    return payload, valid_until
+
+
+# --- Change Feed ---
+
+CHANGES_LIMIT_QUERY = Query(DEFAULT_PAGE_SIZE, ge=1, le=CHANGES_PAGE_MAX)
+SINCE_QUERY = Query(0, ge=0)
+
+
+def _changes_gone(exc: ChangesExpired) -> HTTPException:
+    return HTTPException(
+        status_code=410,
+        detail={
+            "message": "Changes are no longer available; resynchronize and resume from last_seq",
+            "epoch": change_feed.epoch,
+            "oldest_seq": exc.oldest_seq,
+            "last_seq": exc.last_seq,
+        },
+    )
+
+
+def _check_epoch(epoch: Optional[str], since: int) -> None:
+    if epoch is not None and epoch != change_feed.epoch:
+        raise _changes_gone(ChangesExpired(since, change_feed.oldest_seq, change_feed.last_seq))
+
+
+@app.get("/changes")
+async def get_changes(
+    since: int = SINCE_QUERY,
+    limit: int = CHANGES_LIMIT_QUERY,
+    wait: float = Query(30.0, ge=0, le=CHANGES_MAX_WAIT_SECONDS),
+    epoch: Optional[str] = None,
+):
+    """
+    Long-poll for mutations: changes with seq > `since`, oldest first, waiting
+    up to `wait` seconds for the first one. Resume with since=next_since and
+    the returned epoch; 410 means the position was evicted or belongs to
+    another epoch.
+    """
+    _check_epoch(epoch, since)
+    try:
+        changes = change_feed.read(since, limit)
+        if not changes and wait > 0 and await change_feed.wait(since, wait):
+            changes = change_feed.read(since, limit)
+    except ChangesExpired as exc:
+        raise _changes_gone(exc) from None
+    return {
+        "epoch": change_feed.epoch,
+        "changes": [change.to_dict() for change in changes],
+        "next_since": changes[-1].seq if changes else since,
+        "last_seq": change_feed.last_seq,
+    }
+
+
+def _parse_last_event_id(value: str) -> Tuple[Optional[str], int]:
+    """SSE ids are "<epoch>-<seq>" so a reconnecting client resumes in the right feed."""
+    epoch, _, seq = value.rpartition("-")
+    try:
+        return epoch or None, int(seq)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Last-Event-ID") from None
+
+
+@app.get("/changes/stream")
+async def stream_changes(
+    since: int = SINCE_QUERY,
+    epoch: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None),
+):
+    """
+    Server-Sent Events stream of the change feed: one "change" event per
+    mutation, a comment every SSE_KEEPALIVE_SECONDS while idle, and a final
+    "reset" event if the client falls out of the ring buffer.
+    """
+    if last_event_id:
+        epoch, since = _parse_last_event_id(last_event_id)
+    _check_epoch(epoch, since)
+    feed_epoch = change_feed.epoch
+
+    async def events() -> AsyncIterator[bytes]:
+        position = since
+        while True:
+            try:
+                changes = change_feed.read(position, CHANGES_PAGE_MAX)
+            except ChangesExpired as exc:
+                yield format_sse("reset", encode_json(_changes_gone(exc).detail).decode())
+                return
+            for change in changes:
+                data = encode_json(change.to_dict()).decode()
+                yield format_sse("change", data, f"{feed_epoch}-{change.seq}")
+            if changes:
+                position = changes[-1].seq
+            elif not await change_feed.wait(position, SSE_KEEPALIVE_SECONDS):
+                yield b": keep-alive\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# --- Admin ---
+
+
+def admin_token_matches(token: Optional[str]) -> bool:
+    return bool(ADMIN_TOKEN) and hmac.compare_digest((token or "").encode(), ADMIN_TOKEN.encode())
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled")
+    if not admin_token_matches(x_admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+def _publish_charged_fines(marked: List[Tuple[int, int, int]]) -> None:
+    charged_users = dict.fromkeys(user_id for _, user_id, _ in marked)
+    change_feed.publish(
+        [
+            ("loan", loan_id, "fined", {"user_id": user_id, "book_id": book_id})
+            for loan_id, user_id, book_id in marked
+        ]
+        + [("user", user_id, "updated", {}) for user_id in charged_users]
+    )
+
+
+@app.post("/admin/fines/apply", dependencies=[Depends(require_admin)])
+def apply_all_fines():
+    """
+    Batch counterpart of apply_pending_fines for users who never come back:
+    charges every pending overdue fine in one sweep (see fines.py).
+    """
+    report = apply_overdue_fines(store, FINE_PER_DAY, on_charged=_publish_charged_fines)
+    logger.info(
+        "Fine sweep: %d loan(s) charged across %d user(s), total %.2f",
+        report["charged_loans"],
+        report["charged_users"],
+        report["total_charged"],
+    )
+    return report
+
+
+@app.post("/admin/snapshot", dependencies=[Depends(require_admin)])
+def take_snapshot():
+    """Snapshots a journaled in-memory store now, truncating its journal."""
+    if not isinstance(store, JournaledStore):
+        raise HTTPException(status_code=409, detail="Store is not journaled")
+    return store.snapshot()
+
+
+@app.get("/admin/profiles", dependencies=[Depends(require_admin)])
+def list_request_profiles():
+    """Requests profiled via X-Debug-Profile (LIBRARY_PROFILE_REQUESTS=1), newest first."""
+    return [profile.summary() for profile in request_profiles.recent()]
+
+
+@app.get("/admin/profiles/{request_id}", dependencies=[Depends(require_admin)])
+def get_request_profile(
+    request_id: str,
+    output_format: str = Query("text", alias="format", pattern="^(text|pstats)$"),
+    limit: int = Query(40, ge=1, le=1000),
+):
+    """The pstats table of one profiled request, or its .prof file with format=pstats."""
+    profile = request_profiles.get(request_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if output_format == "pstats":
+        return Response(
+            dump_stats(profile.stats),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": 'attachment; filename="request.prof"'},
+        )
+    header = f"{profile.method} {profile.path} -> {profile.status} in {profile.seconds:.6f}s\n\n"
+    return Response(header + format_stats(profile.stats, limit), media_type="text/plain")
+
+
+@app.get("/debug/profile", dependencies=[Depends(require_admin)])
+async def sample_process_profile(
+    seconds: float = Query(10.0, gt=0, le=SAMPLING_MAX_SECONDS),
+    hz: float = Query(100.0, gt=0, le=SAMPLING_MAX_HZ),
+    idle: bool = False,
+    lines: bool = False,
+):
+    """
+    Samples every thread's stack for `seconds` and returns collapsed stacks
+    ("thread;outer;...;inner count" per line) for flamegraph tools. The event
+    loop keeps serving requests meanwhile, so the profile shows real load.
+    Blocked threads are skipped unless idle=true; lines=true adds line numbers.
+    """
+    if not sampling_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A profile is already being sampled")
+    try:
+        sampler = StackSampler(hz, include_idle=idle, line_numbers=lines)
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            counts = sampler.stop()
+    finally:
+        sampling_lock.release()
+    return Response(
+        collapse_stacks(counts),
+        media_type="text/plain",
+        headers={"X-Profile-Samples": str(sampler.samples)},
+    )
+
+
+# --- Metrics ---
+
+
+def _store_gauges() -> List[Tuple[str, str, float]]:
+    """Collection sizes and loan states; overdue matches /statistics (fine > 0)."""
+    now_ts = to_timestamp(datetime.now())
+    status_counts = store.loan_status_counts()
+    return [
+        ("books", "Books in the catalogue.", len(books)),
+        ("users", "Registered users.", len(users)),
+        ("loans", "Loans ever created.", len(loans)),
+        ("reservations", "Reservations ever created.", len(reservations)),
+        ("loans_active", "Loans not yet returned.", status_counts.get("active", 0)),
+        (
+            "loans_overdue",
+            "Active loans accruing a fine.",
+            len(store.overdue_loans(now_ts - SECONDS_PER_DAY)),
+        ),
+    ]
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """
+    Prometheus scrape target. Declared async so rendering runs on the event
+    loop thread that records the request metrics; the store is read in the
+    threadpool as usual.
+    """
+    gauges = await run_in_threadpool(_store_gauges)
+    return Response(request_metrics.render(gauges), media_type=PROMETHEUS_CONTENT_TYPE)
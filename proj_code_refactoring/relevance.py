@@ -0,0 +1,364 @@
+"""
+Library Management System - Relevance Ranking
+BM25 ranking of books over title and author with typo-tolerant term
+matching, for the ranked mode of /books/search.
+
+* Tokens      - lowercased runs of letters and digits.
+* Index       - per field, term -> postings packed as (book_id << 8 | tf);
+                a term in a single book is stored as one int, the rest as
+                array('q'). Field lengths and genre codes are arrays indexed
+                by book id. Books are added one at a time (add), so the
+                stores keep the index current as books arrive.
+* Fuzzy terms - query words of FUZZY_MIN_LENGTH+ letters also match
+                vocabulary words with a trigram similarity (as in pg_trgm)
+                of at least FUZZY_THRESHOLD, found through a trigram index
+                over the vocabulary; a fuzzy match scores its BM25 weight
+                times the similarity, so "poter" finds "potter" below an
+                exact match.
+* Scoring     - per field BM25 (k1, b), title and author weighted. A query
+                word counts once per book: its best-scoring variant, all of
+                its variants sharing the idf of the most common one.
+
+Scores are computed with NumPy when it is installed (one vectorized pass per
+posting list); otherwise a pure Python loop gives the same ranking.
+"""
+
+from array import array
+from typing import Dict, List, Optional, Set, Tuple, Union
+import math
+import re
+
+try:
+    import numpy as np
+except ImportError:  # optional, see RelevanceIndex.search
+    np = None
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+FIELD_WEIGHTS = {"title": 1.0, "author": 0.6}
+FUZZY_THRESHOLD = 0.3  # pg_trgm's default similarity_threshold
+FUZZY_MIN_LENGTH = 4
+FUZZY_MAX_VARIANTS = 4  # similar vocabulary words tried per query word, best first
+
+_TOKEN = re.compile(r"[^\W_]+")
+_TF_BITS = 8
+_TF_MAX = (1 << _TF_BITS) - 1
+
+Postings = Union[int, "array[int]"]
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text.lower())
+
+
+def trigrams(word: str) -> Set[str]:
+    """Trigrams of a word padded like pg_trgm: two spaces before, one after."""
+    padded = f"  {word} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def _fuzzy_eligible(word: str) -> bool:
+    return len(word) >= FUZZY_MIN_LENGTH and word.isalpha()
+
+
+class _Field:
+    """Postings and per-book lengths of one text field."""
+
+    def __init__(self, weight: float) -> None:
+        self.weight = weight
+        self.postings: Dict[str, Postings] = {}
+        self.lengths = array("H")  # indexed by book id
+        self.total_length = 0
+
+    def add(self, book_id: int, tokens: List[str]) -> None:
+        counts: Dict[str, int] = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for term, tf in counts.items():
+            packed = book_id << _TF_BITS | min(tf, _TF_MAX)
+            current = self.postings.get(term)
+            if current is None:
+                self.postings[term] = packed
+            elif isinstance(current, int):
+                self.postings[term] = array("q", (current, packed))
+            else:
+                current.append(packed)
+        length = min(len(tokens), 0xFFFF)
+        self.lengths[book_id] = length
+        self.total_length += length
+
+
+class RelevanceIndex:
+    """
+    Incremental BM25 index. Not thread-safe: callers serialize every add()
+    and search() (searches share scratch arrays).
+    """
+
+    def __init__(self) -> None:
+        self.fields = {name: _Field(weight) for name, weight in FIELD_WEIGHTS.items()}
+        self.genre_codes = array("H")  # book id -> genre code, 0 = no such book
+        self._genres: Dict[str, int] = {}
+        self.books = 0
+        self.max_id = 0
+        self._word_grams: Dict[str, Set[str]] = {}  # trigram -> vocabulary words
+        self._vocabulary: Set[str] = set()
+        self._scratch: Dict[str, "np.ndarray"] = {}  # see _scratch_arrays
+
+    def __contains__(self, book_id: int) -> bool:
+        return 0 < book_id < len(self.genre_codes) and self.genre_codes[book_id] != 0
+
+    def add(self, book_id: int, title: str, author: str, genre: str) -> None:
+        if book_id in self:
+            return
+        self._grow(book_id)
+        for name, text in (("title", title), ("author", author)):
+            tokens = tokenize(text)
+            self.fields[name].add(book_id, tokens)
+            for word in tokens:
+                if word not in self._vocabulary:
+                    self._vocabulary.add(word)
+                    if _fuzzy_eligible(word):
+                        for gram in trigrams(word):
+                            self._word_grams.setdefault(gram, set()).add(word)
+        genre = genre.lower()
+        code = self._genres.get(genre)
+        if code is None:
+            code = self._genres[genre] = len(self._genres) + 1
+        self.genre_codes[book_id] = code
+        self.books += 1
+        self.max_id = max(self.max_id, book_id)
+
+    def _grow(self, book_id: int) -> None:
+        missing = book_id + 1 - len(self.genre_codes)
+        if missing > 0:
+            grow = max(missing, len(self.genre_codes) // 2)  # amortized doubling
+            zeros = array("H", bytes(2 * grow))
+            self.genre_codes.extend(zeros)
+            for field in self.fields.values():
+                field.lengths.extend(zeros)
+
+    def clear(self) -> None:
+        for name, weight in FIELD_WEIGHTS.items():
+            self.fields[name] = _Field(weight)
+        self.genre_codes = array("H")
+        self._genres.clear()
+        self.books = 0
+        self.max_id = 0
+        self._word_grams.clear()
+        self._vocabulary.clear()
+        self._scratch = {}
+
+    # Query terms
+
+    def variants(self, word: str) -> List[Tuple[str, float]]:
+        """Vocabulary words matching `word`, with their similarity, best first."""
+        exact = [(word, 1.0)] if word in self._vocabulary else []
+        if not _fuzzy_eligible(word):
+            return exact
+        grams = trigrams(word)
+        shared: Dict[str, int] = {}
+        for gram in grams:
+            for candidate in self._word_grams.get(gram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        similar = []
+        for candidate, common in shared.items():
+            if candidate == word:
+                continue
+            # |A ∩ B| / |A ∪ B|; a padded word of n letters has at most n + 1 trigrams
+            similarity = common / (len(grams) + len(trigrams(candidate)) - common)
+            if similarity >= FUZZY_THRESHOLD:
+                similar.append((candidate, similarity))
+        similar.sort(key=lambda item: (-item[1], item[0]))
+        return (exact + similar)[:FUZZY_MAX_VARIANTS]
+
+    # Search
+
+    def search(
+        self,
+        q: str,
+        limit: int,
+        genre: str = "",
+        restrict: Optional[Set[int]] = None,
+        use_numpy: Optional[bool] = None,
+    ) -> List[Tuple[int, float]]:
+        """
+        Top `limit` (book_id, score) pairs for `q`, best first, ties by id.
+        `genre` (exact, case-insensitive) and `restrict` (allowed ids) filter.
+        """
+        words = list(dict.fromkeys(tokenize(q)))
+        if not words or limit <= 0 or not self.books:
+            return []
+        genre_code = None
+        if genre:
+            genre_code = self._genres.get(genre.lower())
+            if genre_code is None:
+                return []
+        terms = [variants for variants in map(self.variants, words) if variants]
+        if not terms:
+            return []
+        if use_numpy is None:
+            use_numpy = np is not None
+        if not use_numpy:
+            return self._search_python(terms, limit, genre_code, restrict)
+        try:
+            return self._search_numpy(terms, limit, genre_code, restrict)
+        except BaseException:
+            self._scratch = {}  # may be left partly written
+            raise
+
+    def _idf(self, term: str) -> float:
+        """
+        BM25 idf from the number of books containing `term` in any field,
+        approximated by the larger per-field count (exact unless a term is
+        common in both titles and authors).
+        """
+        df = 0
+        for field in self.fields.values():
+            postings = field.postings.get(term)
+            if postings is not None:
+                df = max(df, 1 if isinstance(postings, int) else len(postings))
+        return math.log(1 + (self.books - df + 0.5) / (df + 0.5))
+
+    def _word_idf(self, variants: List[Tuple[str, float]]) -> float:
+        # Blended: every variant of a query word gets the idf of its most common
+        # variant, so a rare near-miss cannot outscore the word that was typed.
+        return min(self._idf(term) for term, _ in variants)
+
+    # Both implementations add the same terms in the same order, so they
+    # produce identical scores and therefore identical rankings.
+
+    def _search_python(self, terms, limit, genre_code, restrict) -> List[Tuple[int, float]]:
+        scores: Dict[int, float] = {}
+        for variants in terms:
+            direct = len(variants) == 1
+            best = scores if direct else {}
+            idf = self._word_idf(variants)
+            for term, similarity in variants:
+                variant = best if direct else {}
+                for field in self.fields.values():
+                    postings = field.postings.get(term)
+                    if postings is None:
+                        continue
+                    avg_length = field.total_length / self.books or 1.0
+                    weight = field.weight * similarity * idf
+                    for packed in (postings,) if isinstance(postings, int) else postings:
+                        book_id, tf = packed >> _TF_BITS, packed & _TF_MAX
+                        norm = BM25_K1 * (1 - BM25_B + BM25_B * field.lengths[book_id] / avg_length)
+                        score = weight * tf * (BM25_K1 + 1) / (tf + norm)
+                        variant[book_id] = variant.get(book_id, 0.0) + score
+                if not direct:
+                    for book_id, score in variant.items():
+                        if score > best.get(book_id, 0.0):
+                            best[book_id] = score
+            if not direct:
+                for book_id, score in best.items():
+                    scores[book_id] = scores.get(book_id, 0.0) + score
+        ranked = [
+            (book_id, score)
+            for book_id, score in scores.items()
+            if (genre_code is None or self.genre_codes[book_id] == genre_code)
+            and (restrict is None or book_id in restrict)
+        ]
+        ranked.sort(key=lambda item: (-item[1], item[0]))
+        return ranked[:limit]
+
+    def _scratch_arrays(self, size: int) -> Dict[str, "np.ndarray"]:
+        """
+        Per-book arrays reused by every NumPy search, grown with the catalogue.
+        They are all zero/False between searches: a search resets exactly the
+        ids it touched.
+        """
+        if len(self._scratch.get("scores", ())) < size:
+            size = max(size, 2 * len(self._scratch.get("scores", ())))
+            self._scratch = {
+                "scores": np.zeros(size, dtype=np.float64),
+                "best": np.zeros(size, dtype=np.float64),
+                "variant": np.zeros(size, dtype=np.float64),
+                "allowed": np.zeros(size, dtype=bool),
+                "seen": np.zeros(size, dtype=bool),
+            }
+        return self._scratch
+
+    def _search_numpy(self, terms, limit, genre_code, restrict) -> List[Tuple[int, float]]:
+        # Every step is proportional to the posting lists involved (plus the
+        # size of `restrict`), never to the catalogue: filters are gathered
+        # per posting list and the scratch arrays are touched only at the ids
+        # those lists contain.
+        size = self.max_id + 1
+        scratch = self._scratch_arrays(size)
+        scores, allowed, seen = scratch["scores"], scratch["allowed"], scratch["seen"]
+        genre_codes = np.frombuffer(self.genre_codes, dtype=np.uint16, count=size)
+        wanted = None
+        if restrict is not None:
+            wanted = np.fromiter(restrict, dtype=np.int64, count=len(restrict))
+            wanted = wanted[(wanted > 0) & (wanted < size)]
+            allowed[wanted] = True
+
+        candidates = []  # each touched id once, collected as posting lists are read
+        for variants in terms:
+            direct = len(variants) == 1
+            best = scores if direct else scratch["best"]
+            idf = self._word_idf(variants)
+            touched = []
+            for term, similarity in variants:
+                variant = best if direct else scratch["variant"]
+                hits = []
+                for field in self.fields.values():
+                    postings = field.postings.get(term)
+                    if postings is None:
+                        continue
+                    if isinstance(postings, int):
+                        packed = np.array([postings], dtype=np.int64)
+                    else:
+                        packed = np.frombuffer(postings, dtype=np.int64)
+                    ids = packed >> _TF_BITS
+                    if genre_code is not None or wanted is not None:
+                        mask = np.ones(len(ids), dtype=bool)
+                        if genre_code is not None:
+                            mask &= genre_codes[ids] == genre_code
+                        if wanted is not None:
+                            mask &= allowed[ids]
+                        packed, ids = packed[mask], ids[mask]
+                    tf = (packed & _TF_MAX).astype(np.float64)
+                    lengths = np.frombuffer(field.lengths, dtype=np.uint16, count=size)[ids]
+                    avg_length = field.total_length / self.books or 1.0
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / avg_length)
+                    weight = field.weight * similarity * idf
+                    variant[ids] += weight * tf * (BM25_K1 + 1) / (tf + norm)
+                    hits.append(ids)
+                    new = ids[~seen[ids]]
+                    seen[new] = True
+                    candidates.append(new)
+                if not direct:
+                    for ids in hits:  # max is idempotent, so overlaps are harmless
+                        best[ids] = np.maximum(best[ids], variant[ids])
+                    for ids in hits:
+                        variant[ids] = 0.0
+                    touched.extend(hits)
+            for ids in touched:  # zeroed once added, so each book counts once
+                scores[ids] += best[ids]
+                best[ids] = 0.0
+        if wanted is not None:
+            allowed[wanted] = False
+        if not candidates:
+            return []
+        ids = np.concatenate(candidates)
+        seen[ids] = False
+        found = scores[ids]
+        scores[ids] = 0.0
+        return _top(ids, found, limit)
+
+
+def _top(ids, scores, limit: int) -> List[Tuple[int, float]]:
+    """Best `limit` of `ids` by score, ties by lowest id, without a full sort."""
+    if len(ids) > limit:
+        kth = np.partition(scores, len(scores) - limit)[len(scores) - limit]
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)
+        room = limit - len(above)  # at least 1: kth is the limit-th best score
+        if len(ties) > room:
+            ties = ties[np.argpartition(ids[ties], room - 1)[:room]]
+        chosen = np.concatenate((above, ties))
+        ids, scores = ids[chosen], scores[chosen]
+    order = np.lexsort((ids, -scores))
+    return [(int(ids[i]), float(scores[i])) for i in order]
@@ -0,0 +1,90 @@
+"""
+Library Management System - Multi-Worker Launcher
+Runs refactored_code:app under several uvicorn worker processes.
+Workers share state through one SQLite file (see storage.SQLiteStore), so
+in-memory storage is only allowed with a single worker.
+
+Run: python serve.py --workers 4 --db library.db
+"""
+
+import argparse
+import os
+import socket
+from typing import List, Optional
+
+import uvicorn
+from uvicorn.supervisors import Multiprocess
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Run the library API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("LIBRARY_WORKERS", "1")),
+        help="number of worker processes (default: LIBRARY_WORKERS or 1)",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=("memory", "sqlite"),
+        default=os.environ.get("LIBRARY_STORAGE"),
+        help="storage backend; defaults to sqlite when --workers > 1",
+    )
+    parser.add_argument(
+        "--db",
+        default=os.environ.get("LIBRARY_SQLITE_PATH", "library.db"),
+        help="SQLite file shared by all workers",
+    )
+    parser.add_argument("--log-level", default="warning")
+    return parser
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    """
+    Listening socket shared by the workers.
+    uvicorn's own one is created with proto=0, which makes asyncio skip
+    TCP_NODELAY on accepted connections; every keep-alive response then
+    stalls ~40 ms on delayed ACKs. Binding with IPPROTO_TCP avoids that.
+    """
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    storage = args.storage or ("sqlite" if args.workers > 1 else "memory")
+    if storage == "memory" and args.workers > 1:
+        parser.error("in-memory storage cannot be shared; use --storage sqlite with --workers > 1")
+
+    # Worker processes import refactored_code themselves and read these.
+    os.environ["LIBRARY_STORAGE"] = storage
+    os.environ["LIBRARY_SQLITE_PATH"] = os.path.abspath(args.db)
+    if storage == "sqlite":
+        # Create the schema once up front instead of racing in every worker.
+        from storage import SQLiteStore
+
+        SQLiteStore(os.environ["LIBRARY_SQLITE_PATH"]).close()
+
+    config = uvicorn.Config(
+        "refactored_code:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        log_level=args.log_level,
+    )
+    if args.workers == 1:
+        uvicorn.Server(config).run()
+    else:
+        Multiprocess(config, sockets=[bind_socket(args.host, args.port)]).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2018 @@
+"""
+Library Management System - Storage Backends
+The route handlers in refactored_code.py talk to a LibraryStore instead of
+module-level dicts. Two implementations are provided:
+
+* InMemoryStore - the original dicts plus incrementally maintained indexes.
+* SQLiteStore   - a WAL-mode SQLite database with per-thread connections,
+                  suitable for data sets larger than RAM.
+
+Select one with LIBRARY_STORAGE=memory|sqlite (see create_store).
+"""
+
+from abc import ABC, abstractmethod
+from array import array
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Optional, List, Dict, Iterator, Set, Tuple
+import bisect
+import heapq
+import os
+import sqlite3
+import threading
+import uuid
+
+try:
+    import numpy as np
+except ImportError:  # optional, see FacetIndex.counts
+    np = None
+
+from relevance import RelevanceIndex
+
+ID_KINDS = ("book", "user", "loan", "reservation")
+# Change counters: per book, user and loan, and one for the store as a whole
+VERSION_KINDS = ("book", "user", "loan", "store")
+
+
+# --- Time Helpers ---
+
+_EPOCH = datetime(1970, 1, 1)
+SECONDS_PER_DAY = 86400
+# Popularity rankings slide in hourly steps; window name -> number of buckets
+POPULARITY_BUCKET_SECONDS = 3600
+POPULARITY_WINDOWS = {"1d": 24, "7d": 7 * 24, "30d": 30 * 24}
+# Book fields search results can be faceted on; genres are counted lowercased
+FACET_FIELDS = ("genre", "author", "year")
+
+
+def to_timestamp(moment: datetime) -> float:
+    """Naive wall-clock seconds, so differences match naive datetime arithmetic."""
+    return (moment - _EPOCH).total_seconds()
+
+
+def iso_to_timestamp(value: str) -> float:
+    return to_timestamp(datetime.fromisoformat(value))
+
+
+def timestamp_to_iso(ts: float) -> str:
+    # timedelta rounds to the nearest microsecond, so ISO -> ts -> ISO is exact.
+    return (_EPOCH + timedelta(seconds=ts)).isoformat()
+
+
+def popularity_cutoff(now_ts: float, window: str) -> float:
+    """Start of `window`: the first of its buckets, the last one being the current bucket."""
+    bucket = int(now_ts // POPULARITY_BUCKET_SECONDS)
+    return float((bucket - POPULARITY_WINDOWS[window] + 1) * POPULARITY_BUCKET_SECONDS)
+
+
+# --- Compact Records ---
+
+
+class _Record(MutableMapping):
+    """
+    Base for __slots__ records that still behave like the original dicts
+    (record["field"], .get, .update, dict(record)), so helpers, tests and
+    FastAPI's encoder see the same shape. Subclasses list their public keys in
+    _KEYS; keys in _OPTIONAL are hidden while unset, as they were absent from
+    the original dicts.
+    """
+
+    __slots__ = ()
+    _KEYS: Tuple[str, ...] = ()
+    _OPTIONAL: Tuple[str, ...] = ()
+
+    def __getitem__(self, key: str):
+        if key not in self._KEYS:
+            raise KeyError(key)
+        value = self._get(key)
+        if value is None and key in self._OPTIONAL:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value) -> None:
+        if key not in self._KEYS:
+            raise KeyError(key)
+        self._set(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        raise TypeError(f"{type(self).__name__} fields cannot be deleted")
+
+    def __iter__(self) -> Iterator[str]:
+        return (key for key in self._KEYS if key not in self._OPTIONAL or self._get(key) is not None)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def _get(self, key: str):
+        return getattr(self, key)
+
+    def _set(self, key: str, value) -> None:
+        setattr(self, key, value)
+
+    def to_dict(self) -> dict:
+        """The record in its API response shape."""
+        return {key: self[key] for key in self}
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class BookRecord(_Record):
+    __slots__ = ("id", "title", "author", "isbn", "genre", "year", "copies", "available_copies")
+    _KEYS = __slots__
+
+    def __init__(self, id, title, author, isbn, genre, year, copies, available_copies):
+        self.id = id
+        self.title = title
+        self.author = author
+        self.isbn = isbn
+        self.genre = genre
+        self.year = year
+        self.copies = copies
+        self.available_copies = available_copies
+
+    @classmethod
+    def from_dict(cls, book: dict) -> "BookRecord":
+        return cls(*(book[key] for key in cls._KEYS))
+
+
+LOAN_STATUSES = ("active", "returned")
+_LOAN_STATUS_CODES = {status: code for code, status in enumerate(LOAN_STATUSES)}
+
+
+class LoanRecord(_Record):
+    """
+    Loan with int ids, naive epoch-second dates and a small-int status code;
+    the ISO strings and status names of the API shape are produced on access.
+    """
+
+    __slots__ = (
+        "id", "user_id", "book_id", "issue_ts", "due_ts", "status_code",
+        "fine_applied", "renewed", "return_ts", "final_fine",
+    )
+    _KEYS = (
+        "id", "user_id", "book_id", "issue_date", "due_date", "status",
+        "fine_applied", "renewed", "return_date", "final_fine",
+    )
+    _OPTIONAL = ("return_date", "final_fine")
+    _DATE_SLOTS = {"issue_date": "issue_ts", "due_date": "due_ts", "return_date": "return_ts"}
+
+    def __init__(self, id, user_id, book_id, issue_ts, due_ts, status_code,
+                 fine_applied=False, renewed=False, return_ts=None, final_fine=None):
+        self.id = id
+        self.user_id = user_id
+        self.book_id = book_id
+        self.issue_ts = issue_ts
+        self.due_ts = due_ts
+        self.status_code = status_code
+        self.fine_applied = fine_applied
+        self.renewed = renewed
+        self.return_ts = return_ts
+        self.final_fine = final_fine
+
+    @classmethod
+    def from_dict(cls, loan: dict) -> "LoanRecord":
+        return_date = loan.get("return_date")
+        return cls(
+            loan["id"],
+            loan["user_id"],
+            loan["book_id"],
+            iso_to_timestamp(loan["issue_date"]),
+            iso_to_timestamp(loan["due_date"]),
+            _LOAN_STATUS_CODES[loan["status"]],
+            bool(loan["fine_applied"]),
+            bool(loan["renewed"]),
+            None if return_date is None else iso_to_timestamp(return_date),
+            loan.get("final_fine"),
+        )
+
+    @property
+    def status(self) -> str:
+        return LOAN_STATUSES[self.status_code]
+
+    def _get(self, key: str):
+        if key == "status":
+            return LOAN_STATUSES[self.status_code]
+        slot = self._DATE_SLOTS.get(key)
+        if slot is not None:
+            ts = getattr(self, slot)
+            return None if ts is None else timestamp_to_iso(ts)
+        return getattr(self, key)
+
+    def _set(self, key: str, value) -> None:
+        if key == "status":
+            self.status_code = _LOAN_STATUS_CODES[value]
+            return
+        slot = self._DATE_SLOTS.get(key)
+        if slot is not None:
+            setattr(self, slot, None if value is None else iso_to_timestamp(value))
+            return
+        setattr(self, key, value)
+
+
+# --- Secondary Indexes ---
+
+
+class StatusIndex:
+    """
+    Maps a key (user_id or book_id) to record ids, split by record status.
+    Keeps per-request cost proportional to one user's/book's loans or
+    reservations instead of the whole history.
+    """
+
+    def __init__(self) -> None:
+        self._all: Dict[int, List[int]] = {}
+        self._by_status: Dict[int, Dict[str, Dict[int, None]]] = {}
+
+    def add(self, key: int, loan_id: int, status: str) -> None:
+        self._all.setdefault(key, []).append(loan_id)
+        self._by_status.setdefault(key, {}).setdefault(status, {})[loan_id] = None
+
+    def move(self, key: int, loan_id: int, old_status: str, new_status: str) -> None:
+        buckets = self._by_status.setdefault(key, {})
+        buckets.get(old_status, {}).pop(loan_id, None)
+        buckets.setdefault(new_status, {})[loan_id] = None
+
+    def ids(
+        self,
+        key: int,
+        status: Optional[str] = None,
+        after_id: int = 0,
+        limit: Optional[int] = None,
+    ) -> Iterator[int]:
+        """
+        Record ids for a key in creation order, optionally filtered by status.
+        `after_id`/`limit` select one keyset page: ids are appended in
+        increasing order, so the page start is a bisect into the full list.
+        """
+        if not after_id and limit is None:
+            if status is None:
+                return iter(self._all.get(key, ()))
+            return iter(self._by_status.get(key, {}).get(status, ()))
+        all_ids = self._all.get(key, [])
+        tail = islice(all_ids, bisect.bisect_right(all_ids, after_id), None)
+        if status is not None:
+            bucket = self._by_status.get(key, {}).get(status, {})
+            tail = (record_id for record_id in tail if record_id in bucket)
+        return islice(tail, limit)
+
+    def count(self, key: int, status: Optional[str] = None) -> int:
+        if status is None:
+            return len(self._all.get(key, ()))
+        return len(self._by_status.get(key, {}).get(status, ()))
+
+    def clear(self) -> None:
+        self._all.clear()
+        self._by_status.clear()
+
+
+class BookSearchIndex:
+    """
+    Trigram inverted index over lowercased title/author plus an exact genre index.
+    Queries become posting-list intersections followed by a substring check,
+    preserving the substring semantics of the original predicate.
+    """
+
+    NGRAM = 3
+
+    def __init__(self) -> None:
+        self._title_grams: Dict[str, Set[int]] = {}
+        self._author_grams: Dict[str, Set[int]] = {}
+        self._genre: Dict[str, Set[int]] = {}
+        self._fields: Dict[int, tuple] = {}  # book_id -> (title, author) lowercased
+        self._ids: List[int] = []  # every indexed id, ascending
+
+    @classmethod
+    def _grams(cls, text: str) -> Set[str]:
+        n = cls.NGRAM
+        return {text[i : i + n] for i in range(len(text) - n + 1)}
+
+    def add(self, book: dict) -> None:
+        book_id = book["id"]
+        title = book["title"].lower()
+        author = book["author"].lower()
+        self._fields[book_id] = (title, author)
+        if self._ids and book_id < self._ids[-1]:
+            bisect.insort(self._ids, book_id)
+        else:
+            self._ids.append(book_id)
+        for gram in self._grams(title):
+            self._title_grams.setdefault(gram, set()).add(book_id)
+        for gram in self._grams(author):
+            self._author_grams.setdefault(gram, set()).add(book_id)
+        self._genre.setdefault(book["genre"].lower(), set()).add(book_id)
+
+    def _candidates(self, postings: Dict[str, Set[int]], text: str) -> Optional[Set[int]]:
+        """Ids whose field may contain `text`; None means "no pruning possible"."""
+        grams = self._grams(text)
+        if not grams:
+            return None
+        lists = sorted((postings.get(gram, set()) for gram in grams), key=len)
+        return set(lists[0]).intersection(*lists[1:])
+
+    def search(
+        self,
+        q: str = "",
+        genre: str = "",
+        author: str = "",
+        after_id: int = 0,
+        limit: Optional[int] = None,
+    ) -> List[int]:
+        """
+        Returns matching book ids in ascending order, starting after `after_id`.
+        With a `limit` the walk stops as soon as the page is full, so paging
+        through an unprunable query (e.g. q="a") touches one page of books.
+        """
+        q, genre, author = q.lower(), genre.lower(), author.lower()
+        filters: List[Set[int]] = []
+        if genre:
+            filters.append(self._genre.get(genre, set()))
+        if author:
+            author_ids = self._candidates(self._author_grams, author)
+            if author_ids is not None:
+                filters.append(author_ids)
+        if q:
+            title_ids = self._candidates(self._title_grams, q)
+            author_ids = self._candidates(self._author_grams, q)
+            if title_ids is not None and author_ids is not None:
+                filters.append(title_ids | author_ids)
+
+        if filters:
+            filters.sort(key=len)
+            candidates = sorted(filters[0].intersection(*filters[1:]))
+        else:
+            candidates = self._ids
+
+        result: List[int] = []
+        if limit is not None and limit <= 0:
+            return result
+        start = bisect.bisect_right(candidates, after_id)
+        if not q and not author:  # nothing to re-check
+            return candidates[start : None if limit is None else start + limit]
+        for book_id in islice(candidates, start, None):
+            title, book_author = self._fields[book_id]
+            if q and q not in title and q not in book_author:
+                continue
+            if author and author not in book_author:
+                continue
+            result.append(book_id)
+            if len(result) == limit:
+                break
+        return result
+
+    def clear(self) -> None:
+        self._title_grams.clear()
+        self._author_grams.clear()
+        self._genre.clear()
+        self._fields.clear()
+        self._ids.clear()
+
+
+def facet_value(book: dict, field: str):
+    value = book[field]
+    return value.lower() if field == "genre" else value
+
+
+def top_facet_values(counts: Dict, limit: int) -> List[Tuple[object, int]]:
+    """The `limit` most frequent (value, count) pairs, ties by value."""
+    return heapq.nsmallest(limit, counts.items(), key=lambda item: (-item[1], item[0]))
+
+
+class FacetIndex:
+    """
+    Value codes per book id for each facet field (0 = no such book), plus
+    running totals per value. A search's counts are one gather over the
+    codes of its matches (np.bincount when NumPy is installed), so the
+    matching books' rows are never revisited.
+    """
+
+    def __init__(self) -> None:
+        self._codes = {field: array("I") for field in FACET_FIELDS}
+        self._values: Dict[str, list] = {field: [None] for field in FACET_FIELDS}
+        self._value_codes: Dict[str, Dict[object, int]] = {field: {} for field in FACET_FIELDS}
+        self._totals: Dict[str, List[int]] = {field: [0] for field in FACET_FIELDS}
+
+    def add(self, book: dict) -> None:
+        book_id = book["id"]
+        for field, codes in self._codes.items():
+            value = facet_value(book, field)
+            code = self._value_codes[field].get(value)
+            if code is None:
+                code = self._value_codes[field][value] = len(self._values[field])
+                self._values[field].append(value)
+                self._totals[field].append(0)
+            missing = book_id + 1 - len(codes)
+            if missing > 0:
+                codes.extend(array("I", bytes(4 * max(missing, len(codes) // 2))))
+            codes[book_id] = code
+            self._totals[field][code] += 1
+
+    def counts(
+        self,
+        field: str,
+        matches: Optional[List[int]],
+        limit: int,
+        use_numpy: Optional[bool] = None,
+    ) -> List[Tuple[object, int]]:
+        """Top `limit` values of `field` among the `matches` ids (None = every book)."""
+        values, codes = self._values[field], self._codes[field]
+        if matches is None:
+            per_code = self._totals[field]
+        elif (np is not None if use_numpy is None else use_numpy) and matches:
+            gathered = np.frombuffer(codes, dtype=np.uint32)[np.array(matches, dtype=np.int64)]
+            per_code = np.bincount(gathered, minlength=len(values)).tolist()
+        else:
+            per_code = [0] * len(values)
+            for book_id in matches:
+                per_code[codes[book_id]] += 1
+        counts = {values[code]: count for code, count in enumerate(per_code) if code and count}
+        return top_facet_values(counts, limit)
+
+    def clear(self) -> None:
+        for field in FACET_FIELDS:
+            self._codes[field] = array("I")
+            self._values[field] = [None]
+            self._value_codes[field].clear()
+            self._totals[field] = [0]
+
+
+class StatisticsAggregator:
+    """
+    Running totals behind /statistics, updated by the mutating handlers.
+    Everything except the time-dependent overdue figures is read in O(1).
+    """
+
+    def __init__(self) -> None:
+        self.loans_by_status: Dict[str, int] = {}
+        self.genre_stats: Dict[str, int] = {}
+        self.loan_counts_by_book: Dict[int, int] = {}
+        self._first_loan_rank: Dict[int, int] = {}
+        self.top_book_id: Optional[int] = None
+
+    def on_book_added(self, book: dict) -> None:
+        genre = book["genre"].lower()
+        self.genre_stats[genre] = self.genre_stats.get(genre, 0) + 1
+
+    def on_loan_created(self, loan: dict) -> None:
+        self._count_status(loan["status"], +1)
+
+        book_id = loan["book_id"]
+        count = self.loan_counts_by_book.get(book_id, 0) + 1
+        self.loan_counts_by_book[book_id] = count
+        self._first_loan_rank.setdefault(book_id, len(self._first_loan_rank))
+        # Ties go to the book that was first borrowed, matching max() over a
+        # dict built in loan order.
+        top = self.top_book_id
+        if top is None:
+            self.top_book_id = book_id
+            return
+        top_count = self.loan_counts_by_book[top]
+        if count > top_count or (
+            count == top_count
+            and self._first_loan_rank[book_id] < self._first_loan_rank[top]
+        ):
+            self.top_book_id = book_id
+
+    def on_loan_status_changed(self, loan: dict, old_status: str) -> None:
+        self._count_status(old_status, -1)
+        self._count_status(loan["status"], +1)
+
+    def _count_status(self, status: str, delta: int) -> None:
+        self.loans_by_status[status] = self.loans_by_status.get(status, 0) + delta
+
+    def clear(self) -> None:
+        self.loans_by_status.clear()
+        self.genre_stats.clear()
+        self.loan_counts_by_book.clear()
+        self._first_loan_rank.clear()
+        self.top_book_id = None
+
+
+class RankedCounter:
+    """
+    Counts per key with the keys grouped by count (the LFU list layout):
+    increments and decrements are O(1), and the top k are read from the
+    highest count down instead of sorting every key.
+    """
+
+    def __init__(self) -> None:
+        self.counts: Dict[int, int] = {}
+        self._by_count: Dict[int, Set[int]] = {}
+        self._max = 0
+
+    def add(self, key: int, delta: int) -> None:
+        old = self.counts.get(key, 0)
+        new = old + delta
+        if old:
+            level = self._by_count[old]
+            level.discard(key)
+            if not level:
+                del self._by_count[old]
+        if new > 0:
+            self.counts[key] = new
+            self._by_count.setdefault(new, set()).add(key)
+            self._max = max(self._max, new)
+        else:
+            self.counts.pop(key, None)
+        while self._max and self._max not in self._by_count:
+            self._max -= 1
+
+    def top(self, k: int) -> List[Tuple[int, int]]:
+        """Up to k (key, count) pairs, highest count first, ties by key."""
+        ranked: List[Tuple[int, int]] = []
+        count = self._max
+        while count > 0 and len(ranked) < k:
+            level = self._by_count.get(count)
+            if level:
+                ranked += [(key, count) for key in heapq.nsmallest(k - len(ranked), level)]
+            count -= 1
+        return ranked
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def clear(self) -> None:
+        self.counts.clear()
+        self._by_count.clear()
+        self._max = 0
+
+
+class PopularityIndex:
+    """
+    Loans per book over the sliding POPULARITY_WINDOWS, built from hourly
+    buckets. Each window keeps a RankedCounter overall and one per genre;
+    as the clock moves on, buckets leaving a window are subtracted from it.
+    A loan counts in a window while its bucket is one of the window's last
+    buckets, the newest being the current hour (see popularity_cutoff).
+    """
+
+    def __init__(self) -> None:
+        self._spans = POPULARITY_WINDOWS
+        self._retention = max(self._spans.values())
+        # bucket -> (book_id, lowercased genre or None) -> loans issued in it
+        self._buckets: Dict[int, Dict[Tuple[int, Optional[str]], int]] = {}
+        # (window, genre or None for all books) -> loans per book
+        self._ranked: Dict[Tuple[str, Optional[str]], RankedCounter] = {}
+        self._head: Optional[int] = None  # newest bucket the windows end at
+
+    def on_loan_created(self, book_id: int, genre: Optional[str], issue_ts: float) -> None:
+        bucket = int(issue_ts // POPULARITY_BUCKET_SECONDS)
+        self.advance(bucket)
+        if bucket <= self._head - self._retention:
+            return
+        counts = self._buckets.setdefault(bucket, {})
+        counts[(book_id, genre)] = counts.get((book_id, genre), 0) + 1
+        for window, span in self._spans.items():
+            if bucket > self._head - span:
+                self._count(window, book_id, genre, +1)
+
+    def _count(self, window: str, book_id: int, genre: Optional[str], delta: int) -> None:
+        keys = [(window, None)] if genre is None else [(window, None), (window, genre)]
+        for key in keys:
+            ranked = self._ranked.get(key)
+            if ranked is None:
+                ranked = self._ranked[key] = RankedCounter()
+            ranked.add(book_id, delta)
+
+    def advance(self, bucket: int) -> None:
+        """Moves the windows forward to end at `bucket` (never backwards)."""
+        head = self._head
+        if head is not None and bucket <= head:
+            return
+        self._head = bucket
+        if head is None:
+            return
+        for old in sorted(self._buckets):
+            for window, span in self._spans.items():
+                # In the window ending at the old head, not in the new one
+                if head - span < old <= bucket - span:
+                    for (book_id, genre), loans in self._buckets[old].items():
+                        self._count(window, book_id, genre, -loans)
+            if old <= bucket - self._retention:
+                del self._buckets[old]
+
+    def top(
+        self, window: str, now_ts: float, limit: int, genre: Optional[str] = None
+    ) -> List[Tuple[int, int]]:
+        self.advance(int(now_ts // POPULARITY_BUCKET_SECONDS))
+        ranked = self._ranked.get((window, genre.lower() if genre is not None else None))
+        return ranked.top(limit) if ranked is not None else []
+
+    def clear(self) -> None:
+        self._buckets.clear()
+        self._ranked.clear()
+        self._head = None
+
+
+class DueDateIndex:
+    """
+    Min-heap of (due timestamp, loan id) over active loans.
+    Overdue queries walk only the heap nodes due before the cut-off, so their
+    cost is proportional to the number of overdue loans. Returned or renewed
+    loans leave stale heap entries that are skipped and periodically compacted.
+    """
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[float, int]] = []
+        self._due: Dict[int, float] = {}
+
+    def set(self, loan_id: int, due_ts: float) -> None:
+        self._due[loan_id] = due_ts
+        heapq.heappush(self._heap, (due_ts, loan_id))
+        self._maybe_compact()
+
+    def discard(self, loan_id: int) -> None:
+        self._due.pop(loan_id, None)
+        self._maybe_compact()
+
+    def due(self, loan_id: int) -> Optional[float]:
+        return self._due.get(loan_id)
+
+    def overdue(self, as_of_ts: float) -> Iterator[Tuple[int, float]]:
+        """Yields (loan_id, due_ts) for active loans due strictly before `as_of_ts`."""
+        heap = self._heap
+        stack = [0] if heap else []
+        while stack:
+            i = stack.pop()
+            due_ts, loan_id = heap[i]
+            if due_ts >= as_of_ts:
+                continue  # heap property: the whole subtree is due later
+            if self._due.get(loan_id) == due_ts:
+                yield loan_id, due_ts
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    stack.append(child)
+
+    def _maybe_compact(self) -> None:
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._heap = [(due_ts, loan_id) for loan_id, due_ts in self._due.items()]
+            heapq.heapify(self._heap)
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def clear(self) -> None:
+        self._heap.clear()
+        self._due.clear()
+
+
+class ExpiryScheduler:
+    """
+    Min-heap of (expires timestamp, reservation id).
+    Draining pops only entries that expired since the previous drain.
+    """
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[float, int]] = []
+        self._lock = threading.Lock()
+
+    def schedule(self, reservation_id: int, expires_ts: float) -> None:
+        with self._lock:
+            heapq.heappush(self._heap, (expires_ts, reservation_id))
+
+    def pop_expired(self, now_ts: float) -> List[int]:
+        """Removes and returns ids whose expiry is strictly before `now_ts`."""
+        expired = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] < now_ts:
+                expired.append(heapq.heappop(heap)[1])
+        return expired
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._heap.clear()
+
+
+# --- Storage Interface ---
+
+
+class LibraryStore(ABC):
+    """
+    Persistence operations needed by the route handlers.
+    Records are plain dicts in the API response shape. Mutations go through
+    the update_*/adjust_* methods so each backend can keep its indexes in sync;
+    callers group related mutations in `with store.transaction():`.
+    """
+
+    books: "Dict[int, dict]"
+    users: "Dict[int, dict]"
+    loans: "Dict[int, dict]"
+    reservations: "Dict[int, dict]"
+    # Names this store's version sequence: (epoch, kind, id, version) is never
+    # reused, even by a store that restarts with its counters back at zero.
+    epoch: str
+    # Whether transaction() discards the enclosed writes when it ends in an
+    # error. In-memory stores keep writes made before the error.
+    rolls_back = False
+
+    @abstractmethod
+    def transaction(self):
+        """Context manager making the enclosed mutations atomic."""
+
+    @abstractmethod
+    def reserve_ids(self, kind: str, count: int) -> int:
+        """Allocates `count` consecutive ids for one of ID_KINDS; returns the first."""
+
+    def next_id(self, kind: str) -> int:
+        """Allocates the next id for one of ID_KINDS."""
+        return self.reserve_ids(kind, 1)
+
+    @abstractmethod
+    def clear(self) -> None:
+        """Removes all records and resets id counters."""
+
+    @abstractmethod
+    def version(self, kind: str, record_id: int = 0) -> int:
+        """
+        Change counter for one book/user/loan, or for the whole store (kind
+        "store", id 0). It grows on every mutation of that record's read
+        payload, including loan/active-loan counts, and never goes back, not
+        even on clear(), so (kind, id, version) identifies one payload for good.
+        """
+
+    def versions(self, kind: str, record_ids: List[int]) -> List[int]:
+        """version() for many records of one kind; backends may batch the lookup."""
+        return [self.version(kind, record_id) for record_id in record_ids]
+
+    # Books
+
+    @abstractmethod
+    def insert_book(self, book: dict) -> None: ...
+
+    def insert_books(self, books: List[dict]) -> None:
+        """Inserts a batch of books; backends may override with a bulk path."""
+        for book in books:
+            self.insert_book(book)
+
+    @abstractmethod
+    def get_book(self, book_id: int) -> Optional[dict]: ...
+
+    @abstractmethod
+    def adjust_available_copies(self, book_id: int, delta: int) -> None: ...
+
+    @abstractmethod
+    def search_books(
+        self,
+        q: str = "",
+        genre: str = "",
+        author: str = "",
+        after_id: int = 0,
+        limit: Optional[int] = None,
+    ) -> List[dict]:
+        """
+        Case-insensitive substring search on title/author, exact genre.
+        Results are in id order; `after_id`/`limit` select a keyset page.
+        """
+
+    @abstractmethod
+    def facet_counts(
+        self,
+        q: str = "",
+        genre: str = "",
+        author: str = "",
+        facets: Tuple[str, ...] = FACET_FIELDS,
+        limit: int = 10,
+    ) -> Dict[str, List[Tuple[object, int]]]:
+        """
+        For each of `facets` (FACET_FIELDS), the `limit` most frequent
+        (value, count) pairs among all books search_books(q, genre, author)
+        matches, most books first, ties by value.
+        """
+
+    @abstractmethod
+    def rank_books(
+        self, q: str, limit: int, genre: str = "", author: str = ""
+    ) -> List[Tuple[dict, float]]:
+        """
+        Up to `limit` (book, score) pairs for `q` ranked by relevance (BM25
+        over title and author with typo-tolerant words, see relevance.py),
+        best first, ties by id. `genre` and `author` filter as in search_books.
+        """
+
+    @abstractmethod
+    def count_loans_for_book(self, book_id: int) -> int: ...
+
+    # Users
+
+    @abstractmethod
+    def insert_user(self, user: dict) -> None: ...
+
+    def insert_users(self, users: List[dict]) -> None:
+        """Inserts a batch of users; backends may override with a bulk path."""
+        for user in users:
+            self.insert_user(user)
+
+    @abstractmethod
+    def get_user(self, user_id: int) -> Optional[dict]: ...
+
+    @abstractmethod
+    def update_user(self, user: dict, **fields) -> None: ...
+
+    @abstractmethod
+    def adjust_balance(self, user_id: int, delta: float) -> None: ...
+
+    # Loans
+
+    @abstractmethod
+    def insert_loan(self, loan: dict) -> None: ...
+
+    @abstractmethod
+    def get_loan(self, loan_id: int) -> Optional[dict]: ...
+
+    @abstractmethod
+    def update_loan(self, loan: dict, **fields) -> None:
+        """Updates loan fields (status, due_date, fine_applied, renewed, ...)."""
+
+    @abstractmethod
+    def loans_for_user(
+        self,
+        user_id: int,
+        status: Optional[str] = None,
+        after_id: int = 0,
+        limit: Optional[int] = None,
+    ) -> List[dict]:
+        """A user's loans in creation order, optionally filtered by status and paged."""
+
+    @abstractmethod
+    def count_loans_for_user(self, user_id: int, status: Optional[str] = None) -> int: ...
+
+    @abstractmethod
+    def overdue_loans(self, as_of_ts: float) -> List[Tuple[dict, float]]:
+        """Active loans due strictly before `as_of_ts`, with their due timestamp."""
+
+    @abstractmethod
+    def fine_candidates(self, as_of_ts: float) -> Tuple[List[int], List[int], List[float]]:
+        """
+        Active loans due before `as_of_ts` whose fine has not been applied yet,
+        as parallel columns (loan ids, user ids, due timestamps) for batch math.
+        """
+
+    @abstractmethod
+    def mark_fines_applied(self, loan_ids: List[int]) -> List[Tuple[int, int, int]]:
+        """
+        Sets fine_applied on those of `loan_ids` that are still active and
+        unapplied, returning their (loan_id, user_id, book_id). Loans returned or fined
+        since fine_candidates() are skipped, so nothing is charged twice.
+        """
+
+    # Reservations
+
+    @abstractmethod
+    def insert_reservation(self, reservation: dict) -> None: ...
+
+    @abstractmethod
+    def get_active_reservation(self, user_id: int, book_id: int) -> Optional[dict]: ...
+
+    @abstractmethod
+    def update_reservation(self, reservation: dict, **fields) -> None: ...
+
+    @abstractmethod
+    def reservations_for_user(
+        self, user_id: int, after_id: int = 0, limit: Optional[int] = None
+    ) -> List[dict]:
+        """A user's reservations in creation order, optionally paged."""
+
+    @abstractmethod
+    def expire_reservations(self, now_ts: float) -> List[Tuple[int, int]]:
+        """
+        Marks active reservations expiring before `now_ts` as expired and
+        returns their (reservation_id, user_id) pairs.
+        """
+
+    # Statistics
+
+    @abstractmethod
+    def loan_status_counts(self) -> Dict[str, int]: ...
+
+    @abstractmethod
+    def genre_stats(self) -> Dict[str, int]:
+        """Books per lowercased genre, in order of first appearance."""
+
+    @abstractmethod
+    def most_popular_book_id(self) -> Optional[int]:
+        """Book with most loans; ties go to the book borrowed first."""
+
+    @abstractmethod
+    def popular_books(
+        self, window: str, now_ts: float, limit: int, genre: Optional[str] = None
+    ) -> List[Tuple[int, int]]:
+        """
+        (book_id, loans) for the books borrowed most since
+        popularity_cutoff(now_ts, window), optionally within one genre
+        (case-insensitive). Most loans first, ties by book id.
+        """
+
+
+# --- In-Memory Backend ---
+
+
+class InMemoryStore(LibraryStore):
+    """The original dict-based store, with the secondary indexes kept alongside."""
+
+    def __init__(self) -> None:
+        self.books: Dict[int, dict] = {}
+        self.users: Dict[int, dict] = {}
+        self.loans: Dict[int, dict] = {}
+        self.reservations: Dict[int, dict] = {}
+        self._counters: Dict[str, int] = dict.fromkeys(ID_KINDS, 0)
+        self._versions: Dict[Tuple[str, int], int] = {}
+        # Version of every record not in _versions; raised when a persisted
+        # store is reloaded so versions keep growing across restarts.
+        self._version_base = 0
+        self.epoch = uuid.uuid4().hex[:12]
+        self._lock = threading.RLock()
+
+        self.loans_by_user = StatusIndex()
+        self.loans_by_book = StatusIndex()
+        self.reservations_by_user = StatusIndex()
+        # (user_id, book_id) -> id of that user's active reservation for the book
+        self.active_reservations: Dict[Tuple[int, int], int] = {}
+        self.reservation_expiry = ExpiryScheduler()
+        self.book_search_index = BookSearchIndex()
+        self.relevance_index = RelevanceIndex()
+        self.facets = FacetIndex()
+        self.statistics = StatisticsAggregator()
+        self.popularity = PopularityIndex()
+        self.due_dates = DueDateIndex()
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            yield
+
+    def reserve_ids(self, kind: str, count: int) -> int:
+        with self._lock:
+            first = self._counters[kind] + 1
+            self._counters[kind] += count
+            return first
+
+    def clear(self) -> None:
+        with self._lock:
+            for table in (self.books, self.users, self.loans, self.reservations):
+                table.clear()
+            self._counters = dict.fromkeys(ID_KINDS, 0)
+            for key in self._versions:
+                self._versions[key] += 1
+            self.loans_by_user.clear()
+            self.loans_by_book.clear()
+            self.reservations_by_user.clear()
+            self.active_reservations.clear()
+            self.reservation_expiry.clear()
+            self.book_search_index.clear()
+            self.relevance_index.clear()
+            self.facets.clear()
+            self.statistics.clear()
+            self.popularity.clear()
+            self.due_dates.clear()
+
+    def version(self, kind: str, record_id: int = 0) -> int:
+        return self._versions.get((kind, record_id), self._version_base)
+
+    def versions(self, kind: str, record_ids: List[int]) -> List[int]:
+        get, base = self._versions.get, self._version_base
+        return [get((kind, record_id), base) for record_id in record_ids]
+
+    def _bump(self, *keys: Tuple[str, int]) -> None:
+        versions, base = self._versions, self._version_base
+        for key in keys + (("store", 0),):
+            versions[key] = versions.get(key, base) + 1
+
+    # Books
+
+    def insert_book(self, book: dict) -> None:
+        record = BookRecord.from_dict(book)
+        self._index_book(record)
+        self._bump(("book", record.id))
+
+    def _index_book(self, record: BookRecord) -> None:
+        self.books[record.id] = record
+        self.book_search_index.add(record)
+        self.relevance_index.add(record.id, record.title, record.author, record.genre)
+        self.facets.add(record)
+        self.statistics.on_book_added(record)
+
+    def get_book(self, book_id: int) -> Optional[dict]:
+        return self.books.get(book_id)
+
+    def adjust_available_copies(self, book_id: int, delta: int) -> None:
+        self.books[book_id].available_copies += delta
+        self._bump(("book", book_id))
+
+    def search_books(
+        self,
+        q: str = "",
+        genre: str = "",
+        author: str = "",
+        after_id: int = 0,
+        limit: Optional[int] = None,
+    ) -> List[dict]:
+        with self._lock:  # the index's sets and id list change under writers
+            book_ids = self.book_search_index.search(q, genre, author, after_id, limit)
+            return [self.books[book_id] for book_id in book_ids]
+
+    def facet_counts(
+        self,
+        q: str = "",
+        genre: str = "",
+        author: str = "",
+        facets: Tuple[str, ...] = FACET_FIELDS,
+        limit: int = 10,
+    ) -> Dict[str, List[Tuple[object, int]]]:
+        with self._lock:  # the code arrays must not grow mid-gather
+            matches = None
+            if q or genre or author:
+                matches = self.book_search_index.search(q, genre, author)
+            return {field: self.facets.counts(field, matches, limit) for field in facets}
+
+    def rank_books(
+        self, q: str, limit: int, genre: str = "", author: str = ""
+    ) -> List[Tuple[dict, float]]:
+        with self._lock:  # the index's arrays must not grow mid-query
+            restrict = set(self.book_search_index.search(author=author)) if author else None
+            ranked = self.relevance_index.search(q, limit, genre, restrict)
+        return [(self.books[book_id], score) for book_id, score in ranked]
+
+    def count_loans_for_book(self, book_id: int) -> int:
+        return self.loans_by_book.count(book_id)
+
+    # Users
+
+    def insert_user(self, user: dict) -> None:
+        self.users[user["id"]] = user
+        self._bump(("user", user["id"]))
+
+    def get_user(self, user_id: int) -> Optional[dict]:
+        return self.users.get(user_id)
+
+    def update_user(self, user: dict, **fields) -> None:
+        user.update(fields)
+        self._bump(("user", user["id"]))
+
+    def adjust_balance(self, user_id: int, delta: float) -> None:
+        self.users[user_id]["balance"] += delta
+        self._bump(("user", user_id))
+
+    # Loans
+
+    def insert_loan(self, loan: dict) -> None:
+        record = LoanRecord.from_dict(loan)
+        self._index_loan(record)
+        # The user's active loan count and the book's loan_count change too.
+        self._bump(("loan", record.id), ("user", record.user_id), ("book", record.book_id))
+
+    def _index_loan(self, record: LoanRecord) -> None:
+        status = record.status
+        self.loans[record.id] = record
+        self.loans_by_user.add(record.user_id, record.id, status)
+        self.loans_by_book.add(record.book_id, record.id, status)
+        self.statistics.on_loan_created(record)
+        book = self.books.get(record.book_id)
+        genre = book.genre.lower() if book is not None else None
+        self.popularity.on_loan_created(record.book_id, genre, record.issue_ts)
+        if status == "active":
+            self.due_dates.set(record.id, record.due_ts)
+
+    def get_loan(self, loan_id: int) -> Optional[dict]:
+        return self.loans.get(loan_id)
+
+    def update_loan(self, loan: dict, **fields) -> None:
+        record = self.loans[loan["id"]]
+        old_status = record.status
+        record.update(fields)
+        if loan is not record:
+            loan.update(fields)  # keep the caller's copy in step, as SQLiteStore does
+        status = record.status
+        if status != old_status:
+            self.loans_by_user.move(record.user_id, record.id, old_status, status)
+            self.loans_by_book.move(record.book_id, record.id, old_status, status)
+            self.statistics.on_loan_status_changed(record, old_status)
+        if status != "active":
+            self.due_dates.discard(record.id)
+        elif "due_date" in fields or status != old_status:
+            self.due_dates.set(record.id, record.due_ts)
+        self._bump(("loan", record.id), ("user", record.user_id))
+
+    def loans_for_user(
+        self,
+        user_id: int,
+        status: Optional[str] = None,
+        after_id: int = 0,
+        limit: Optional[int] = None,
+    ) -> List[dict]:
+        with self._lock:  # ids() iterates the live status buckets
+            loan_ids = self.loans_by_user.ids(user_id, status, after_id, limit)
+            return [self.loans[loan_id] for loan_id in loan_ids]
+
+    def count_loans_for_user(self, user_id: int, status: Optional[str] = None) -> int:
+        return self.loans_by_user.count(user_id, status)
+
+    def overdue_loans(self, as_of_ts: float) -> List[Tuple[dict, float]]:
+        with self._lock:  # the due-date heap is pushed and compacted by writers
+            return [
+                (self.loans[loan_id], due_ts)
+                for loan_id, due_ts in self.due_dates.overdue(as_of_ts)
+            ]
+
+    def fine_candidates(self, as_of_ts: float) -> Tuple[List[int], List[int], List[float]]:
+        loan_ids, user_ids, due = [], [], []
+        loans = self.loans
+        with self._lock:
+            for loan_id, due_ts in self.due_dates.overdue(as_of_ts):
+                record = loans[loan_id]
+                if not record.fine_applied:
+                    loan_ids.append(loan_id)
+                    user_ids.append(record.user_id)
+                    due.append(due_ts)
+        return loan_ids, user_ids, due
+
+    def mark_fines_applied(self, loan_ids: List[int]) -> List[Tuple[int, int, int]]:
+        marked = []
+        for loan_id in loan_ids:
+            record = self.loans.get(loan_id)
+            if record is None or record.fine_applied or record.status != "active":
+                continue
+            # fine_applied feeds no index, so skip update_loan's bookkeeping.
+            record.fine_applied = True
+            self._bump(("loan", loan_id), ("user", record.user_id))
+            marked.append((loan_id, record.user_id, record.book_id))
+        return marked
+
+    # Reservations
+
+    def insert_reservation(self, reservation: dict) -> None:
+        self.reservations[reservation["id"]] = reservation
+        self.reservations_by_user.add(
+            reservation["user_id"], reservation["id"], reservation["status"]
+        )
+        if reservation["status"] == "active":
+            key = (reservation["user_id"], reservation["book_id"])
+            self.active_reservations[key] = reservation["id"]
+        self.reservation_expiry.schedule(
+            reservation["id"], iso_to_timestamp(reservation["expires_at"])
+        )
+
+    def get_active_reservation(self, user_id: int, book_id: int) -> Optional[dict]:
+        reservation_id = self.active_reservations.get((user_id, book_id))
+        return None if reservation_id is None else self.reservations[reservation_id]
+
+    def update_reservation(self, reservation: dict, **fields) -> None:
+        old_status = reservation["status"]
+        reservation.update(fields)
+        status = reservation["status"]
+        if status == old_status:
+            return
+        self.reservations_by_user.move(
+            reservation["user_id"], reservation["id"], old_status, status
+        )
+        key = (reservation["user_id"], reservation["book_id"])
+        if status == "active":
+            self.active_reservations[key] = reservation["id"]
+        elif self.active_reservations.get(key) == reservation["id"]:
+            del self.active_reservations[key]
+
+    def reservations_for_user(
+        self, user_id: int, after_id: int = 0, limit: Optional[int] = None
+    ) -> List[dict]:
+        with self._lock:
+            return [
+                self.reservations[reservation_id]
+                for reservation_id in self.reservations_by_user.ids(user_id, None, after_id, limit)
+            ]
+
+    def expire_reservations(self, now_ts: float) -> List[Tuple[int, int]]:
+        expired = []
+        for reservation_id in self.reservation_expiry.pop_expired(now_ts):
+            reservation = self.reservations.get(reservation_id)
+            if reservation is not None and reservation["status"] == "active":
+                self.update_reservation(reservation, status="expired")
+                expired.append((reservation_id, reservation["user_id"]))
+        return expired
+
+    # Statistics
+
+    def loan_status_counts(self) -> Dict[str, int]:
+        return dict(self.statistics.loans_by_status)
+
+    def genre_stats(self) -> Dict[str, int]:
+        return dict(self.statistics.genre_stats)
+
+    def most_popular_book_id(self) -> Optional[int]:
+        return self.statistics.top_book_id
+
+    def popular_books(
+        self, window: str, now_ts: float, limit: int, genre: Optional[str] = None
+    ) -> List[Tuple[int, int]]:
+        with self._lock:  # reading advances the windows to now
+            return self.popularity.top(window, now_ts, limit, genre)
+
+
+# --- SQLite Backend ---
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS id_counters (
+    kind TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS store_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    author TEXT NOT NULL,
+    isbn TEXT NOT NULL,
+    genre TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    copies INTEGER NOT NULL,
+    available_copies INTEGER NOT NULL,
+    loan_count INTEGER NOT NULL DEFAULT 0,
+    first_loan_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_books_genre ON books (lower(genre));
+CREATE INDEX IF NOT EXISTS idx_books_popularity ON books (loan_count DESC, first_loan_id);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    membership_type TEXT NOT NULL,
+    balance REAL NOT NULL,
+    active INTEGER NOT NULL,
+    registered_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS loans (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    book_id INTEGER NOT NULL,
+    issue_date TEXT NOT NULL,
+    due_date TEXT NOT NULL,
+    due_ts REAL NOT NULL,
+    status TEXT NOT NULL,
+    fine_applied INTEGER NOT NULL,
+    renewed INTEGER NOT NULL,
+    return_date TEXT,
+    final_fine REAL
+);
+CREATE INDEX IF NOT EXISTS idx_loans_user_status ON loans (user_id, status);
+CREATE INDEX IF NOT EXISTS idx_loans_status_due ON loans (status, due_ts);
+CREATE INDEX IF NOT EXISTS idx_loans_issue ON loans (issue_date, book_id);
+CREATE TABLE IF NOT EXISTS loan_buckets (
+    bucket INTEGER NOT NULL,
+    book_id INTEGER NOT NULL,
+    genre TEXT,
+    n INTEGER NOT NULL,
+    PRIMARY KEY (bucket, book_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_loan_buckets_genre ON loan_buckets (genre, bucket);
+CREATE TABLE IF NOT EXISTS reservations (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    book_id INTEGER NOT NULL,
+    reserved_at TEXT NOT NULL,
+    expires_at TEXT NOT NULL,
+    expires_ts REAL NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_reservations_user ON reservations (user_id);
+CREATE INDEX IF NOT EXISTS idx_reservations_status_expiry ON reservations (status, expires_ts);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_reservations_active
+    ON reservations (user_id, book_id) WHERE status = 'active';
+"""
+
+# Version counters are bumped by triggers, so every write path (including
+# executemany bulk inserts and other worker processes) invalidates ETags.
+_VERSION_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS versions (
+        kind TEXT NOT NULL,
+        id INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        PRIMARY KEY (kind, id)
+    ) WITHOUT ROWID
+    """,
+    *(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()}
+        AFTER {event} ON {table} BEGIN
+            INSERT INTO versions (kind, id, version)
+            VALUES {values}, ('store', 0, 1)
+            ON CONFLICT (kind, id) DO UPDATE SET version = version + 1;
+        END
+        """
+        for table, values in (
+            ("books", "('book', NEW.id, 1)"),
+            ("users", "('user', NEW.id, 1)"),
+            # The user's active loan count changes too; loan_count bumps the book.
+            ("loans", "('loan', NEW.id, 1), ('user', NEW.user_id, 1)"),
+        )
+        for event in ("INSERT", "UPDATE")
+    ),
+]
+
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS book_search USING fts5 (
+    title, author, content='books', content_rowid='id', tokenize='trigram'
+)
+"""
+
+# How far below the newest indexed book ranked search still waits for a missing
+# id to commit (see _sync_relevance)
+RELEVANCE_SYNC_MARGIN = 256
+
+# Hourly loan counts per book (lowercased genre alongside) for popular_books;
+# buckets older than the longest window are pruned as new hours start. The
+# backfill drops fractional seconds, which strftime('%s') would round up.
+_POPULARITY_RETENTION = max(POPULARITY_WINDOWS.values())
+_LOAN_BUCKETS_BACKFILL = f"""
+INSERT INTO loan_buckets (bucket, book_id, genre, n)
+SELECT CAST(strftime('%s', substr(l.issue_date, 1, 19)) AS INTEGER) / {POPULARITY_BUCKET_SECONDS} AS bucket,
+       l.book_id, lower(b.genre), COUNT(*)
+FROM loans AS l LEFT JOIN books AS b ON b.id = l.book_id
+GROUP BY bucket, l.book_id
+"""
+
+_BOOK_COLUMNS = "id, title, author, isbn, genre, year, copies, available_copies"
+_USER_COLUMNS = "id, name, email, phone, membership_type, balance, active, registered_at"
+_LOAN_COLUMNS = (
+    "id, user_id, book_id, issue_date, due_date, status, fine_applied, renewed, "
+    "return_date, final_fine"
+)
+_RESERVATION_COLUMNS = "id, user_id, book_id, reserved_at, expires_at, status"
+
+# Columns handlers may change through update_*; anything else is rejected.
+_LOAN_UPDATABLE = {"status", "due_date", "fine_applied", "renewed", "return_date", "final_fine"}
+_USER_UPDATABLE = {"active"}
+_RESERVATION_UPDATABLE = {"status"}
+
+
+def _text_matches(q: str, author: str, title: str, book_author: str) -> bool:
+    """
+    The exact search semantics on lowercased q/author; FTS case folding is
+    broader than str.lower(), so candidate rows are re-checked with this.
+    """
+    title, book_author = title.lower(), book_author.lower()
+    if q and q not in title and q not in book_author:
+        return False
+    return not author or author in book_author
+
+
+def _book_from_row(row: tuple) -> dict:
+    keys = ("id", "title", "author", "isbn", "genre", "year", "copies", "available_copies")
+    return dict(zip(keys, row))
+
+
+def _user_from_row(row: tuple) -> dict:
+    user = dict(
+        zip(("id", "name", "email", "phone", "membership_type", "balance", "active", "registered_at"), row)
+    )
+    user["active"] = bool(user["active"])
+    return user
+
+
+def _loan_from_row(row: tuple) -> dict:
+    loan = {
+        "id": row[0],
+        "user_id": row[1],
+        "book_id": row[2],
+        "issue_date": row[3],
+        "due_date": row[4],
+        "status": row[5],
+        "fine_applied": bool(row[6]),
+        "renewed": bool(row[7]),
+    }
+    if row[8] is not None:
+        loan["return_date"] = row[8]
+        loan["final_fine"] = row[9]
+    return loan
+
+
+def _reservation_from_row(row: tuple) -> dict:
+    keys = ("id", "user_id", "book_id", "reserved_at", "expires_at", "status")
+    return dict(zip(keys, row))
+
+
+class _TableView:
+    """Read-only mapping over one table, standing in for the in-memory dicts."""
+
+    def __init__(self, store: "SQLiteStore", table: str, getter) -> None:
+        self._store = store
+        self._table = table
+        self._getter = getter
+
+    def get(self, record_id: int, default=None):
+        record = self._getter(record_id)
+        return default if record is None else record
+
+    def __getitem__(self, record_id: int) -> dict:
+        record = self._getter(record_id)
+        if record is None:
+            raise KeyError(record_id)
+        return record
+
+    def __contains__(self, record_id) -> bool:
+        return self._getter(record_id) is not None
+
+    def __len__(self) -> int:
+        return self._store._fetch_one(f"SELECT COUNT(*) FROM {self._table}")[0]
+
+    def __iter__(self) -> Iterator[int]:
+        rows = self._store._conn().execute(f"SELECT id FROM {self._table} ORDER BY id")
+        return (row[0] for row in rows)
+
+
+class SQLiteStore(LibraryStore):
+    """
+    SQLite backend in WAL mode. Each thread gets its own connection (and with it
+    sqlite3's prepared-statement cache); writes run inside BEGIN IMMEDIATE
+    transactions so concurrent writers serialize instead of failing midway.
+    The file can be shared by several worker processes: ids come from the
+    id_counters table, so allocation stays unique across processes.
+    """
+
+    rolls_back = True
+
+    def __init__(self, path: str, busy_timeout_ms: int = 5000) -> None:
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        # Ranked search runs on an in-process index over the books table
+        self._relevance = RelevanceIndex()
+        self._relevance_lock = threading.Lock()
+        self._relevance_gaps: Set[int] = set()  # unindexed ids within the margin
+        self._relevance_version = -1  # store version the index was last synced at
+        self._popularity_pruned = -1  # newest bucket this process pruned behind
+
+        # Several worker processes may open the same file at once; creating the
+        # schema inside one write transaction keeps that race harmless.
+        with self.transaction():
+            conn = self._conn()
+            had_buckets = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'loan_buckets'"
+            ).fetchone()
+            for statement in _SCHEMA.split(";"):
+                if statement.strip():
+                    conn.execute(statement)
+            if had_buckets is None:  # a file from before loan_buckets existed
+                conn.execute(_LOAN_BUCKETS_BACKFILL)
+            for statement in _VERSION_SCHEMA:
+                conn.execute(statement)
+            try:
+                conn.execute(_FTS_SCHEMA)
+                self.has_fts = True
+            except sqlite3.OperationalError:  # SQLite built without FTS5 / trigram
+                self.has_fts = False
+            conn.executemany(
+                "INSERT OR IGNORE INTO id_counters (kind, value) VALUES (?, 0)",
+                [(kind,) for kind in ID_KINDS],
+            )
+            # Created with the file and shared by every worker that opens it
+            conn.execute(
+                "INSERT OR IGNORE INTO store_meta (key, value) VALUES ('epoch', ?)",
+                (uuid.uuid4().hex[:12],),
+            )
+            self.epoch = conn.execute(
+                "SELECT value FROM store_meta WHERE key = 'epoch'"
+            ).fetchone()[0]
+
+        self.books = _TableView(self, "books", self.get_book)
+        self.users = _TableView(self, "users", self.get_user)
+        self.loans = _TableView(self, "loans", self.get_loan)
+        self.reservations = _TableView(self, "reservations", self._get_reservation)
+
+    # Connections and transactions
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=self.busy_timeout_ms / 1000,  # wait on locks held by other workers
+                isolation_level=None,  # explicit BEGIN/COMMIT in transaction()
+                check_same_thread=False,
+                cached_statements=256,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=OFF")
+            self._local.conn = conn
+            self._local.depth = 0
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _fetch_one(self, sql: str, params: tuple = ()) -> Optional[tuple]:
+        return self._conn().execute(sql, params).fetchone()
+
+    def _fetch_all(self, sql: str, params: tuple = ()) -> List[tuple]:
+        return self._conn().execute(sql, params).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        conn = self._conn()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def reserve_ids(self, kind: str, count: int) -> int:
+        row = self._fetch_one(
+            "UPDATE id_counters SET value = value + ? WHERE kind = ? RETURNING value",
+            (count, kind),
+        )
+        if row is None:
+            raise ValueError(f"Unknown id kind: {kind}")
+        return row[0] - count + 1
+
+    def clear(self) -> None:
+        with self.transaction():
+            conn = self._conn()
+            for table in ("books", "users", "loans", "reservations", "loan_buckets"):
+                conn.execute(f"DELETE FROM {table}")
+            if self.has_fts:
+                conn.execute("INSERT INTO book_search (book_search) VALUES ('delete-all')")
+            conn.execute("UPDATE id_counters SET value = 0")
+            conn.execute("UPDATE versions SET version = version + 1")
+        with self._relevance_lock:
+            self._relevance.clear()
+            self._relevance_gaps.clear()
+            self._relevance_version = -1
+
+    def version(self, kind: str, record_id: int = 0) -> int:
+        row = self._fetch_one(
+            "SELECT version FROM versions WHERE kind = ? AND id = ?", (kind, record_id)
+        )
+        return row[0] if row else 0
+
+    def versions(self, kind: str, record_ids: List[int]) -> List[int]:
+        found: Dict[int, int] = {}
+        for start in range(0, len(record_ids), 500):
+            chunk = record_ids[start : start + 500]
+            found.update(
+                self._fetch_all(
+                    f"SELECT id, version FROM versions WHERE kind = ? "
+                    f"AND id IN ({', '.join('?' * len(chunk))})",
+                    (kind, *chunk),
+                )
+            )
+        return [found.get(record_id, 0) for record_id in record_ids]
+
+    def _update(self, table: str, allowed: Set[str], record: dict, fields: dict) -> None:
+        unknown = set(fields) - allowed
+        if unknown:
+            raise ValueError(f"Cannot update {table} columns: {sorted(unknown)}")
+        columns = sorted(fields)
+        assignments = ", ".join(f"{column} = ?" for column in columns)
+        params = [fields[column] for column in columns]
+        if table == "loans" and "due_date" in fields:
+            assignments += ", due_ts = ?"
+            params.append(iso_to_timestamp(fields["due_date"]))
+        self._conn().execute(
+            f"UPDATE {table} SET {assignments} WHERE id = ?", (*params, record["id"])
+        )
+        record.update(fields)
+
+    # Books
+
+    def insert_book(self, book: dict) -> None:
+        self.insert_books([book])
+
+    def insert_books(self, books: List[dict]) -> None:
+        conn = self._conn()
+        conn.executemany(
+            f"INSERT INTO books ({_BOOK_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    book["id"], book["title"], book["author"], book["isbn"],
+                    book["genre"], book["year"], book["copies"], book["available_copies"],
+                )
+                for book in books
+            ],
+        )
+        if self.has_fts:
+            conn.executemany(
+                "INSERT INTO book_search (rowid, title, author) VALUES (?, ?, ?)",
+                [(book["id"], book["title"], book["author"]) for book in books],
+            )
+
+    def get_book(self, book_id: int) -> Optional[dict]:
+        row = self._fetch_one(f"SELECT {_BOOK_COLUMNS} FROM books WHERE id = ?", (book_id,))
+        return None if row is None else _book_from_row(row)
+
+    def adjust_available_copies(self, book_id: int, delta: int) -> None:
+        self._conn().execute(
+            "UPDATE books SET available_copies = available_copies + ? WHERE id = ?",
+            (delta, book_id),
+        )
+
+    def _search_filter(self, q: str, genre: str, author: str) -> Tuple[List[str], list]:
+        """
+        WHERE clauses and parameters selecting candidates for a search on
+        lowercased q/genre/author; rows still need _text_matches.
+        """
+        clauses, params = [], []
+        fts_terms = []
+        if genre:
+            clauses.append("lower(genre) = ?")
+            params.append(genre)
+        for column, text in ((None, q), ("author", author)):
+            if not text:
+                continue
+            if self.has_fts and len(text) >= 3:
+                phrase = '"' + text.replace('"', '""') + '"'
+                fts_terms.append(f"{column} : {phrase}" if column else phrase)
+            elif column:
+                clauses.append("instr(lower(author), ?) > 0")
+                params.append(text)
+            else:
+                clauses.append("(instr(lower(title), ?) > 0 OR instr(lower(author), ?) > 0)")
+                params.extend((text, text))
+        if fts_terms:
+            clauses.append("id IN (SELECT rowid FROM book_search WHERE book_search MATCH ?)")
+            params.append(" AND ".join(fts_terms))
+        return clauses, params
+
+    def search_books(
+        self,
+        q: str = "",
+        genre: str = "",
+        author: str = "",
+        after_id: int = 0,
+        limit: Optional[int] = None,
+    ) -> List[dict]:
+        q, genre, author = q.lower(), genre.lower(), author.lower()
+        clauses, params = self._search_filter(q, genre, author)
+        where = " AND ".join(["id > ?"] + clauses)
+        sql = f"SELECT {_BOOK_COLUMNS} FROM books WHERE {where} ORDER BY id LIMIT ?"
+        result: List[dict] = []
+        while limit is None or len(result) < limit:
+            # The re-check below can drop rows, so a page may take several fetches.
+            want = -1 if limit is None else limit - len(result)
+            rows = self._fetch_all(sql, (after_id, *params, want))
+            for row in rows:
+                book = _book_from_row(row)
+                if _text_matches(q, author, book["title"], book["author"]):
+                    result.append(book)
+            if limit is None or len(rows) < want:
+                break
+            after_id = rows[-1][0]
+        return result
+
+    def facet_counts(
+        self,
+        q: str = "",
+        genre: str = "",
+        author: str = "",
+        facets: Tuple[str, ...] = FACET_FIELDS,
+        limit: int = 10,
+    ) -> Dict[str, List[Tuple[object, int]]]:
+        q, genre, author = q.lower(), genre.lower(), author.lower()
+        clauses, params = self._search_filter(q, genre, author)
+        where = " AND ".join(clauses) or "1"
+        counts: Dict[str, Dict[object, int]] = {field: {} for field in facets}
+        if q or author:
+            # Text matches need the re-check, so count the narrow candidate rows.
+            rows = self._conn().execute(
+                f"SELECT title, author, genre, year FROM books WHERE {where}", params
+            )
+            for title, book_author, book_genre, year in rows:
+                if not _text_matches(q, author, title, book_author):
+                    continue
+                book = {"author": book_author, "genre": book_genre, "year": year}
+                for field in facets:
+                    value = facet_value(book, field)
+                    counts[field][value] = counts[field].get(value, 0) + 1
+        else:
+            for field in facets:
+                rows = self._fetch_all(
+                    f"SELECT {field}, COUNT(*) FROM books WHERE {where} GROUP BY {field}", params
+                )
+                for value, count in rows:
+                    value = facet_value({field: value}, field)  # merges genres by case
+                    counts[field][value] = counts[field].get(value, 0) + count
+        return {field: top_facet_values(counts[field], limit) for field in facets}
+
+    def rank_books(
+        self, q: str, limit: int, genre: str = "", author: str = ""
+    ) -> List[Tuple[dict, float]]:
+        restrict = {book["id"] for book in self.search_books(author=author)} if author else None
+        with self._relevance_lock:
+            self._sync_relevance()
+            ranked = self._relevance.search(q, limit, genre, restrict)
+        result = []
+        for book_id, score in ranked:
+            book = self.get_book(book_id)
+            if book is not None:
+                result.append((book, score))
+        return result
+
+    def _sync_relevance(self) -> None:
+        """
+        Adds books inserted since the last call, by any connection or process.
+        Nothing is read while the store version is unchanged. Otherwise only ids
+        above the newest indexed one are fetched, plus the gaps below it: ids are
+        allocated before their rows commit, so an id within RELEVANCE_SYNC_MARGIN
+        of the newest may still appear.
+        """
+        index = self._relevance
+        version = self.version("store")  # read first: later commits bump it again
+        if version == self._relevance_version:
+            return
+        newest = self._fetch_one("SELECT max(id) FROM books")[0] or 0
+        if newest < index.max_id:  # cleared through another connection
+            index.clear()
+            self._relevance_gaps.clear()
+        previous = index.max_id
+        gaps = sorted(self._relevance_gaps)
+        where = "id > ?"
+        if gaps:
+            where += f" OR id IN ({', '.join('?' * len(gaps))})"
+        rows = self._fetch_all(
+            f"SELECT id, title, author, genre FROM books WHERE {where} ORDER BY id",
+            (previous, *gaps),
+        )
+        for book_id, title, author, genre in rows:
+            index.add(book_id, title, author, genre)
+        floor = index.max_id - RELEVANCE_SYNC_MARGIN
+        self._relevance_gaps = {
+            book_id
+            for book_id in (*gaps, *range(max(previous, floor) + 1, index.max_id))
+            if book_id > floor and book_id not in index
+        }
+        self._relevance_version = version
+
+    def count_loans_for_book(self, book_id: int) -> int:
+        row = self._fetch_one("SELECT loan_count FROM books WHERE id = ?", (book_id,))
+        return row[0] if row else 0
+
+    # Users
+
+    def insert_user(self, user: dict) -> None:
+        self.insert_users([user])
+
+    def insert_users(self, users: List[dict]) -> None:
+        self._conn().executemany(
+            f"INSERT INTO users ({_USER_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    user["id"], user["name"], user["email"], user["phone"],
+                    str(getattr(user["membership_type"], "value", user["membership_type"])),
+                    user["balance"], int(user["active"]), user["registered_at"],
+                )
+                for user in users
+            ],
+        )
+
+    def get_user(self, user_id: int) -> Optional[dict]:
+        row = self._fetch_one(f"SELECT {_USER_COLUMNS} FROM users WHERE id = ?", (user_id,))
+        return None if row is None else _user_from_row(row)
+
+    def update_user(self, user: dict, **fields) -> None:
+        self._update("users", _USER_UPDATABLE, user, fields)
+
+    def adjust_balance(self, user_id: int, delta: float) -> None:
+        self._conn().execute(
+            "UPDATE users SET balance = balance + ? WHERE id = ?", (delta, user_id)
+        )
+
+    # Loans
+
+    def insert_loan(self, loan: dict) -> None:
+        conn = self._conn()
+        conn.execute(
+            "INSERT INTO loans (id, user_id, book_id, issue_date, due_date, due_ts, status, "
+            "fine_applied, renewed, return_date, final_fine) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                loan["id"], loan["user_id"], loan["book_id"], loan["issue_date"],
+                loan["due_date"], iso_to_timestamp(loan["due_date"]), loan["status"],
+                int(loan["fine_applied"]), int(loan["renewed"]),
+                loan.get("return_date"), loan.get("final_fine"),
+            ),
+        )
+        conn.execute(
+            "UPDATE books SET loan_count = loan_count + 1, "
+            "first_loan_id = COALESCE(first_loan_id, ?) WHERE id = ?",
+            (loan["id"], loan["book_id"]),
+        )
+        bucket = int(iso_to_timestamp(loan["issue_date"]) // POPULARITY_BUCKET_SECONDS)
+        conn.execute(
+            "INSERT INTO loan_buckets (bucket, book_id, genre, n) "
+            "VALUES (?, ?, (SELECT lower(genre) FROM books WHERE id = ?), 1) "
+            "ON CONFLICT (bucket, book_id) DO UPDATE SET n = n + 1",
+            (bucket, loan["book_id"], loan["book_id"]),
+        )
+        if bucket > self._popularity_pruned:  # about once an hour per process
+            conn.execute(
+                "DELETE FROM loan_buckets WHERE bucket <= ?", (bucket - _POPULARITY_RETENTION,)
+            )
+            self._popularity_pruned = bucket
+
+    def get_loan(self, loan_id: int) -> Optional[dict]:
+        row = self._fetch_one(f"SELECT {_LOAN_COLUMNS} FROM loans WHERE id = ?", (loan_id,))
+        return None if row is None else _loan_from_row(row)
+
+    def update_loan(self, loan: dict, **fields) -> None:
+        self._update("loans", _LOAN_UPDATABLE, loan, fields)
+
+    def loans_for_user(
+        self,
+        user_id: int,
+        status: Optional[str] = None,
+        after_id: int = 0,
+        limit: Optional[int] = None,
+    ) -> List[dict]:
+        status_clause = "" if status is None else "AND status = ? "
+        params = (user_id, after_id) + (() if status is None else (status,))
+        rows = self._fetch_all(
+            f"SELECT {_LOAN_COLUMNS} FROM loans WHERE user_id = ? AND id > ? "
+            f"{status_clause}ORDER BY id LIMIT ?",
+            params + (-1 if limit is None else limit,),
+        )
+        return [_loan_from_row(row) for row in rows]
+
+    def count_loans_for_user(self, user_id: int, status: Optional[str] = None) -> int:
+        if status is None:
+            return self._fetch_one("SELECT COUNT(*) FROM loans WHERE user_id = ?", (user_id,))[0]
+        return self._fetch_one(
+            "SELECT COUNT(*) FROM loans WHERE user_id = ? AND status = ?", (user_id, status)
+        )[0]
+
+    def overdue_loans(self, as_of_ts: float) -> List[Tuple[dict, float]]:
+        rows = self._fetch_all(
+            f"SELECT {_LOAN_COLUMNS}, due_ts FROM loans "
+            "WHERE status = 'active' AND due_ts < ? ORDER BY due_ts",
+            (as_of_ts,),
+        )
+        return [(_loan_from_row(row), row[-1]) for row in rows]
+
+    def fine_candidates(self, as_of_ts: float) -> Tuple[List[int], List[int], List[float]]:
+        rows = self._fetch_all(
+            "SELECT id, user_id, due_ts FROM loans "
+            "WHERE status = 'active' AND due_ts < ? AND fine_applied = 0 "
+            "ORDER BY id",  # id order keeps mark_fines_applied batches on nearby pages
+            (as_of_ts,),
+        )
+        if not rows:
+            return [], [], []
+        loan_ids, user_ids, due = zip(*rows)
+        return list(loan_ids), list(user_ids), list(due)
+
+    def mark_fines_applied(self, loan_ids: List[int]) -> List[Tuple[int, int, int]]:
+        marked: List[Tuple[int, int, int]] = []
+        conn = self._conn()
+        for start in range(0, len(loan_ids), 500):
+            chunk = loan_ids[start : start + 500]
+            marked.extend(
+                conn.execute(
+                    # "+status" keeps the planner on the primary key; with a long
+                    # IN list it would otherwise scan idx_loans_status_due.
+                    "UPDATE loans SET fine_applied = 1 "
+                    f"WHERE id IN ({', '.join('?' * len(chunk))}) "
+                    "AND +status = 'active' AND fine_applied = 0 RETURNING id, user_id, book_id",
+                    chunk,
+                ).fetchall()
+            )
+        return marked
+
+    # Reservations
+
+    def insert_reservation(self, reservation: dict) -> None:
+        self._conn().execute(
+            "INSERT INTO reservations (id, user_id, book_id, reserved_at, expires_at, "
+            "expires_ts, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                reservation["id"], reservation["user_id"], reservation["book_id"],
+                reservation["reserved_at"], reservation["expires_at"],
+                iso_to_timestamp(reservation["expires_at"]), reservation["status"],
+            ),
+        )
+
+    def _get_reservation(self, reservation_id: int) -> Optional[dict]:
+        row = self._fetch_one(
+            f"SELECT {_RESERVATION_COLUMNS} FROM reservations WHERE id = ?", (reservation_id,)
+        )
+        return None if row is None else _reservation_from_row(row)
+
+    def get_active_reservation(self, user_id: int, book_id: int) -> Optional[dict]:
+        row = self._fetch_one(
+            f"SELECT {_RESERVATION_COLUMNS} FROM reservations "
+            "WHERE user_id = ? AND book_id = ? AND status = 'active'",
+            (user_id, book_id),
+        )
+        return None if row is None else _reservation_from_row(row)
+
+    def update_reservation(self, reservation: dict, **fields) -> None:
+        self._update("reservations", _RESERVATION_UPDATABLE, reservation, fields)
+
+    def reservations_for_user(
+        self, user_id: int, after_id: int = 0, limit: Optional[int] = None
+    ) -> List[dict]:
+        rows = self._fetch_all(
+            f"SELECT {_RESERVATION_COLUMNS} FROM reservations "
+            "WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?",
+            (user_id, after_id, -1 if limit is None else limit),
+        )
+        return [_reservation_from_row(row) for row in rows]
+
+    def expire_reservations(self, now_ts: float) -> List[Tuple[int, int]]:
+        rows = self._fetch_all(
+            "UPDATE reservations SET status = 'expired' "
+            "WHERE status = 'active' AND expires_ts < ? RETURNING id, user_id",
+            (now_ts,),
+        )
+        return sorted(rows)
+
+    # Statistics
+
+    def loan_status_counts(self) -> Dict[str, int]:
+        return dict(self._fetch_all("SELECT status, COUNT(*) FROM loans GROUP BY status"))
+
+    def genre_stats(self) -> Dict[str, int]:
+        return dict(
+            self._fetch_all(
+                "SELECT lower(genre), COUNT(*) FROM books GROUP BY lower(genre) ORDER BY MIN(id)"
+            )
+        )
+
+    def most_popular_book_id(self) -> Optional[int]:
+        row = self._fetch_one(
+            "SELECT id FROM books WHERE loan_count > 0 "
+            "ORDER BY loan_count DESC, first_loan_id LIMIT 1"
+        )
+        return row[0] if row else None
+
+    def popular_books(
+        self, window: str, now_ts: float, limit: int, genre: Optional[str] = None
+    ) -> List[Tuple[int, int]]:
+        """
+        Sums the hourly loan_buckets counters in the window, never the loans:
+        the cost grows with the (book, hour) pairs that saw a loan, at most
+        one row per book per hour of the window however many loans it had.
+        """
+        since = int(popularity_cutoff(now_ts, window)) // POPULARITY_BUCKET_SECONDS
+        where, params = "bucket >= ?", (since,)
+        if genre is not None:
+            where, params = "genre = ? AND bucket >= ?", (genre.lower(), since)
+        rows = self._fetch_all(
+            f"SELECT book_id, SUM(n) AS loans FROM loan_buckets WHERE {where} "
+            "GROUP BY book_id ORDER BY loans DESC, book_id LIMIT ?",
+            (*params, limit),
+        )
+        return [(book_id, loans) for book_id, loans in rows]
+
+
+def create_store(backend: Optional[str] = None, path: Optional[str] = None) -> LibraryStore:
+    """
+    Builds the configured store: LIBRARY_STORAGE selects "memory" (default) or
+    "sqlite"; LIBRARY_SQLITE_PATH sets the database file for the latter.
+    With LIBRARY_JOURNAL_DIR the in-memory store is journaled to that
+    directory (see journal.JournaledStore); LIBRARY_JOURNAL_FSYNC,
+    LIBRARY_JOURNAL_FLUSH_MS and LIBRARY_SNAPSHOT_EVERY tune it.
+    """
+    backend = (backend or os.environ.get("LIBRARY_STORAGE", "memory")).lower()
+    if backend == "memory":
+        journal_dir = os.environ.get("LIBRARY_JOURNAL_DIR")
+        if journal_dir:
+            from journal import JournaledStore
+
+            return JournaledStore(
+                journal_dir,
+                fsync=os.environ.get("LIBRARY_JOURNAL_FSYNC", "batch"),
+                flush_interval=float(os.environ.get("LIBRARY_JOURNAL_FLUSH_MS", "50")) / 1000,
+                snapshot_every=int(os.environ.get("LIBRARY_SNAPSHOT_EVERY", "1000000")),
+            )
+        return InMemoryStore()
+    if backend == "sqlite":
+        return SQLiteStore(path or os.environ.get("LIBRARY_SQLITE_PATH", "library.db"))
+    raise ValueError(f"Unknown LIBRARY_STORAGE backend: {backend}")
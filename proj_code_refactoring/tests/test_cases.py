@@ -7,6 +7,7 @@ Run: pytest tests/test_cases.py -v
 import pytest
 from fastapi.testclient import TestClient
 from datetime import datetime, timedelta
+import json
 
 
 from refactored_code import (
@@ -30,14 +31,7 @@ import refactored_code as rc
 @pytest.fixture(autouse=True)
 def clear_state():
     """Reset all in-memory state before each test."""
-    books.clear()
-    users.clear()
-    loans.clear()
-    reservations.clear()
-    rc._book_counter = 0
-    rc._user_counter = 0
-    rc._loan_counter = 0
-    rc._reservation_counter = 0
+    rc.store.clear()  # records, id counters and indexes
     yield
 
 
@@ -343,11 +337,1057 @@ def test_membership_max_loans():
     assert get_max_loans(MembershipType.STUDENT) == 5
 
 
+# ────────────────────────────────────────────────
+# INDEX TESTS (26–29)
+# ────────────────────────────────────────────────
+
+
+def test_loan_indexes_follow_status_changes():
+    """Test 26: Returning a loan moves it out of the user's active index."""
+    _setup_user_and_book()
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    assert [loan["id"] for loan in get_active_loans_for_user(1)] == [1]
+    client.post("/loans/1/return")
+    assert get_active_loans_for_user(1) == []
+    assert rc.store.loans_by_user.count(1) == 1
+    assert rc.store.loans_by_book.count(1, "returned") == 1
+
+
+def test_user_loans_only_lists_own_loans():
+    """Test 27: /users/{id}/loans and loan_count only see indexed loans."""
+    _setup_user_and_book(copies=2, available_copies=2)
+    client.post(
+        "/users",
+        json={
+            "name": "Other",
+            "email": "other@example.com",
+            "phone": "111",
+            "membership_type": "basic",
+        },
+    )
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    client.post("/loans", json={"user_id": 2, "book_id": 1})
+    user_loans = client.get("/users/2/loans").json()["loans"]
+    assert [entry["loan"]["id"] for entry in user_loans] == [2]
+    assert client.get("/books/1").json()["loan_count"] == 2
+
+
+def test_search_index_keeps_substring_semantics():
+    """Test 28: Indexed search matches substrings across title/author, any length."""
+    _add_book("Python Cookbook", "Beazley", "tech")
+    _add_book("Fluent Python", "Ramalho", "Tech")
+    _add_book("Dune", "Herbert", "fiction")
+
+    def titles(query: str):
+        return [book["title"] for book in client.get(query).json()]
+
+    assert titles("/books/search?q=PYTHON") == ["Python Cookbook", "Fluent Python"]
+    assert titles("/books/search?q=herb") == ["Dune"]
+    assert titles("/books/search?q=du") == ["Dune"]
+    assert titles("/books/search?q=thon&author=ram") == ["Fluent Python"]
+    assert titles("/books/search?genre=TECH") == ["Python Cookbook", "Fluent Python"]
+    assert titles("/books/search?q=nohit") == []
+
+
+def test_search_trigrams_require_contiguous_match():
+    """Test 29: Sharing every trigram is not enough; the substring must occur."""
+    _add_book("abcd xbcde", "Anon", "misc")
+    assert client.get("/books/search?q=abcde").json() == []
+
+
+# ────────────────────────────────────────────────
+# STATISTICS TESTS (30–31)
+# ────────────────────────────────────────────────
+
+
+def test_statistics_counters_follow_mutations():
+    """Test 30: /statistics reflects adds, loans and returns incrementally."""
+    _setup_user_and_book(copies=2, available_copies=2)
+    _add_book("Second", "Someone", "Fiction")
+    client.post("/loans", json={"user_id": 1, "book_id": 2})
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    client.post("/loans/1/return")
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    rc.store.update_loan(loans[3], due_date=(datetime.now() - timedelta(days=2)).isoformat())
+
+    stats = client.get("/statistics").json()
+    assert stats["total_books"] == 2
+    assert stats["total_users"] == 1
+    assert stats["total_loans"] == 3
+    assert stats["active_loans"] == 2
+    assert stats["returned_loans"] == 1
+    assert stats["overdue_loans"] == 1
+    assert stats["total_outstanding_fines"] == pytest.approx(1.0)
+    assert stats["genre_stats"] == {"fiction": 2}
+    assert stats["most_popular_book"] == "Test Book"
+
+
+def test_most_popular_book_tie_goes_to_first_borrowed():
+    """Test 31: On equal loan counts the earliest-borrowed book wins."""
+    _setup_user_and_book(copies=2, available_copies=2)
+    _add_book("Second", "Someone", "fiction")
+    client.post("/loans", json={"user_id": 1, "book_id": 2})
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    assert client.get("/statistics").json()["most_popular_book"] == "Test Book"
+    client.post("/loans/1/return")
+    books[2]["available_copies"] = 1
+    client.post("/loans", json={"user_id": 1, "book_id": 2})
+    assert client.get("/statistics").json()["most_popular_book"] == "Second"
+
+
+# ────────────────────────────────────────────────
+# DUE-DATE INDEX TESTS (32–33)
+# ────────────────────────────────────────────────
+
+
+def test_overdue_query_skips_returned_and_renewed_loans():
+    """Test 32: Only currently overdue active loans are reported."""
+    _setup_user_and_book(copies=3, available_copies=3)
+    for _ in range(3):
+        client.post("/loans", json={"user_id": 1, "book_id": 1})
+    past = datetime.now() - timedelta(days=30)
+    for loan_id in (1, 2, 3):
+        rc.store.update_loan(loans[loan_id], due_date=past.isoformat())
+    client.post("/loans/1/return")
+    client.post("/loans/2/renew")  # basic: +14 days, still 16 days overdue
+
+    overdue = {loan["id"]: fine for loan, fine in rc.get_overdue_loans()}
+    assert overdue == {2: pytest.approx(8.0), 3: pytest.approx(15.0)}
+    assert rc.get_overdue_loans(past) == []
+
+
+def test_fine_for_due_matches_calculate_fine():
+    """Test 33: Timestamp-based fines agree with the ISO-string helper."""
+    now = datetime.now()
+    due = now - timedelta(days=4, hours=5)
+    loan = {"status": "active", "due_date": due.isoformat()}
+    expected = rc.fine_for_due(rc.to_timestamp(due), rc.to_timestamp(now))
+    assert calculate_fine(loan, now) == expected == pytest.approx(2.0)
+
+
+# ────────────────────────────────────────────────
+# RESERVATION EXPIRY TESTS (34–35)
+# ────────────────────────────────────────────────
+
+
+def test_expiry_drain_only_expires_active_reservations():
+    """Test 34: Draining the expiry heap expires active, not fulfilled, reservations."""
+    _setup_user_and_book(copies=2, available_copies=2)
+    _add_book("Second", "Someone", "fiction")
+    client.post("/reservations", json={"user_id": 1, "book_id": 1})
+    client.post("/reservations", json={"user_id": 1, "book_id": 2})
+    fulfill_reservation_if_exists(1, 2)
+
+    expire_stale_reservations()
+    assert reservations[1]["status"] == "active"
+
+    expire_stale_reservations(datetime.now() + timedelta(days=4))
+    assert reservations[1]["status"] == "expired"
+    assert reservations[2]["status"] == "fulfilled"
+    assert len(rc.store.reservation_expiry) == 0
+
+
+def test_user_reservations_lists_only_own():
+    """Test 35: GET /reservations/{user_id} reads the per-user index."""
+    _setup_user_and_book()
+    client.post(
+        "/users",
+        json={
+            "name": "Other",
+            "email": "other@example.com",
+            "phone": "111",
+            "membership_type": "basic",
+        },
+    )
+    client.post("/reservations", json={"user_id": 2, "book_id": 1})
+    client.post("/reservations", json={"user_id": 1, "book_id": 1})
+    response = client.get("/reservations/1").json()
+    assert [entry["reservation"]["id"] for entry in response] == [2]
+    assert response[0]["book_title"] == "Test Book"
+
+
+# ────────────────────────────────────────────────
+# RESERVATION INDEX TESTS (36–37)
+# ────────────────────────────────────────────────
+
+
+def test_loan_fulfills_reservation_via_composite_index():
+    """Test 36: Borrowing a reserved book fulfills it and frees the (user, book) key."""
+    _setup_user_and_book()
+    client.post("/reservations", json={"user_id": 1, "book_id": 1})
+    assert rc.store.active_reservations == {(1, 1): 1}
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    assert reservations[1]["status"] == "fulfilled"
+    assert rc.store.active_reservations == {}
+    response = client.post("/reservations", json={"user_id": 1, "book_id": 1})
+    assert response.status_code == 201
+
+
+def test_expired_reservation_can_be_reserved_again():
+    """Test 37: Expiry removes the reservation from the active index."""
+    _setup_user_and_book()
+    client.post("/reservations", json={"user_id": 1, "book_id": 1})
+    expire_stale_reservations(datetime.now() + timedelta(days=4))
+    assert list(rc.store.reservations_by_user.ids(1, "active")) == []
+    response = client.post("/reservations", json={"user_id": 1, "book_id": 1})
+    assert response.status_code == 201
+    assert rc.store.active_reservations == {(1, 1): 2}
+
+
+# ────────────────────────────────────────────────
+# BULK IMPORT TESTS (38–39)
+# ────────────────────────────────────────────────
+
+
+def test_bulk_books_import_reports_bad_lines():
+    """Test 38: NDJSON import inserts valid rows and reports rejected lines."""
+    good = {
+        "title": "Bulk Title",
+        "author": "Bulk Author",
+        "isbn": "1",
+        "genre": "fiction",
+        "year": 2001,
+        "copies": 1,
+        "available_copies": 1,
+    }
+    body = "\n".join(
+        [json.dumps(good), "", json.dumps({**good, "year": "soon"}), "{not json", json.dumps(good)]
+    )
+    response = client.post("/books/bulk", content=body)
+    report = response.json()
+    assert response.status_code == 200
+    assert report["inserted"] == 2
+    assert report["rejected"] == 2
+    assert report["id_ranges"] == [[1, 2]]
+    assert [error["line"] for error in report["errors"]] == [3, 4]
+    assert "year" in report["errors"][0]["error"]
+    assert len(client.get("/books/search?q=bulk").json()) == 2
+
+
+def test_bulk_users_import_spans_batches(monkeypatch):
+    """Test 39: Users are imported batch by batch with contiguous id ranges."""
+    monkeypatch.setattr(rc, "BULK_BATCH_SIZE", 2)
+    lines = [
+        json.dumps(
+            {
+                "name": f"User {i}",
+                "email": f"user{i}@example.com",
+                "phone": str(i),
+                "membership_type": "student",
+            }
+        )
+        for i in range(5)
+    ]
+    report = client.post("/users/bulk", content="\n".join(lines) + "\n").json()
+    assert report == {"inserted": 5, "rejected": 0, "id_ranges": [[1, 5]], "errors": []}
+    assert users[5]["active"] is True
+    assert client.get("/users/5").json()["user"]["name"] == "User 4"
+
+
+# ────────────────────────────────────────────────
+# PAGINATION TESTS (40–42)
+# ────────────────────────────────────────────────
+
+
+def test_search_cursor_pages_cover_all_matches_once():
+    """Test 40: Following next_cursor visits every match exactly once, in id order."""
+    for i in range(7):
+        _add_book(f"Saga {i}", "Author", "fiction" if i % 2 else "tech")
+    _add_book("Unrelated", "Nobody", "tech")
+
+    seen, cursor = [], None
+    while True:
+        params = {"q": "a", "genre": "tech", "limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        page = client.get("/books/search", params=params).json()
+        seen.extend(book["title"] for book in page["items"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == ["Saga 0", "Saga 2", "Saga 4", "Saga 6", "Unrelated"]
+    assert len(client.get("/books/search?q=a").json()) == 8  # unpaged shape unchanged
+    assert client.get("/books/search?cursor=bogus!").status_code == 400
+    assert client.get("/books/search?limit=0").status_code == 422
+
+
+def test_user_loans_and_reservations_stream_ndjson(monkeypatch):
+    """Test 41: format=ndjson streams one item per line across store chunks."""
+    monkeypatch.setattr(rc, "STREAM_CHUNK_SIZE", 2)
+    _setup_user_and_book(copies=5, available_copies=5)
+    for _ in range(3):
+        client.post("/loans", json={"user_id": 1, "book_id": 1})
+
+    response = client.get("/users/1/loans?format=ndjson")
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [item["loan"]["id"] for item in lines] == [1, 2, 3]
+    assert lines[0]["book_title"] == "Test Book"
+
+    limited = client.get("/users/1/loans?format=ndjson&limit=2").text.splitlines()
+    assert len(limited) == 2
+    assert client.get("/reservations/1?format=ndjson").text == ""
+
+
+def test_user_loans_page_omits_total_and_resumes_after_cursor():
+    """Test 42: Paged user loans return items plus a cursor instead of total_fine."""
+    _setup_user_and_book(copies=5, available_copies=5)
+    for _ in range(3):
+        client.post("/loans", json={"user_id": 1, "book_id": 1})
+
+    first = client.get("/users/1/loans?limit=2").json()
+    assert set(first) == {"items", "next_cursor"}
+    assert [item["loan"]["id"] for item in first["items"]] == [1, 2]
+    rest = client.get(f"/users/1/loans?cursor={first['next_cursor']}").json()
+    assert [item["loan"]["id"] for item in rest["items"]] == [3]
+    assert rest["next_cursor"] is None
+    assert client.get("/reservations/1?limit=5").json() == {"items": [], "next_cursor": None}
+
+
+# ────────────────────────────────────────────────
+# CONDITIONAL GET TESTS (43–45)
+# ────────────────────────────────────────────────
+
+
+def test_book_etag_revalidates_until_a_loan_changes_it():
+    """Test 43: If-None-Match gets 304 until a mutation bumps the book version."""
+    _setup_user_and_book(copies=2, available_copies=2)
+    first = client.get("/books/1")
+    etag = first.headers["etag"]
+    assert first.json()["loan_count"] == 0
+
+    cached = client.get("/books/1", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.headers["etag"] == etag
+
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    fresh = client.get("/books/1", headers={"If-None-Match": etag})
+    assert fresh.status_code == 200
+    assert fresh.headers["etag"] != etag
+    assert fresh.json()["loan_count"] == 1
+    assert fresh.json()["book"]["available_copies"] == 1
+
+
+def test_user_etag_follows_balance_and_deactivation():
+    """Test 44: User ETags change on balance/active updates and survive clear()."""
+    _setup_user_and_book()
+    etag = client.get("/users/1").headers["etag"]
+    rc.store.adjust_balance(1, -1.0)
+    after_fine = client.get("/users/1", headers={"If-None-Match": etag})
+    assert after_fine.status_code == 200
+    assert after_fine.json()["user"]["balance"] == -1.0
+
+    rc.store.clear()
+    _setup_user_and_book()
+    recreated = client.get("/users/1", headers={"If-None-Match": after_fine.headers["etag"]})
+    assert recreated.status_code == 200
+    assert recreated.json()["user"]["balance"] == 0.0
+    assert client.get("/users/2").status_code == 404
+
+
+def test_statistics_cached_until_next_fine_tick():
+    """Test 45: Statistics revalidate per store version and expire at the next fine change."""
+    _setup_user_and_book()
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    etag = client.get("/statistics").headers["etag"]
+    assert client.get("/statistics", headers={"If-None-Match": etag}).status_code == 304
+
+    now = datetime.now()
+    rc.store.update_loan(loans[1], due_date=(now - timedelta(days=1, hours=12)).isoformat())
+    stats = client.get("/statistics", headers={"If-None-Match": etag})
+    assert stats.status_code == 200
+    assert stats.json()["total_outstanding_fines"] == 0.5
+
+    now_ts = rc.to_timestamp(now)
+    _, valid_until = rc._statistics_payload(now_ts)
+    assert valid_until == pytest.approx(now_ts + 12 * 3600)
+
+
+# ────────────────────────────────────────────────
+# FRAGMENT CACHE TESTS (46–47)
+# ────────────────────────────────────────────────
+
+
+def test_spliced_loan_responses_match_default_encoding(monkeypatch):
+    """Test 46: Fragment-assembled responses are byte-identical to FastAPI's encoding."""
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from caching import get_json_encoder
+
+    monkeypatch.setattr(rc, "encode_json", get_json_encoder("json"))
+    _setup_user_and_book(copies=2, available_copies=2)
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    client.post("/loans/2/return")
+
+    expected = {
+        "loan": loans[1],
+        "user_name": "TestUser",
+        "book_title": "Test Book",
+        "current_fine": 0.0,
+    }
+    for _ in range(2):  # cold, then served from the fragment cache
+        body = client.get("/loans/1").content
+        assert body == JSONResponse(jsonable_encoder(expected)).body
+
+    listing = client.get("/users/1/loans").json()
+    assert [item["loan"]["status"] for item in listing["loans"]] == ["active", "returned"]
+    assert listing["total_fine"] == 0.0
+
+
+def test_loan_fragment_follows_renewal():
+    """Test 47: A mutated loan is re-encoded instead of served from a stale fragment."""
+    _setup_user_and_book()
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    before = client.get("/users/1/loans").json()["loans"][0]["loan"]
+    assert before["renewed"] is False
+
+    client.post("/loans/1/renew")
+    after = client.get("/loans/1").json()["loan"]
+    assert after["renewed"] is True
+    assert after["due_date"] > before["due_date"]
+    assert client.get("/users/1/loans").json()["loans"][0]["loan"] == after
+
+
+# ────────────────────────────────────────────────
+# BATCH FINE TESTS (48–49)
+# ────────────────────────────────────────────────
+
+
+def test_admin_fine_sweep_charges_each_overdue_loan_once(monkeypatch):
+    """Test 48: The fine sweep charges pending fines once and the lazy path agrees."""
+    assert client.post("/admin/fines/apply").status_code == 403  # no token configured
+    monkeypatch.setattr(rc, "ADMIN_TOKEN", "s3cret")
+    assert client.post("/admin/fines/apply", headers={"X-Admin-Token": "nope"}).status_code == 403
+
+    _setup_user_and_book(copies=3, available_copies=3)
+    for _ in range(3):
+        client.post("/loans", json={"user_id": 1, "book_id": 1})
+    now = datetime.now()
+    rc.store.update_loan(loans[1], due_date=(now - timedelta(days=4, hours=1)).isoformat())
+    rc.store.update_loan(loans[2], due_date=(now - timedelta(hours=5)).isoformat())  # fine 0
+
+    headers = {"X-Admin-Token": "s3cret"}
+    report = client.post("/admin/fines/apply", headers=headers).json()
+    assert report["candidates"] == 2
+    assert report["charged_loans"] == 1
+    assert report["total_charged"] == 2.0
+    assert users[1]["balance"] == -2.0
+    assert loans[1]["fine_applied"] is True
+    assert loans[2]["fine_applied"] is False
+
+    assert client.post("/admin/fines/apply", headers=headers).json()["charged_loans"] == 0
+    rc.apply_pending_fines(1)
+    assert users[1]["balance"] == -2.0
+
+
+def test_vectorized_fines_match_fine_for_due():
+    """Test 49: NumPy and pure Python fine kernels agree with fine_for_due."""
+    from fines import compute_fines, np
+
+    now_ts = rc.to_timestamp(datetime.now())
+    due = [now_ts - seconds for seconds in (-3600, 0, 1, 86399, 86400, 86401, 10 * 86400 + 7)]
+    expected = [rc.fine_for_due(due_ts, now_ts) for due_ts in due]
+    assert compute_fines(due, now_ts, rc.FINE_PER_DAY, use_numpy=False) == expected
+    if np is not None:
+        assert compute_fines(due, now_ts, rc.FINE_PER_DAY, use_numpy=True).tolist() == expected
+
+
+# ────────────────────────────────────────────────
+# METRICS TESTS (50–51)
+# ────────────────────────────────────────────────
+
+
+def _scrape() -> dict:
+    """Samples of GET /metrics as {'name{labels}': value}."""
+    response = client.get("/metrics")
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    samples = {}
+    for line in response.text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+def test_metrics_count_requests_per_route_template():
+    """Test 50: Requests are labelled by route template and status, errors counted."""
+    rc.request_metrics.clear()
+    _setup_user_and_book()
+    client.get("/books/1")
+    client.get("/books/2")
+    client.get("/no/such/path")
+
+    samples = _scrape()
+    route = 'method="GET",route="/books/{book_id}"'
+    assert samples[f"library_http_requests_total{{{route},status=\"200\"}}"] == 1
+    assert samples[f"library_http_requests_total{{{route},status=\"404\"}}"] == 1
+    assert samples[f"library_http_request_errors_total{{{route},status=\"404\"}}"] == 1
+    assert f"library_http_request_errors_total{{{route},status=\"200\"}}" not in samples
+    assert samples[f"library_http_request_duration_seconds_count{{{route}}}"] == 2
+    assert samples[f"library_http_request_duration_seconds_bucket{{{route},le=\"+Inf\"}}"] == 2
+    assert samples['library_http_requests_total{method="GET",route="unmatched",status="404"}'] == 1
+
+
+def test_metrics_gauges_follow_the_store():
+    """Test 51: Collection and loan-state gauges are read from the store at scrape time."""
+    _setup_user_and_book(copies=2, available_copies=2)
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    rc.store.update_loan(loans[1], due_date=(datetime.now() - timedelta(days=2)).isoformat())
+    rc.store.update_loan(loans[2], due_date=(datetime.now() - timedelta(hours=2)).isoformat())
+
+    samples = _scrape()
+    assert samples["library_books"] == 1
+    assert samples["library_users"] == 1
+    assert samples["library_loans"] == 2
+    assert samples["library_loans_active"] == 2
+    assert samples["library_loans_overdue"] == 1  # the other accrues no fine yet
+
+
+# ────────────────────────────────────────────────
+# PROFILING TESTS (52–54)
+# ────────────────────────────────────────────────
+
+
+@pytest.fixture
+def profiled_app(monkeypatch):
+    """A separate instance of the API module loaded with request profiling enabled."""
+    import importlib.util
+
+    monkeypatch.setenv("LIBRARY_PROFILE_REQUESTS", "1")
+    monkeypatch.setenv("LIBRARY_ADMIN_TOKEN", "s3cret")
+    spec = importlib.util.spec_from_file_location("refactored_profiled", rc.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_profile_header_with_admin_token_stores_handler_profile(profiled_app):
+    """Test 52: X-Debug-Profile plus the admin token profiles the handler under its request id."""
+    profiled = TestClient(profiled_app.app)
+    _add_book_via(profiled, "Profiled Title")
+    headers = {"X-Debug-Profile": "1", "X-Admin-Token": "s3cret", "X-Request-ID": "req-1"}
+    response = profiled.get("/books/search", params={"q": "profiled"}, headers=headers)
+    assert response.status_code == 200
+    assert len(response.json()) == 1
+    assert response.headers["x-profile-id"] == "req-1"
+
+    admin = {"X-Admin-Token": "s3cret"}
+    listed = profiled.get("/admin/profiles", headers=admin).json()
+    assert [profile["request_id"] for profile in listed] == ["req-1"]
+    report = profiled.get("/admin/profiles/req-1", headers=admin).text
+    assert report.startswith("GET /books/search -> 200")
+    assert "(search_books)" in report  # the handler ran in the threadpool and was captured
+    dump = profiled.get("/admin/profiles/req-1", params={"format": "pstats"}, headers=admin)
+    assert dump.headers["content-type"] == "application/octet-stream"
+    assert profiled.get("/admin/profiles/nope", headers=admin).status_code == 404
+
+
+def test_profile_requires_valid_admin_token(profiled_app):
+    """Test 53: Profile requests without a valid token are served but not profiled."""
+    profiled = TestClient(profiled_app.app)
+    response = profiled.get(
+        "/statistics", params={"debug_profile": "1"}, headers={"X-Admin-Token": "wrong"}
+    )
+    assert response.status_code == 200
+    assert "x-profile-id" not in response.headers
+    assert profiled_app.request_profiles.recent() == []
+    # The default app is loaded without LIBRARY_PROFILE_REQUESTS: no hooks at all
+    assert rc.PROFILE_REQUESTS is False
+    assert "x-profile-id" not in client.get("/statistics", headers={"X-Debug-Profile": "1"}).headers
+
+
+def test_debug_profile_returns_collapsed_stacks(monkeypatch):
+    """Test 54: /debug/profile samples other threads and returns collapsed stacks."""
+    import threading
+
+    assert client.get("/debug/profile", params={"seconds": 0.05}).status_code == 403
+    monkeypatch.setattr(rc, "ADMIN_TOKEN", "s3cret")
+    stop = threading.Event()
+
+    def busy_worker():
+        while not stop.is_set():
+            sum(i * i for i in range(1000))
+
+    worker = threading.Thread(target=busy_worker, name="busy-worker")
+    worker.start()
+    try:
+        response = client.get(
+            "/debug/profile", params={"seconds": 0.3, "hz": 100}, headers={"X-Admin-Token": "s3cret"}
+        )
+    finally:
+        stop.set()
+        worker.join()
+
+    assert response.status_code == 200
+    assert int(response.headers["x-profile-samples"]) > 0
+    stacks = {}
+    for line in response.text.splitlines():
+        stack, count = line.rsplit(" ", 1)
+        stacks[stack] = int(count)
+    busy = [stack for stack in stacks if stack.startswith("busy-worker;")]
+    assert busy and all("busy_worker (test_cases.py)" in stack for stack in busy)
+    assert not any(stack.endswith("(selectors.py)") for stack in stacks)  # idle loop skipped
+
+
+# ────────────────────────────────────────────────
+# CHANGE FEED TESTS (55–57)
+# ────────────────────────────────────────────────
+
+
+def _feed_ops(changes):
+    return [(change["entity"], change["id"], change["op"]) for change in changes]
+
+
+def test_change_feed_lists_mutations_in_order():
+    """Test 55: /changes lists committed mutations after a cursor, 410 for unknown ones."""
+    start = rc.change_feed.last_seq
+    _setup_user_and_book()
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    client.post("/loans/1/return")
+    client.post("/loans", json={"user_id": 1, "book_id": 99})  # rejected: nothing recorded
+
+    page = client.get("/changes", params={"since": start, "wait": 0}).json()
+    assert _feed_ops(page["changes"]) == [
+        ("user", 1, "created"),
+        ("book", 1, "created"),
+        ("loan", 1, "created"),
+        ("book", 1, "updated"),
+        ("loan", 1, "returned"),
+        ("book", 1, "updated"),
+        ("user", 1, "updated"),
+    ]
+    assert [change["seq"] for change in page["changes"]] == list(range(start + 1, start + 8))
+    assert page["changes"][2]["user_id"] == page["changes"][2]["book_id"] == 1
+    assert page["changes"][4]["book_id"] == 1
+    assert page["next_since"] == page["last_seq"] == start + 7
+
+    resumed = client.get(
+        "/changes", params={"since": page["next_since"], "epoch": page["epoch"], "wait": 0}
+    ).json()
+    assert resumed["changes"] == [] and resumed["next_since"] == start + 7
+    assert client.get("/changes", params={"since": start + 8, "wait": 0}).status_code == 410
+    assert client.get("/changes", params={"since": start, "epoch": "other"}).status_code == 410
+
+
+def test_changes_long_poll_returns_when_a_change_is_published():
+    """Test 56: A waiting /changes request wakes up on the next commit."""
+    import asyncio
+    import time
+
+    since = rc.change_feed.last_seq
+
+    async def poll_while_adding_a_book():
+        poll = asyncio.create_task(rc.get_changes(since=since, limit=50, wait=10.0, epoch=None))
+        await asyncio.sleep(0.05)
+        assert not poll.done()
+        await asyncio.to_thread(_add_book_via, client, "Awaited")
+        return await poll
+
+    started = time.perf_counter()
+    page = asyncio.run(poll_while_adding_a_book())
+    assert time.perf_counter() - started < 5
+    assert _feed_ops(page["changes"]) == [("book", 1, "created")]
+
+
+def test_change_stream_sends_sse_events_then_reset(monkeypatch):
+    """Test 57: /changes/stream emits SSE change events and a reset once evicted."""
+    import asyncio
+    from changes import ChangeFeed
+
+    monkeypatch.setattr(rc, "change_feed", ChangeFeed(capacity=3))
+
+    async def first_events(count, **params):
+        params = {"since": 0, "epoch": None, "last_event_id": None, **params}
+        response = await rc.stream_changes(**params)
+        events = []
+        async for chunk in response.body_iterator:
+            events.append(chunk.decode())
+            if len(events) == count:
+                break
+        await response.body_iterator.aclose()
+        return events
+
+    _add_book_via(client, "One")
+    _add_book_via(client, "Two")
+    events = asyncio.run(first_events(2))
+    epoch = rc.change_feed.epoch
+    assert events[0].startswith(f"id: {epoch}-1\nevent: change\ndata: ")
+    assert json.loads(events[1].split("data: ")[1])["id"] == 2
+
+    for title in ("Three", "Four"):
+        _add_book_via(client, title)  # seq 1 falls out of the ring
+    (reset,) = asyncio.run(first_events(1, last_event_id=f"{epoch}-0"))
+    assert reset.startswith("event: reset\n")
+    assert json.loads(reset.split("data: ")[1])["oldest_seq"] == 2
+    resumed = asyncio.run(first_events(1, last_event_id=f"{epoch}-3"))
+    assert resumed[0].startswith(f"id: {epoch}-4\n")
+
+
+# ────────────────────────────────────────────────
+# POPULARITY TESTS (58)
+# ────────────────────────────────────────────────
+
+
+def test_popular_books_rank_recent_loans():
+    """Test 58: /books/popular ranks books by loans in the window, per genre on request."""
+    _setup_user_and_book(copies=5, available_copies=5)
+    _add_book("Dune", "Herbert", "Sci-Fi")
+    for book_id in (2, 1, 1):
+        client.post("/loans", json={"user_id": 1, "book_id": book_id})
+
+    ranking = client.get("/books/popular", params={"window": "7d"}).json()
+    assert [(b["book_id"], b["loans"]) for b in ranking["books"]] == [(1, 2), (2, 1)]
+    assert ranking["books"][1]["title"] == "Dune"
+    assert ranking["since"] < datetime.now().isoformat()
+
+    sci_fi = client.get("/books/popular", params={"genre": "sci-fi", "limit": 5}).json()
+    assert [b["book_id"] for b in sci_fi["books"]] == [2]
+    assert client.get("/books/popular", params={"window": "all"}).status_code == 422
+
+
+# ────────────────────────────────────────────────
+# RANKED SEARCH TESTS (59)
+# ────────────────────────────────────────────────
+
+
+def test_ranked_search_orders_by_relevance():
+    """Test 59: mode=ranked returns scored matches, best first, despite typos."""
+    _add_book("Clean Code", "Robert Martin", "Tech")
+    _add_book("Code Complete", "Steve McConnell", "Tech")
+    _add_book("The Code Book of Secret Codes", "Simon Singh", "History")
+    _add_book("Refactoring", "Martin Fowler", "Tech")
+
+    response = client.get("/books/search", params={"q": "cleen code", "mode": "ranked"})
+    assert response.status_code == 200
+    items = response.json()["items"]
+    assert [item["book"]["id"] for item in items] == [1, 2, 3]
+    assert items[0]["book"]["title"] == "Clean Code"
+    assert items[0]["score"] > items[1]["score"] > items[2]["score"]
+
+    filtered = client.get(
+        "/books/search",
+        params={"q": "code", "mode": "ranked", "genre": "tech", "author": "mcconnell"},
+    ).json()["items"]
+    assert [item["book"]["id"] for item in filtered] == [2]
+    top = client.get("/books/search", params={"q": "code", "mode": "ranked", "limit": 1})
+    assert [item["book"]["id"] for item in top.json()["items"]] == [1]
+
+    from relevance import np
+
+    index = rc.store.relevance_index
+    for use_numpy in [False] + ([True] if np is not None else []):
+        assert index.search("cleen code", 10, use_numpy=use_numpy) == [
+            (item["book"]["id"], pytest.approx(item["score"], abs=1e-4)) for item in items
+        ]
+        # Repeated and narrowed searches must not see state left by earlier ones.
+        assert index.search("code", 10, genre="tech", restrict={2, 3}, use_numpy=use_numpy) == (
+            index.search("code", 10, genre="tech", restrict={2, 3}, use_numpy=False)
+        )
+        assert index.search("cleen code", 10, use_numpy=use_numpy)[0][0] == 1
+
+    assert client.get("/books/search", params={"q": "code", "mode": "fuzzy"}).status_code == 422
+    assert (
+        client.get("/books/search", params={"q": "code", "mode": "ranked", "cursor": "x"}).status_code
+        == 400
+    )
+
+
+# ────────────────────────────────────────────────
+# FACET TESTS (60)
+# ────────────────────────────────────────────────
+
+
+def test_search_facets_count_all_matches_alongside_a_page():
+    """Test 60: facets=... adds per-field counts over every match to a search page."""
+    _add_book("Clean Code", "Robert Martin", "Tech")
+    _add_book("Clean Architecture", "Robert Martin", "tech")
+    _add_book("Clean Coder", "Robert Martin", "Career")
+    _add_book("Refactoring", "Martin Fowler", "Tech")
+
+    response = client.get(
+        "/books/search", params={"q": "clean", "limit": 1, "facets": "genre,author"}
+    )
+    assert response.status_code == 200
+    page = response.json()
+    assert [book["id"] for book in page["items"]] == [1]
+    assert page["next_cursor"] is not None
+    assert page["facets"] == {
+        "genre": [{"value": "tech", "count": 2}, {"value": "career", "count": 1}],
+        "author": [{"value": "Robert Martin", "count": 3}],
+    }
+
+    from storage import np
+
+    matches = rc.store.book_search_index.search("clean")
+    for use_numpy in [False] + ([True] if np is not None else []):
+        assert rc.store.facets.counts("genre", matches, 10, use_numpy=use_numpy) == [
+            ("tech", 2),
+            ("career", 1),
+        ]
+
+    years = client.get("/books/search", params={"facets": "year", "facet_limit": 1}).json()
+    assert len(years["items"]) == 4
+    assert years["facets"] == {"year": [{"value": 2020, "count": 4}]}
+
+    assert client.get("/books/search", params={"facets": "isbn"}).status_code == 422
+    assert (
+        client.get("/books/search", params={"facets": "genre", "format": "ndjson"}).status_code
+        == 400
+    )
+
+
+# ────────────────────────────────────────────────
+# BATCH CHECKOUT TESTS (61-62)
+# ────────────────────────────────────────────────
+
+
+def test_batch_checkout_creates_every_loan_and_applies_fines_once():
+    """Test 61: /loans/batch lends all books, charges pending fines once, fulfills reservations."""
+    _setup_user_and_book(copies=2, available_copies=2)
+    _add_book("Dune", "Herbert", "Sci-Fi")
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    rc.store.update_loan(loans[1], due_date=(datetime.now() - timedelta(days=2)).isoformat())
+    client.post("/reservations", json={"user_id": 1, "book_id": 2})
+
+    response = client.post("/loans/batch", json={"user_id": 1, "book_ids": [1, 2]})
+    assert response.status_code == 201
+    results = response.json()["results"]
+    assert [(r["book_id"], r["status"], r["loan"]["id"]) for r in results] == [
+        (1, "created", 2),
+        (2, "created", 3),
+    ]
+    assert results[0]["loan"]["due_date"] == results[1]["loan"]["due_date"]
+    assert users[1]["balance"] == pytest.approx(-1.0)
+    assert books[1]["available_copies"] == 0 and books[2]["available_copies"] == 0
+    assert reservations[1]["status"] == "fulfilled"
+
+
+def test_batch_checkout_is_all_or_nothing():
+    """Test 62: One unavailable book or an exceeded limit rejects the whole batch."""
+    _setup_user_and_book(copies=4, available_copies=1)
+    _add_book("Dune", "Herbert", "Sci-Fi")
+
+    response = client.post("/loans/batch", json={"user_id": 1, "book_ids": [2, 1, 1, 99]})
+    assert response.status_code == 400
+    assert response.json()["detail"]["results"] == [
+        {"book_id": 2, "status": "valid"},
+        {"book_id": 1, "status": "valid"},
+        {"book_id": 1, "status": "rejected", "error": "No copies available"},
+        {"book_id": 99, "status": "rejected", "error": "Book not found"},
+    ]
+    assert len(loans) == 0
+    assert books[1]["available_copies"] == 1 and books[2]["available_copies"] == 1
+
+    books[1]["available_copies"] = 4
+    response = client.post("/loans/batch", json={"user_id": 1, "book_ids": [1, 1, 2, 1]})
+    assert response.status_code == 400
+    assert "Loan limit reached" in response.json()["detail"]
+    assert len(loans) == 0
+
+    assert client.post("/loans/batch", json={"user_id": 1, "book_ids": []}).status_code == 422
+    assert client.post("/loans/batch", json={"user_id": 9, "book_ids": [1]}).status_code == 404
+
+
+# ────────────────────────────────────────────────
+# CONDITIONAL GET EDGE CASES (63-64)
+# ────────────────────────────────────────────────
+
+
+def test_if_none_match_on_missing_record_is_404():
+    """Test 63: A version-shaped If-None-Match never turns a missing record into 304."""
+    epoch = rc.store.epoch
+    book = client.get("/books/999", headers={"If-None-Match": f'"book-{epoch}-999-0"'})
+    user = client.get("/users/999", headers={"If-None-Match": f'"user-{epoch}-999-0"'})
+    assert (book.status_code, user.status_code) == (404, 404)
+
+
+def test_restarted_store_never_reuses_an_etag(monkeypatch):
+    """Test 64: After a restart the same id and version get a different ETag."""
+    from caching import FragmentCache, ResponseCache
+    from storage import InMemoryStore
+
+    _add_book("Dune", "Herbert", "Sci-Fi")
+    before = client.get("/books/1").headers["etag"]
+
+    # A restart: an empty store whose counters start over, and empty caches
+    monkeypatch.setattr(rc, "store", InMemoryStore())
+    monkeypatch.setattr(rc, "response_cache", ResponseCache(rc.RESPONSE_CACHE_SIZE))
+    monkeypatch.setattr(rc, "fragment_cache", FragmentCache(rc.FRAGMENT_CACHE_SIZE))
+    _add_book("Solaris", "Lem", "Sci-Fi")
+    assert rc.store.version("book", 1) == 1
+
+    after = client.get("/books/1", headers={"If-None-Match": before})
+    assert after.status_code == 200
+    assert after.json()["book"]["title"] == "Solaris"
+    assert after.headers["etag"] != before
+
+
+# ────────────────────────────────────────────────
+# BOOK AND USER FRAGMENT TESTS (65)
+# ────────────────────────────────────────────────
+
+
+def test_spliced_book_and_user_responses_match_default_encoding(monkeypatch):
+    """Test 65: Book and user payloads spliced from fragments match FastAPI and stay fresh."""
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from caching import get_json_encoder
+
+    def default(payload) -> bytes:
+        return JSONResponse(jsonable_encoder(payload)).body
+
+    monkeypatch.setattr(rc, "encode_json", get_json_encoder("json"))
+    _setup_user_and_book(copies=2, available_copies=2)
+    _add_book("Clean Code", "Robert Martin", "Tech")
+    for _ in range(2):  # cold, then served from the fragment cache
+        assert client.get("/books/1").content == default(
+            {"book": rc.store.get_book(1), "loan_count": 0}
+        )
+        assert client.get("/users/1").content == default(
+            {"user": rc.store.get_user(1), "active_loans": 0}
+        )
+        assert client.get("/books/search").content == default(rc.store.search_books())
+        ranked = client.get("/books/search", params={"q": "clean", "mode": "ranked"})
+        assert ranked.json()["items"][0]["book"] == rc.store.get_book(2)
+
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    assert client.get("/books/1").json()["book"]["available_copies"] == 1
+    assert client.get("/books/search").json()[0]["available_copies"] == 1
+    assert client.get("/users/1").json()["active_loans"] == 1
+
+
+# ────────────────────────────────────────────────
+# FINE JOB CLI TESTS (66)
+# ────────────────────────────────────────────────
+
+
+def test_fine_job_cli_leaves_the_app_store_alone(tmp_path, monkeypatch):
+    """Test 66: python fines.py sweeps only --db, never the app's configured journal."""
+    import os
+    import subprocess
+    import sys
+    from storage import SQLiteStore
+
+    db_path = str(tmp_path / "library.db")
+    monkeypatch.setattr(rc, "store", SQLiteStore(db_path))
+    _setup_user_and_book()
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    loan = rc.store.get_loan(1)
+    rc.store.update_loan(loan, due_date=(datetime.now() - timedelta(days=4, hours=1)).isoformat())
+    rc.store.close()
+
+    journal_dir = tmp_path / "journal"
+    env = dict(os.environ, LIBRARY_JOURNAL_DIR=str(journal_dir), LIBRARY_STORAGE="sqlite")
+    result = subprocess.run(
+        [sys.executable, "fines.py", "--db", db_path, "--fine-per-day", "1.5"],
+        cwd=os.path.dirname(os.path.abspath(rc.__file__)),
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert json.loads(result.stdout)["total_charged"] == 6.0
+    assert not journal_dir.exists()
+
+
+# ────────────────────────────────────────────────
+# RESERVATION SWEEPER TESTS (67)
+# ────────────────────────────────────────────────
+
+
+def test_reservation_sweeper_runs_off_the_event_loop(monkeypatch):
+    """Test 67: The background sweep runs in a worker thread, not on the event loop."""
+    import asyncio
+    import threading
+
+    sweeps = []
+    monkeypatch.setattr(
+        rc, "expire_stale_reservations", lambda: sweeps.append(threading.get_ident())
+    )
+
+    async def sweep_twice():
+        task = asyncio.create_task(rc.sweep_reservations_forever(0.001))
+        while len(sweeps) < 2:
+            await asyncio.sleep(0.001)
+        task.cancel()
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(sweep_twice())
+    assert loop_thread not in sweeps
+
+
+# ────────────────────────────────────────────────
+# CHANGE FEED ROLLBACK TESTS (68)
+# ────────────────────────────────────────────────
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_rejected_mutation_publishes_only_kept_writes(backend, tmp_path, monkeypatch):
+    """Test 68: A rolled-back mutation publishes nothing; kept in-memory writes still show."""
+    from storage import SQLiteStore
+
+    if backend == "sqlite":
+        monkeypatch.setattr(rc, "store", SQLiteStore(str(tmp_path / "library.db")))
+    _setup_user_and_book(copies=2, available_copies=2)
+    client.post("/loans", json={"user_id": 1, "book_id": 1})
+    loan = rc.store.get_loan(1)
+    rc.store.update_loan(loan, due_date=(datetime.now() - timedelta(days=2, hours=1)).isoformat())
+    monkeypatch.setattr(rc, "get_max_loans", lambda membership: 1)
+
+    start = rc.change_feed.last_seq
+    response = client.post("/loans", json={"user_id": 1, "book_id": 1})  # fines, then limit
+    assert response.status_code == 400
+    changes = client.get("/changes", params={"since": start, "wait": 0}).json()["changes"]
+    if backend == "sqlite":
+        assert changes == []
+        assert rc.store.get_user(1)["balance"] == 0.0
+        rc.store.close()
+    else:
+        assert _feed_ops(changes) == [("loan", 1, "fined"), ("user", 1, "updated")]
+        assert changes[0]["book_id"] == 1
+        assert rc.store.get_user(1)["balance"] == -1.0
+
+
 # ────────────────────────────────────────────────
 # HELPERS
 # ────────────────────────────────────────────────
 
 
+def _add_book_via(test_client: TestClient, title: str):
+    """Create a single-copy book through `test_client`."""
+    test_client.post(
+        "/books",
+        json={
+            "title": title,
+            "author": "Author",
+            "isbn": "000",
+            "genre": "fiction",
+            "year": 2020,
+            "copies": 1,
+            "available_copies": 1,
+        },
+    )
+
+
+def _add_book(title: str, author: str, genre: str):
+    """Create a single-copy book with the given searchable fields."""
+    client.post(
+        "/books",
+        json={
+            "title": title,
+            "author": author,
+            "isbn": "000",
+            "genre": genre,
+            "year": 2020,
+            "copies": 1,
+            "available_copies": 1,
+        },
+    )
+
+
 def _setup_user_and_book(copies: int = 1, available_copies: int = 1):
     """Create a basic user and book for use in loan tests."""
     client.post(
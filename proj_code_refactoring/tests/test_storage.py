@@ -0,0 +1,538 @@
+"""
+Contract tests for the storage backends.
+Every test runs against InMemoryStore, JournaledStore and SQLiteStore.
+Run: pytest tests/test_storage.py -v
+"""
+
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import pytest
+from datetime import datetime, timedelta
+
+from journal import JournaledStore
+from storage import InMemoryStore, LoanRecord, SQLiteStore, create_store, to_timestamp
+
+
+@pytest.fixture(params=["memory", "journaled", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        yield InMemoryStore()
+    elif request.param == "journaled":
+        journaled_store = JournaledStore(str(tmp_path / "journal"), fsync="none")
+        yield journaled_store
+        journaled_store.close()
+    else:
+        sqlite_store = SQLiteStore(str(tmp_path / "library.db"))
+        yield sqlite_store
+        sqlite_store.close()
+
+
+def _book(store, title="Clean Code", author="Robert Martin", genre="tech", year=2008):
+    book = {
+        "id": store.next_id("book"),
+        "title": title,
+        "author": author,
+        "isbn": "000",
+        "genre": genre,
+        "year": year,
+        "copies": 1,
+        "available_copies": 1,
+    }
+    store.insert_book(book)
+    return book
+
+
+def _user(store):
+    user = {
+        "id": store.next_id("user"),
+        "name": "Alice",
+        "email": "alice@example.com",
+        "phone": "123",
+        "membership_type": "basic",
+        "balance": 0.0,
+        "active": True,
+        "registered_at": datetime.now().isoformat(),
+    }
+    store.insert_user(user)
+    return user
+
+
+def _loan(store, user_id, book_id, due_in_days=14, issued_days_ago=0):
+    now = datetime.now() - timedelta(days=issued_days_ago)
+    loan = {
+        "id": store.next_id("loan"),
+        "user_id": user_id,
+        "book_id": book_id,
+        "issue_date": now.isoformat(),
+        "due_date": (now + timedelta(days=due_in_days)).isoformat(),
+        "status": "active",
+        "fine_applied": False,
+        "renewed": False,
+    }
+    store.insert_loan(loan)
+    return loan
+
+
+def test_ids_are_sequential_and_reset_by_clear(store):
+    """Storage 1: ids count up per kind and clear() resets them."""
+    assert [store.next_id("book") for _ in range(3)] == [1, 2, 3]
+    assert store.next_id("loan") == 1
+    store.clear()
+    assert store.next_id("book") == 1
+
+
+def test_search_semantics_match_across_backends(store):
+    """Storage 2: substring title/author search, exact genre, insertion order."""
+    _book(store, "Python Cookbook", "Beazley", "tech")
+    _book(store, "Fluent Python", "Ramalho", "Tech")
+    _book(store, "Dune", "Herbert", "fiction")
+
+    def titles(**query):
+        return [book["title"] for book in store.search_books(**query)]
+
+    assert titles(q="PYTHON") == ["Python Cookbook", "Fluent Python"]
+    assert titles(q="du") == ["Dune"]
+    assert titles(q="thon", author="ram") == ["Fluent Python"]
+    assert titles(genre="tech") == ["Python Cookbook", "Fluent Python"]
+    assert titles(q='"quoted"') == []
+    assert titles() == ["Python Cookbook", "Fluent Python", "Dune"]
+
+
+def test_loan_lifecycle_keeps_queries_in_sync(store):
+    """Storage 3: status, due-date and popularity queries follow loan updates."""
+    user = _user(store)
+    first = _book(store, "First")
+    second = _book(store, "Second")
+    loan_a = _loan(store, user["id"], second["id"], due_in_days=-3)
+    loan_b = _loan(store, user["id"], first["id"])
+    _loan(store, user["id"], first["id"])
+
+    assert store.count_loans_for_user(user["id"], "active") == 3
+    assert store.count_loans_for_book(first["id"]) == 2
+    assert store.most_popular_book_id() == first["id"]
+    overdue = store.overdue_loans(to_timestamp(datetime.now()))
+    assert [loan["id"] for loan, _ in overdue] == [loan_a["id"]]
+
+    store.update_loan(
+        loan_a, status="returned", return_date=datetime.now().isoformat(), final_fine=1.5
+    )
+    store.update_loan(loan_b, due_date=(datetime.now() - timedelta(days=1)).isoformat())
+    assert [loan["id"] for loan in store.loans_for_user(user["id"], "active")] == [2, 3]
+    assert store.get_loan(loan_a["id"])["final_fine"] == 1.5
+    overdue = store.overdue_loans(to_timestamp(datetime.now()))
+    assert [loan["id"] for loan, _ in overdue] == [loan_b["id"]]
+    assert store.loan_status_counts() == {"active": 2, "returned": 1}
+
+
+def test_reservations_expire_and_fulfill(store):
+    """Storage 4: active (user, book) lookup follows fulfill and expiry."""
+    now = datetime.now()
+    for book_id in (1, 2):
+        store.insert_reservation(
+            {
+                "id": store.next_id("reservation"),
+                "user_id": 1,
+                "book_id": book_id,
+                "reserved_at": now.isoformat(),
+                "expires_at": (now + timedelta(days=3)).isoformat(),
+                "status": "active",
+            }
+        )
+    store.update_reservation(store.get_active_reservation(1, 2), status="fulfilled")
+    assert store.expire_reservations(to_timestamp(now + timedelta(days=4))) == [(1, 1)]
+    assert store.get_active_reservation(1, 1) is None
+    statuses = [r["status"] for r in store.reservations_for_user(1)]
+    assert statuses == ["expired", "fulfilled"]
+
+
+def test_user_updates_and_balance(store):
+    """Storage 5: update_user and adjust_balance persist."""
+    user = _user(store)
+    store.update_user(user, active=False)
+    store.adjust_balance(user["id"], -2.5)
+    stored = store.get_user(user["id"])
+    assert stored["active"] is False
+    assert stored["balance"] == pytest.approx(-2.5)
+    assert len(store.users) == 1
+
+
+def test_sqlite_transaction_rolls_back_and_persists(tmp_path):
+    """Storage 6: SQLite writes are atomic and survive reopening the file."""
+    path = str(tmp_path / "library.db")
+    store = create_store("sqlite", path)
+    user = _user(store)
+    with pytest.raises(RuntimeError):
+        with store.transaction():
+            store.adjust_balance(user["id"], -10)
+            raise RuntimeError("abort")
+    store.close()
+
+    reopened = SQLiteStore(path)
+    assert reopened.get_user(user["id"])["balance"] == 0.0
+    assert reopened.next_id("user") == 2
+    reopened.close()
+
+
+def _allocate_loan_ids(path: str, count: int):
+    store = SQLiteStore(path)
+    ids = [store.next_id("loan") for _ in range(count)]
+    store.close()
+    return ids
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses the fork start method")
+def test_sqlite_ids_unique_across_processes(tmp_path):
+    """Storage 7: worker processes sharing one file never hand out the same id."""
+    path = str(tmp_path / "library.db")
+    SQLiteStore(path).close()
+    with multiprocessing.get_context("fork").Pool(4) as pool:
+        batches = pool.starmap(_allocate_loan_ids, [(path, 100)] * 4)
+    allocated = sorted(loan_id for batch in batches for loan_id in batch)
+    assert allocated == list(range(1, 401))
+
+
+def test_loan_record_round_trips_api_shape():
+    """Storage 8: compact loan records expose exactly the original dict shape."""
+    now = datetime.now()
+    loan = {
+        "id": 7,
+        "user_id": 1,
+        "book_id": 2,
+        "issue_date": now.isoformat(),
+        "due_date": (now + timedelta(days=14, microseconds=1)).isoformat(),
+        "status": "active",
+        "fine_applied": False,
+        "renewed": False,
+    }
+    record = LoanRecord.from_dict(loan)
+    assert dict(record) == loan
+    assert "return_date" not in record
+
+    record.update(status="returned", return_date=now.isoformat(), final_fine=0.0)
+    assert record["status"] == "returned"
+    assert record.to_dict()["return_date"] == now.isoformat()
+    assert list(record)[-2:] == ["return_date", "final_fine"]
+
+
+def test_reserve_ids_allocates_contiguous_ranges(store):
+    """Storage 9: bulk id reservation hands out a block and advances the counter."""
+    assert store.reserve_ids("book", 5) == 1
+    assert store.next_id("book") == 6
+    assert store.reserve_ids("book", 3) == 7
+
+
+def test_keyset_pages_follow_id_order(store):
+    """Storage 10: after_id/limit pages match slices of the unpaged results."""
+    user = _user(store)
+    for i in range(6):
+        _book(store, f"Book {i}", genre="tech" if i % 3 else "art")
+    loan_ids = [_loan(store, user["id"], book_id)["id"] for book_id in (1, 2, 3, 4)]
+    store.update_loan(store.get_loan(loan_ids[0]), status="returned")
+
+    def ids(records):
+        return [record["id"] for record in records]
+
+    assert ids(store.search_books("book", after_id=2, limit=3)) == [3, 4, 5]
+    assert ids(store.search_books(genre="tech", after_id=2, limit=2)) == [3, 5]
+    assert ids(store.search_books("b", after_id=5)) == [6]
+    assert ids(store.loans_for_user(user["id"], "active", after_id=1, limit=2)) == [2, 3]
+    assert ids(store.loans_for_user(user["id"], after_id=3)) == [4]
+    assert store.reservations_for_user(user["id"], after_id=0, limit=5) == []
+
+
+def test_versions_bump_on_payload_changes_and_survive_clear(store):
+    """Storage 11: book/user/store versions grow with mutations and never reset."""
+    user = _user(store)
+    book = _book(store)
+
+    def versions():
+        return (
+            store.version("book", book["id"]),
+            store.version("user", user["id"]),
+            store.version("store"),
+        )
+
+    before = versions()
+    assert min(before) > 0
+
+    loan = _loan(store, user["id"], book["id"])
+    after_loan = versions()
+    assert all(new > old for new, old in zip(after_loan, before))
+
+    store.update_loan(loan, status="returned")
+    assert store.version("user", user["id"]) > after_loan[1]
+    assert store.version("book", book["id"]) == after_loan[0]
+
+    last = versions()
+    store.clear()
+    assert all(new > old for new, old in zip(versions(), last))
+
+
+def test_fine_candidates_and_marking_skip_settled_loans(store):
+    """Storage 12: only active, unapplied overdue loans are offered and flagged."""
+    user = _user(store)
+    book = _book(store)
+    overdue = _loan(store, user["id"], book["id"], due_in_days=-3)
+    returned = _loan(store, user["id"], book["id"], due_in_days=-3)
+    _loan(store, user["id"], book["id"], due_in_days=5)
+    store.update_loan(returned, status="returned")
+
+    loan_ids, user_ids, due = store.fine_candidates(to_timestamp(datetime.now()))
+    assert loan_ids == [overdue["id"]]
+    assert user_ids == [user["id"]]
+    assert due[0] < to_timestamp(datetime.now())
+
+    assert store.mark_fines_applied([overdue["id"], returned["id"]]) == [
+        (overdue["id"], user["id"], overdue["book_id"])
+    ]
+    assert store.mark_fines_applied([overdue["id"]]) == []
+    assert store.get_loan(overdue["id"])["fine_applied"] is True
+    assert store.fine_candidates(to_timestamp(datetime.now())) == ([], [], [])
+
+
+def _state(store):
+    """Everything a restart has to bring back, in comparable form."""
+    return (
+        {book_id: dict(book) for book_id, book in store.books.items()},
+        {user_id: dict(user) for user_id, user in store.users.items()},
+        {loan_id: dict(loan) for loan_id, loan in store.loans.items()},
+        {res_id: dict(res) for res_id, res in store.reservations.items()},
+        store.loan_status_counts(),
+        store.genre_stats(),
+        store.most_popular_book_id(),
+        [loan_id for loan_id in store.fine_candidates(to_timestamp(datetime.now()))[0]],
+    )
+
+
+def test_journaled_store_recovers_from_snapshot_and_journal(tmp_path):
+    """Storage 13: A crash loses nothing written before the flush, except a torn last frame."""
+    directory = str(tmp_path / "journal")
+    store = JournaledStore(directory, fsync="always")
+    user, book = _user(store), _book(store)
+    with store.transaction():
+        loan = _loan(store, user["id"], book["id"], due_in_days=-3)
+        store.adjust_available_copies(book["id"], -1)
+    now = datetime.now()
+    store.insert_reservation(
+        {
+            "id": store.next_id("reservation"),
+            "user_id": user["id"],
+            "book_id": book["id"],
+            "reserved_at": now.isoformat(),
+            "expires_at": (now + timedelta(days=3)).isoformat(),
+            "status": "active",
+        }
+    )
+    seen_version = store.version("book", book["id"])
+
+    recovered = JournaledStore(directory)  # no close(): as after a crash
+    assert recovered.recovery["snapshot_segment"] is None
+    assert _state(recovered) == _state(store)
+    assert recovered.version("book", book["id"]) > seen_version  # ETags never repeat
+    assert recovered.next_id("loan") == loan["id"] + 1
+
+    snapshot = recovered.snapshot()
+    assert snapshot["loans"] == 1
+    recovered.update_loan(recovered.get_loan(loan["id"]), status="returned", final_fine=1.5)
+    recovered.mark_fines_applied([loan["id"]])  # no longer active: not marked, not journaled
+    recovered.adjust_balance(user["id"], -1.5)
+    recovered.adjust_balance(user["id"], -1.0)
+    recovered.close()
+    segments = sorted(name for name in os.listdir(directory) if name.startswith("journal-"))
+    with open(os.path.join(directory, segments[-1]), "r+b") as journal:
+        journal.truncate(os.path.getsize(journal.name) - 2)  # tear the last frame
+
+    again = JournaledStore(directory)
+    assert again.recovery["snapshot_segment"] == snapshot["segment"]
+    assert again.recovery["ops"] == 2
+    assert again.get_loan(loan["id"])["status"] == "returned"
+    assert again.get_user(user["id"])["balance"] == -1.5
+    assert again.loan_status_counts() == {"active": 0, "returned": 1}
+    again.close()
+
+
+def test_popular_books_slide_with_the_window(store):
+    """Storage 14: Windowed rankings count recent loans, per genre, and slide with time."""
+    user = _user(store)
+    a, b = _book(store, "A", genre="tech"), _book(store, "B", genre="Tech")
+    c = _book(store, "C", genre="fiction")
+    for book, days_ago in [(a, 0), (a, 0), (a, 10), (b, 0), (b, 3), (c, 0)] + [(c, 20)] * 3:
+        _loan(store, user["id"], book["id"], issued_days_ago=days_ago)
+
+    now_ts = to_timestamp(datetime.now())
+    assert store.popular_books("1d", now_ts, 10) == [(a["id"], 2), (b["id"], 1), (c["id"], 1)]
+    assert store.popular_books("7d", now_ts, 10) == [(a["id"], 2), (b["id"], 2), (c["id"], 1)]
+    assert store.popular_books("7d", now_ts, 10, genre="TECH") == [(a["id"], 2), (b["id"], 2)]
+    assert store.popular_books("30d", now_ts, 1) == [(c["id"], 4)]
+    assert store.popular_books("7d", now_ts, 10, genre="poetry") == []
+
+    later_ts = now_ts + 11 * 86400  # today's loans leave 7d; the 20-day-old ones leave 30d
+    assert store.popular_books("7d", later_ts, 10) == []
+    assert store.popular_books("30d", later_ts, 10) == [(a["id"], 3), (b["id"], 2), (c["id"], 1)]
+
+
+def test_rank_books_orders_by_relevance_and_tolerates_typos(store):
+    """Storage 15: Ranked search scores title above author, forgives typos and filters."""
+    garden = _book(store, "The River Garden", "Anna Koval", genre="fiction")
+    river = _book(store, "River", "Ivan Potter", genre="tech")
+    design = _book(store, "Garden Design", "Maria River", genre="art")
+    potter = _book(store, "Harry Potter", "J. K. Rowling", genre="fiction")
+
+    ranked = store.rank_books("river", 10)
+    assert [book["id"] for book, _ in ranked] == [river["id"], garden["id"], design["id"]]
+    assert ranked[0][0]["title"] == "River"
+    assert ranked[0][1] > ranked[1][1] > ranked[2][1] > 0
+
+    assert store.rank_books("harry poter", 1)[0][0]["id"] == potter["id"]
+    assert [book["id"] for book, _ in store.rank_books("rivr", 10, genre="FICTION")] == [garden["id"]]
+    assert [book["id"] for book, _ in store.rank_books("river", 10, author="koval")] == [garden["id"]]
+    assert store.rank_books("zebra", 10) == []
+
+    again = _book(store, "River", "Ivan Potter", genre="tech")  # indexed as it arrives
+    assert [book["id"] for book, _ in store.rank_books("river", 2)] == [river["id"], again["id"]]
+
+
+def test_facet_counts_cover_all_matches(store):
+    """Storage 16: Facet counts span every match, lowercase genres and rank by count."""
+    for title, author, genre, year in [
+        ("River Song", "Anna Koval", "Poetry", 2001),
+        ("River Road", "Anna Koval", "poetry", 2001),
+        ("Blue River", "Ivan Melnyk", "travel", 2010),
+        ("Dry Land", "Ivan Melnyk", "travel", 2001),
+    ]:
+        _book(store, title, author, genre=genre, year=year)
+
+    assert store.facet_counts("river") == {
+        "genre": [("poetry", 2), ("travel", 1)],
+        "author": [("Anna Koval", 2), ("Ivan Melnyk", 1)],
+        "year": [(2001, 2), (2010, 1)],
+    }
+    assert store.facet_counts(facets=("year", "genre"), limit=1) == {
+        "year": [(2001, 3)],
+        "genre": [("poetry", 2)],
+    }
+    assert store.facet_counts(genre="TRAVEL", author="melnyk", facets=("year",)) == {
+        "year": [(2001, 1), (2010, 1)]
+    }
+    assert store.facet_counts("zebra") == {"genre": [], "author": [], "year": []}
+
+
+def test_epoch_names_one_version_sequence(tmp_path):
+    """Storage 17: SQLite keeps its epoch across reopening; every in-memory store gets a new one."""
+    path = str(tmp_path / "library.db")
+    first = SQLiteStore(path)
+    epoch = first.epoch
+    first.close()
+    reopened = SQLiteStore(path)
+    assert reopened.epoch == epoch
+    reopened.close()
+    other = SQLiteStore(str(tmp_path / "other.db"))
+    assert other.epoch != epoch
+    other.close()
+    assert InMemoryStore().epoch != InMemoryStore().epoch
+
+
+def test_in_memory_reads_are_safe_during_writes():
+    """Storage 18: Index-walking reads never see a write half-done in another thread."""
+    store = InMemoryStore()
+    user = _user(store)
+    errors = []
+    stop = threading.Event()
+
+    def write():
+        while not stop.is_set():
+            with store.transaction():
+                book = _book(store, "River")
+                _loan(store, user["id"], book["id"], issued_days_ago=20)
+
+    def read(query):
+        try:
+            while not stop.is_set():
+                query()
+        except Exception as exc:  # surfaced by the assertion below
+            errors.append(exc)
+
+    queries = [
+        lambda: store.loans_for_user(user["id"], "active"),
+        lambda: store.search_books("river"),
+        lambda: store.overdue_loans(to_timestamp(datetime.now())),
+    ]
+    threads = [threading.Thread(target=write)]
+    threads += [threading.Thread(target=read, args=(query,)) for query in queries]
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # switch threads as often as possible
+    try:
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        sys.setswitchinterval(interval)
+    assert errors == []
+
+
+def test_sqlite_ranked_search_reads_only_new_books(tmp_path):
+    """Storage 19: Ranked search indexes each book once, including ones committed late."""
+    path = str(tmp_path / "library.db")
+    writer, reader = SQLiteStore(path), SQLiteStore(path)
+    river = _book(writer, "River")
+    assert [book["id"] for book, _ in reader.rank_books("river", 10)] == [river["id"]]
+
+    statements = []
+    reader._conn().set_trace_callback(statements.append)
+    reader.rank_books("river", 10)
+    _user(writer)  # a write that adds no books
+    reader.rank_books("river", 10)
+    assert [sql for sql in statements if "SELECT id, title, author, genre" in sql] == [
+        f"SELECT id, title, author, genre FROM books WHERE id > {river['id']} ORDER BY id"
+    ]
+
+    late_id = writer.next_id("book")  # allocated now, committed after a newer book
+    delta = _book(writer, "River Delta")
+    assert {book["id"] for book, _ in reader.rank_books("river", 10)} == {river["id"], delta["id"]}
+    late = dict(delta, id=late_id, title="River Song")
+    writer.insert_book(late)
+    assert late_id in {book["id"] for book, _ in reader.rank_books("river", 10)}
+    assert reader.rank_books("song", 10)[0][0]["id"] == late_id
+    writer.close()
+    reader.close()
+
+
+def test_sqlite_popularity_reads_hourly_counters(tmp_path):
+    """Storage 20: SQLite ranks from hourly counters, backfilled for older files."""
+    import sqlite3
+
+    path = str(tmp_path / "library.db")
+    store = SQLiteStore(path)
+    user = _user(store)
+    a, b = _book(store, "A", genre="Tech"), _book(store, "B", genre="fiction")
+    for book, days_ago in [(a, 0), (a, 0), (a, 2), (b, 0), (b, 20)]:
+        _loan(store, user["id"], book["id"], issued_days_ago=days_ago)
+    now_ts = to_timestamp(datetime.now())
+    expected = {
+        ("7d", None): [(a["id"], 3), (b["id"], 1)],
+        ("30d", None): [(a["id"], 3), (b["id"], 2)],
+        ("30d", "tech"): [(a["id"], 3)],
+    }
+
+    statements = []
+    store._conn().set_trace_callback(statements.append)
+    for (window, genre), ranked in expected.items():
+        assert store.popular_books(window, now_ts, 10, genre) == ranked
+    assert statements and not [sql for sql in statements if "FROM loans" in sql]
+    store.close()
+
+    conn = sqlite3.connect(path)  # as written before the counter table existed
+    conn.execute("DROP TABLE loan_buckets")
+    conn.commit()
+    conn.close()
+    reopened = SQLiteStore(path)
+    for (window, genre), ranked in expected.items():
+        assert reopened.popular_books(window, now_ts, 10, genre) == ranked
+    reopened.close()